@@ -0,0 +1,289 @@
+"""
+Backfill: canonicalize Account phone and email fields with Bulk API 2.0.
+
+Identifier lookups in the Lambda are exact matches on the E.164 phone (phone_normalize, the
+same rules as normalize_phone_basic and the Apex AccountPhoneNormalizer) and the lower-cased
+email. The account phone lookup reads Phone_Formatted__c, a formula on Phone (read-only, see
+the DocShareService permission set), so the backfill rewrites Phone and then checks that
+Phone_Formatted__c reads back as the same canonical value on every Account; mismatches are
+logged and make the run exit non-zero. Spouse_Phone__pc is matched directly. Historical Accounts predate that, so this streams every Account with a phone or email
+out through a Bulk API 2.0 query job, normalizes the fields page by page (phones with the
+Account's Market_Unit__c) and sends only the rows that changed back as CSV update jobs:
+a handful of API calls per page instead of one per record.
+
+Progress is checkpointed after every page; rerunning with the same --checkpoint resumes at
+the next result page of the same query job (Salesforce keeps query results for 7 days).
+Updated rows re-fire AccountPhoneTrigger, whose queueable finds nothing left to change.
+
+    python backfill_identifiers.py                          # org credentials from the Lambda env (index.get_org_token)
+    python backfill_identifiers.py --instance-url https://x.my.salesforce.com --access-token $TOKEN
+    python backfill_identifiers.py --dry-run --out changes.csv
+    python backfill_identifiers.py --instance-url http://localhost:8080 --access-token test --poll-seconds 0
+"""
+import argparse, csv, io, json, os, sys, time
+import urllib.request, urllib.parse
+from urllib.error import HTTPError
+
+from phone_normalize import normalize_phones, is_normalized
+
+SF_API_VERSION = os.environ.get("SF_API_VERSION", "v61.0")
+
+PHONE_FIELDS = ("Phone", "Spouse_Phone__pc")
+FORMATTED_PHONE_FIELD = "Phone_Formatted__c"   # formula on Phone; what the Lambda matches
+EMAIL_FIELDS = ("PersonEmail", "Spouse_Email__pc")
+MARKET_FIELD = "Market_Unit__c"
+
+
+def log(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+
+class BulkClient:
+    """Minimal Bulk API 2.0 client (query and ingest jobs) over urllib."""
+
+    def __init__(self, instance_url: str, access_token: str, api_version: str = SF_API_VERSION, timeout: float = 120):
+        self.base = f"{instance_url.rstrip('/')}/services/data/{api_version}/jobs"
+        self.token = access_token
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None, content_type="application/json", accept="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        req = urllib.request.Request(self.base + path, data=body, method=method)
+        req.add_header("Authorization", f"Bearer {self.token}")
+        req.add_header("Accept", accept)
+        if body is not None:
+            req.add_header("Content-Type", content_type)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as r:
+                return r.status, r.headers, r.read()
+        except HTTPError as e:
+            log(f"Bulk API {method} {path} -> HTTP {e.code}: {e.read().decode('utf-8', 'replace')[:500]}")
+            raise
+
+    def _json(self, method, path, body=None):
+        _, _, raw = self._request(method, path, body)
+        return json.loads(raw.decode("utf-8")) if raw else {}
+
+    def create_query_job(self, soql: str) -> str:
+        return self._json("POST", "/query", {"operation": "query", "query": soql, "contentType": "CSV",
+                                             "columnDelimiter": "COMMA", "lineEnding": "LF"})["id"]
+
+    def create_update_job(self, sobject: str) -> str:
+        return self._json("POST", "/ingest", {"object": sobject, "operation": "update", "contentType": "CSV",
+                                              "columnDelimiter": "COMMA", "lineEnding": "LF"})["id"]
+
+    def wait(self, kind: str, job_id: str, poll_seconds: float = 5, states=("JobComplete",)) -> dict:
+        """Poll a job until it reaches one of `states`. Raises on Failed/Aborted."""
+        while True:
+            info = self._json("GET", f"/{kind}/{job_id}")
+            state = info.get("state")
+            if state in states:
+                return info
+            if state in ("Failed", "Aborted"):
+                raise RuntimeError(f"{kind} job {job_id} {state}: {info.get('errorMessage') or ''}")
+            time.sleep(poll_seconds)
+
+    def query_page(self, job_id: str, locator: str = "", max_records: int = 10000):
+        """One page of query results: (rows as dicts, next locator or None when done)."""
+        path = f"/query/{job_id}/results?maxRecords={int(max_records)}"
+        if locator:
+            path += f"&locator={urllib.parse.quote(locator)}"
+        _, headers, raw = self._request("GET", path, accept="text/csv")
+        nxt = headers.get("Sforce-Locator")
+        rows = list(csv.DictReader(io.StringIO(raw.decode("utf-8"))))
+        return rows, (None if not nxt or nxt == "null" else nxt)
+
+    def upload(self, job_id: str, csv_bytes: bytes):
+        self._request("PUT", f"/ingest/{job_id}/batches", csv_bytes, content_type="text/csv")
+        self._request("PATCH", f"/ingest/{job_id}", {"state": "UploadComplete"})
+
+    def abort(self, kind: str, job_id: str):
+        self._request("PATCH", f"/{kind}/{job_id}", {"state": "Aborted"})
+
+    def failed_results(self, job_id: str) -> str:
+        _, _, raw = self._request("GET", f"/ingest/{job_id}/failedResults", accept="text/csv")
+        return raw.decode("utf-8")
+
+
+def canonicalize(rows, phone_fields=PHONE_FIELDS, email_fields=EMAIL_FIELDS) -> list:
+    """
+    Rows whose phone/email fields change under canonicalization, as {"Id", field: new, ...}.
+    Unchanged fields are left out (an empty CSV cell leaves the field untouched in Bulk API 2.0).
+    """
+    markets = [r.get(MARKET_FIELD) or None for r in rows]
+    changes = [{} for _ in rows]
+    for field in phone_fields:
+        values = [(r.get(field) or "") for r in rows]
+        for change, old, new in zip(changes, values, normalize_phones(values, markets)):
+            if old.strip() and new != old:
+                change[field] = new
+    for field in email_fields:
+        for change, r in zip(changes, rows):
+            old = r.get(field) or ""
+            new = old.strip().lower()
+            if new and new != old:
+                change[field] = new
+    return [dict(change, Id=r["Id"]) for change, r in zip(changes, rows) if change]
+
+
+def to_csv(changed, fields) -> bytes:
+    buf = io.StringIO()
+    w = csv.DictWriter(buf, fieldnames=["Id"] + list(fields), lineterminator="\n", extrasaction="ignore")
+    w.writeheader()
+    w.writerows(changed)
+    return buf.getvalue().encode("utf-8")
+
+
+def load_checkpoint(path: str) -> dict:
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+def save_checkpoint(path: str, state: dict):
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)  # never leave a half-written checkpoint behind
+
+
+def verify_formatted_phones(client: BulkClient, page_size: int = 10000, poll_seconds: float = 5) -> list:
+    """
+    Ids of Accounts whose Phone_Formatted__c does not read back as their (now canonical)
+    Phone, i.e. accounts the Lambda's exact phone match would miss.
+    """
+    job_id = client.create_query_job(f"SELECT Id, Phone, {FORMATTED_PHONE_FIELD} FROM Account WHERE Phone != null")
+    client.wait("query", job_id, poll_seconds)
+    bad, locator = [], ""
+    while locator is not None:
+        rows, locator = client.query_page(job_id, locator, page_size)
+        for r in rows:
+            formatted = r.get(FORMATTED_PHONE_FIELD) or ""
+            if not is_normalized(formatted) or formatted != (r.get("Phone") or "").strip():
+                bad.append(r["Id"])
+        locator = locator or None
+    return bad
+
+
+def run(client: BulkClient, checkpoint_path: str = None, page_size: int = 10000, poll_seconds: float = 5,
+        phone_fields=PHONE_FIELDS, email_fields=EMAIL_FIELDS, dry_run: bool = False, out=None,
+        max_pages: int = None) -> dict:
+    """
+    Stream, canonicalize and update all Accounts, resuming from `checkpoint_path` if it exists.
+    Returns the final checkpoint state (counts, update job ids, failures).
+    """
+    fields = list(phone_fields) + list(email_fields)
+    state = load_checkpoint(checkpoint_path)
+    if not state.get("query_job"):
+        where = " OR ".join(f"{f} != null" for f in fields)
+        soql = f"SELECT Id, {MARKET_FIELD}, {', '.join(fields)} FROM Account WHERE {where}"
+        state = {"query_job": client.create_query_job(soql), "locator": "", "done": False,
+                 "pages": 0, "scanned": 0, "changed": 0, "update_jobs": []}
+        save_checkpoint(checkpoint_path, state)
+        log(f"Created query job {state['query_job']}")
+    else:
+        log(f"Resuming query job {state['query_job']} at page {state['pages']} ({state['scanned']} records scanned)")
+
+    client.wait("query", state["query_job"], poll_seconds)
+    writer = None
+    pages = 0
+    while not state["done"] and (max_pages is None or pages < max_pages):
+        rows, nxt = client.query_page(state["query_job"], state["locator"], page_size)
+        changed = canonicalize(rows, phone_fields, email_fields)
+        if changed and dry_run and out:
+            if writer is None:
+                writer = csv.DictWriter(out, fieldnames=["Id"] + fields, lineterminator="\n", extrasaction="ignore")
+                if out.tell() == 0:  # new or empty file (append mode starts at the end)
+                    writer.writeheader()
+            writer.writerows(changed)
+        elif changed and not dry_run:
+            job_id = client.create_update_job("Account")
+            try:
+                client.upload(job_id, to_csv(changed, fields))
+            except Exception:
+                # Don't leave an Open job behind; the page is retried on the next run
+                try:
+                    client.abort("ingest", job_id)
+                except Exception as e:
+                    log(f"Could not abort update job {job_id}: {e!r}")
+                raise
+            state["update_jobs"].append(job_id)
+        state["pages"] += 1
+        state["scanned"] += len(rows)
+        state["changed"] += len(changed)
+        state["locator"] = nxt or ""
+        state["done"] = nxt is None
+        save_checkpoint(checkpoint_path, state)
+        pages += 1
+        log(f"Page {state['pages']}: {len(rows)} records, {len(changed)} changed "
+            f"(total {state['scanned']} scanned, {state['changed']} changed)")
+
+    if state["done"] and not dry_run:
+        # Update jobs run on Salesforce's side; collect their outcome once everything is queued
+        failed = 0
+        for job_id in state["update_jobs"]:
+            info = client.wait("ingest", job_id, poll_seconds, states=("JobComplete", "Failed"))
+            n = int(info.get("numberRecordsFailed") or 0)
+            if n:
+                failed += n
+                log(f"Update job {job_id}: {n} failed records\n{client.failed_results(job_id)}")
+        state["failed"] = failed
+        if "Phone" in phone_fields:
+            bad = verify_formatted_phones(client, page_size, poll_seconds)
+            state["formatted_mismatches"] = len(bad)
+            if bad:
+                log(f"{len(bad)} Accounts whose {FORMATTED_PHONE_FIELD} is not their canonical Phone, e.g. {bad[:20]}")
+        save_checkpoint(checkpoint_path, state)
+    return state
+
+
+def _org_credentials():
+    """Org token and instance URL the Lambda itself uses (same env vars)."""
+    import index
+    org_token, instance_url = index.get_org_token()
+    return instance_url, org_token
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Canonicalize Account phone/email fields via Bulk API 2.0")
+    p.add_argument("--instance-url", default=os.environ.get("SF_INSTANCE_URL"))
+    p.add_argument("--access-token", default=os.environ.get("SF_ACCESS_TOKEN"))
+    p.add_argument("--api-version", default=SF_API_VERSION)
+    p.add_argument("--checkpoint", default=None,
+                   help="progress file (default backfill_identifiers[.dry-run].checkpoint.json)")
+    p.add_argument("--page-size", type=int, default=10000, help="query records per page (one update job per page)")
+    p.add_argument("--poll-seconds", type=float, default=5)
+    p.add_argument("--phone-fields", default=",".join(PHONE_FIELDS))
+    p.add_argument("--email-fields", default=",".join(EMAIL_FIELDS))
+    p.add_argument("--max-pages", type=int, default=None, help="stop after this many pages (resume later)")
+    p.add_argument("--dry-run", action="store_true", help="no update jobs; write changes to --out")
+    p.add_argument("--out", default=None, help="CSV of changed rows (with --dry-run)")
+    args = p.parse_args(argv)
+    # A dry run must never mark the real backfill as done
+    checkpoint = args.checkpoint or ("backfill_identifiers.dry-run.checkpoint.json" if args.dry_run
+                                     else "backfill_identifiers.checkpoint.json")
+
+    instance_url, access_token = args.instance_url, args.access_token
+    if not (instance_url and access_token):
+        instance_url, access_token = _org_credentials()
+    client = BulkClient(instance_url, access_token, args.api_version)
+    phone_fields = [f for f in args.phone_fields.split(",") if f]
+    email_fields = [f for f in args.email_fields.split(",") if f]
+
+    out = open(args.out, "a", newline="", encoding="utf-8") if args.out else None
+    try:
+        state = run(client, checkpoint, args.page_size, args.poll_seconds, phone_fields, email_fields,
+                    dry_run=args.dry_run, out=out, max_pages=args.max_pages)
+    finally:
+        if out:
+            out.close()
+    print(json.dumps({k: state.get(k) for k in ("query_job", "done", "pages", "scanned", "changed", "failed",
+                                                "formatted_mismatches")}))
+    return 0 if state.get("done") and not state.get("failed") and not state.get("formatted_mismatches") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,16 @@
-import json, os, random, datetime, traceback, re, mimetypes, sys, time, hmac, hashlib, base64, secrets
-import urllib.request, urllib.parse
+import json, os, random, datetime, traceback, re, math, unicodedata, mimetypes, sys, time, hmac, hashlib, base64, secrets, threading, zlib, tempfile, contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request, urllib.parse, http.client, ssl, gzip, io
 from urllib.error import HTTPError, URLError
+from phone_normalize import normalize_phone, canonical_phone, market_for_brand, BRAND_MARKETS
 import boto3
 
+try:
+    import numpy as np   # optional: vectorized similarity; pure-Python fallback below
+except ImportError:
+    np = None
+
 """
 DFJ Document-Share Lambda
 - Journal OTP (legacy): /otp-send, /otp-verify (+ e,t links)
@@ -10,6 +18,10 @@ DFJ Document-Share Lambda
 - Identifier-protected: /identifier/list, /identifier/doc-url, /identifier/approve
 - Journal-protected:    /doc-list, /doc-url, /approve
 - Chat remains journal-scoped
+- s3_event_handler: second entry point, warms the text cache on S3 ObjectCreated
+- stream_handler: response-streaming entry point (/identifier/chat/ask-stream as NDJSON)
+- write_behind_sqs_handler: drains queued best-effort Salesforce updates (WRITE_BEHIND_MODE=sqs)
+- identifier_index_refresh_handler: scheduled refresh of the identifier -> journal index
 """
 
 # ===================== ENV =====================
@@ -21,15 +33,95 @@ SF_CLIENT_ID     = os.environ.get("SF_CLIENT_ID")
 SF_CLIENT_SECRET = os.environ.get("SF_CLIENT_SECRET")
 SF_REFRESH_TOKEN = os.environ.get("SF_REFRESH_TOKEN")
 
+# Org token reuse across warm invocations. Salesforce does not return expires_in for the
+# refresh_token grant, so we track token age ourselves against the org session timeout.
+SF_TOKEN_MAX_AGE_SECONDS       = int(os.environ.get("SF_TOKEN_MAX_AGE_SECONDS", "3600"))
+SF_TOKEN_REFRESH_AHEAD_SECONDS = int(os.environ.get("SF_TOKEN_REFRESH_AHEAD_SECONDS", "300"))
+
+# Salesforce REST client (persistent connections, per-call timeouts)
+SF_API_VERSION          = os.environ.get("SF_API_VERSION", "v61.0")
+SF_POOL_SIZE_PER_HOST   = int(os.environ.get("SF_POOL_SIZE_PER_HOST", "4"))
+SF_QUERY_TIMEOUT        = float(os.environ.get("SF_QUERY_TIMEOUT", "20"))
+SF_WRITE_TIMEOUT        = float(os.environ.get("SF_WRITE_TIMEOUT", "15"))
+SF_QUERY_BATCH_SIZE     = int(os.environ.get("SF_QUERY_BATCH_SIZE", "500"))  # Sforce-Query-Options hint
+
 DEBUG_ALLOW_IDENTIFIER_DOCURL = (os.environ.get("DEBUG_ALLOW_IDENTIFIER_DOCURL", "false").lower() == "true")
 SESSION_HMAC_SECRET = os.environ.get("SESSION_HMAC_SECRET", "")
 SESSION_TTL_SECONDS = int(os.environ.get("URL_TTL_SECONDS", "900"))  # default 15 min if unset
+# Identifier sessions carry their authorized journal Ids (resolved at verify-otp) up to this
+# many; journals outside the claim are re-resolved at most once per refresh interval
+SESSION_MAX_JOURNAL_CLAIMS      = int(os.environ.get("SESSION_MAX_JOURNAL_CLAIMS", "100"))
+SESSION_JOURNAL_REFRESH_SECONDS = int(os.environ.get("SESSION_JOURNAL_REFRESH_SECONDS", "60"))
 
 # AI Chatbot configuration
 AI_ENABLED = (os.environ.get("AI_ENABLED", "true").lower() == "true")
 DYNAMODB_TEXT_CACHE_TABLE = os.environ.get("DYNAMODB_TEXT_CACHE_TABLE", "dfj-pdf-text-cache")
 BEDROCK_MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "us.anthropic.claude-3-5-haiku-20241022-v1:0")
 BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "us-east-1")
+AI_PROMPT_CACHING = (os.environ.get("AI_PROMPT_CACHING", "true").lower() == "true")  # Bedrock prompt-cache breakpoints
+AI_ANSWER_CACHE_TTL_HOURS = int(os.environ.get("AI_ANSWER_CACHE_TTL_HOURS", "168"))  # 0 disables the answer cache
+AI_CACHE_HIT_FIELD = os.environ.get("AI_CACHE_HIT_FIELD", "")  # optional ChatMessage__c checkbox, e.g. AI_Cache_Hit__c
+AI_MAX_DOCUMENT_CHARS = int(os.environ.get("AI_MAX_DOCUMENT_CHARS", "15000"))  # document text sent to the model
+AI_MAX_DOCUMENT_TOKENS = int(os.environ.get("AI_MAX_DOCUMENT_TOKENS", "0"))      # optional token budget (~4 chars/token)
+AI_RETRIEVAL_TOP_K = int(os.environ.get("AI_RETRIEVAL_TOP_K", "12"))
+AI_RETRIEVAL_CHUNK_CHARS = int(os.environ.get("AI_RETRIEVAL_CHUNK_CHARS", "1200"))
+
+# Semantic retrieval: chunk embeddings, fused with BM25 ranks
+AI_EMBEDDER = os.environ.get("AI_EMBEDDER", "bedrock").lower()   # bedrock | hashing | off
+AI_EMBEDDING_MODEL_ID = os.environ.get("AI_EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v2:0")
+AI_EMBEDDING_DIMENSIONS = int(os.environ.get("AI_EMBEDDING_DIMENSIONS", "512"))
+AI_EMBEDDING_DTYPE = os.environ.get("AI_EMBEDDING_DTYPE", "int8").lower()  # int8 | float16
+
+# Write-behind for best-effort Salesforce updates (Last_Viewed, AI_Helpful, OTP__c audit)
+WRITE_BEHIND_MODE         = os.environ.get("WRITE_BEHIND_MODE", "inprocess").lower()  # inprocess | sqs | off
+WRITE_BEHIND_QUEUE_URL    = os.environ.get("WRITE_BEHIND_QUEUE_URL", "")
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+WRITE_BEHIND_DELAY_MS     = int(os.environ.get("WRITE_BEHIND_DELAY_MS", "200"))  # coalescing window
+WRITE_BEHIND_FLUSH_TIMEOUT_MS = int(os.environ.get("WRITE_BEHIND_FLUSH_TIMEOUT_MS", "3000"))  # drain before returning
+
+# Shared short-lived state (view coalescing, ...): DynamoDB table, or in-memory for local runs
+STATE_STORE_BACKEND = os.environ.get("STATE_STORE_BACKEND", "dynamodb").lower()  # dynamodb | memory
+STATE_STORE_TABLE   = os.environ.get("STATE_STORE_TABLE", "") or os.environ.get("DYNAMODB_TEXT_CACHE_TABLE", "dfj-pdf-text-cache")
+STATE_STORE_KEY     = os.environ.get("STATE_STORE_KEY", "s3_key")   # hash key attribute name
+VIEW_COALESCE_SECONDS = int(os.environ.get("VIEW_COALESCE_SECONDS", "600"))  # 0 = write every view
+
+# Identifier -> journal index (state store): entry lifetime, and the scheduled refresh
+IDENTIFIER_INDEX_TTL_SECONDS      = int(os.environ.get("IDENTIFIER_INDEX_TTL_SECONDS", "3600"))
+IDENTIFIER_INDEX_LOOKBACK_MINUTES = int(os.environ.get("IDENTIFIER_INDEX_LOOKBACK_MINUTES", "30"))  # first run / no cursor
+IDENTIFIER_INDEX_REFRESH_MAX      = int(os.environ.get("IDENTIFIER_INDEX_REFRESH_MAX", "500"))     # re-resolved per run
+# Spouse phones are matched exactly once backfill_identifiers.py has rewritten them to E.164;
+# until then ("true") the older +/00/bare spellings are matched as well
+PHONE_LEGACY_VARIANTS = (os.environ.get("PHONE_LEGACY_VARIANTS", "true").lower() == "true")
+
+# Identifier OTP state: "dynamodb" keeps codes/counters in the state store and writes OTP__c
+# asynchronously (audit + delivery); "salesforce" is the original OTP__c-only flow
+OTP_BACKEND          = os.environ.get("OTP_BACKEND", "dynamodb").lower()
+OTP_CODE_TTL_SECONDS = int(os.environ.get("OTP_CODE_TTL_SECONDS", "300"))
+OTP_MAX_ATTEMPTS     = int(os.environ.get("OTP_MAX_ATTEMPTS", "5"))
+OTP_STATE_TTL_SECONDS = int(os.environ.get("OTP_STATE_TTL_SECONDS", "86400"))  # resend counter window
+
+# OTP request rate limits (token buckets in the state store): burst size + refill per hour
+OTP_RATE_IDENTIFIER_BURST    = int(os.environ.get("OTP_RATE_IDENTIFIER_BURST", "5"))
+OTP_RATE_IDENTIFIER_PER_HOUR = float(os.environ.get("OTP_RATE_IDENTIFIER_PER_HOUR", "10"))
+OTP_RATE_IP_BURST            = int(os.environ.get("OTP_RATE_IP_BURST", "20"))
+OTP_RATE_IP_PER_HOUR         = float(os.environ.get("OTP_RATE_IP_PER_HOUR", "60"))
+
+# Document text cache tiers: in-process LRU -> /tmp -> DynamoDB
+TEXT_CACHE_MEMORY_BYTES = int(os.environ.get("TEXT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+TEXT_CACHE_DISK_DIR     = os.environ.get("TEXT_CACHE_DISK_DIR", "/tmp/dfj-text-cache")
+TEXT_CACHE_DISK_BYTES   = int(os.environ.get("TEXT_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+TEXT_CACHE_TTL_DAYS     = int(os.environ.get("TEXT_CACHE_TTL_DAYS", "30"))
+TEXT_CACHE_CHUNK_BYTES  = int(os.environ.get("TEXT_CACHE_CHUNK_BYTES", str(350 * 1024)))  # < 400 KB item limit
+
+# Parallel PDF extraction (worker processes, one PyMuPDF document each)
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "40"))
+PDF_PARALLEL_WORKERS   = int(os.environ.get("PDF_PARALLEL_WORKERS", "0") or 0) or (os.cpu_count() or 1)
+PDF_PARALLEL_TIMEOUT_SECONDS = float(os.environ.get("PDF_PARALLEL_TIMEOUT_SECONDS", "60"))  # then serial fallback
+
+# PDF ingestion: S3 body is streamed to /tmp instead of being held in memory
+PDF_SPOOL_DIR         = os.environ.get("PDF_SPOOL_DIR", "/tmp/dfj-pdf-spool")
+PDF_MAX_BYTES         = int(os.environ.get("PDF_MAX_BYTES", str(100 * 1024 * 1024)))
+PDF_SPOOL_CHUNK_BYTES = 1024 * 1024
 
 ALLOWED_ORIGINS = {
     "https://dfj.lightning.force.com",
@@ -75,6 +167,12 @@ def soql_in_list(values):
     # Build a comma-separated '...','...' list for SOQL IN (...)
     return ", ".join("'" + soql_escape(v) + "'" for v in (values or []) if v)
 
+_SF_ID_RE = re.compile(r'^[A-Za-z0-9]{15}(?:[A-Za-z0-9]{3})?$')
+
+def is_sf_id(value) -> bool:
+    # A malformed Id inside WHERE Id IN (...) fails the whole query, so filter first
+    return isinstance(value, str) and bool(_SF_ID_RE.match(value))
+
 
 # -------- OTP__c constants (hard-coded, no new envs) --------
 OTP_PURPOSE = "DocumentPortal"  # distinct from cancellation portal
@@ -107,28 +205,11 @@ def detect_brand(event, hinted=None) -> str:
     if "hereslaw.ie" in blob:          return "ie"
     return "dk"
 
-def _identifier_exists(instance_url, org_token, email: str = "", phone: str = "") -> bool:
+def _identifier_exists(email: str = "", phone: str = "") -> bool:
     try:
         if phone:
-            phone_norm = normalize_phone_basic(phone)
-            esc_vals = ["'" + v.replace("'", "\\'") + "'" for v in phone_variants_for_match(phone_norm)]
-            in_clause = ", ".join(esc_vals) if esc_vals else "''"
-            soql = (
-                "SELECT COUNT() FROM Shared_Document__c WHERE "
-                "(Journal__r.Account__r.Phone_Formatted__c = '" + phone_norm.replace("'", "\\'") + "' "
-                "OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-                "AND Journal__r.Account__r.Spouse_Phone__pc IN (" + in_clause + ")))"
-            )
-        else:
-            e = (email or "").lower().replace("'", "\\'")
-            soql = (
-                "SELECT COUNT() FROM Shared_Document__c WHERE "
-                "(Journal__r.Account__r.PersonEmail = '" + e + "' "
-                "OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-                "AND Journal__r.Account__r.Spouse_Email__pc = '" + e + "'))"
-            )
-        count = int(salesforce_query(instance_url, org_token, soql).get("totalSize", 0))
-        return count > 0
+            return bool(identifier_journal_ids("phone", phone))
+        return bool(identifier_journal_ids("email", email))
     except Exception:
         return False
 
@@ -166,9 +247,22 @@ def handle_diag_net(event):
     except Exception as e:
         return resp(event, 200, {"ok": False, "https_to_salesforce": False, "error": repr(e)})
 
+def handle_diag_cache(event):
+    return resp(event, 200, {"ok": True, "textCache": text_cache_stats(), "writeBehind": write_behind_stats()})
+
 # ===================== SALESFORCE AUTH =====================
 
-def get_org_token():
+# Process-wide org token. Survives warm invocations; refreshed in the background shortly
+# before SF_TOKEN_MAX_AGE_SECONDS and synchronously when missing/expired or after a 401.
+_org_token_lock = threading.Lock()
+_org_token_state = {
+    "access_token": None,
+    "instance_url": None,
+    "fetched_at": 0.0,       # time.time() when the token was obtained
+    "refreshing": False,     # background refresh in flight
+}
+
+def _fetch_org_token():
     data = urllib.parse.urlencode({
         "grant_type": "refresh_token",
         "client_id": SF_CLIENT_ID or "",
@@ -176,52 +270,809 @@ def get_org_token():
         "refresh_token": SF_REFRESH_TOKEN or "",
     }).encode("utf-8")
     url = f"{SF_LOGIN_URL}/services/oauth2/token"
-    req = urllib.request.Request(url, data=data, method="POST")
-    with urllib.request.urlopen(req, timeout=10) as r:
-        out = json.loads(r.read().decode("utf-8"))
-        if "access_token" not in out or "instance_url" not in out:
-            log("SF token success but missing fields:", out)
-            raise RuntimeError("Salesforce token response missing fields")
-        return out["access_token"], out["instance_url"]
+    out = get_sf_client().request_json(
+        "POST", url, body=data, timeout=10,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    if "access_token" not in out or "instance_url" not in out:
+        log("SF token success but missing fields:", out)
+        raise RuntimeError("Salesforce token response missing fields")
+    return out["access_token"], out["instance_url"]
+
+def _store_org_token(access_token, instance_url):
+    _org_token_state["access_token"] = access_token
+    _org_token_state["instance_url"] = instance_url
+    _org_token_state["fetched_at"]   = time.time()
+
+def _refresh_org_token_in_background():
+    def run():
+        try:
+            tok, inst = _fetch_org_token()
+            with _org_token_lock:
+                _store_org_token(tok, inst)
+            log("SF token refreshed in background")
+        except Exception as e:
+            log("SF background token refresh failed:", repr(e))
+        finally:
+            _org_token_state["refreshing"] = False
+    threading.Thread(target=run, name="sf-token-refresh", daemon=True).start()
+
+def org_token_age() -> float:
+    """Seconds since the cached org token was obtained (inf if there is none)."""
+    if not _org_token_state["access_token"]:
+        return float("inf")
+    return time.time() - _org_token_state["fetched_at"]
+
+def invalidate_org_token(stale_token=None):
+    """Drop the cached token (only if it is still `stale_token`, when given)."""
+    with _org_token_lock:
+        if stale_token is None or _org_token_state["access_token"] == stale_token:
+            _org_token_state["access_token"] = None
+            _org_token_state["instance_url"] = None
+            _org_token_state["fetched_at"]   = 0.0
+
+def get_org_token(force_refresh=False):
+    with _org_token_lock:
+        tok, inst = _org_token_state["access_token"], _org_token_state["instance_url"]
+        age = org_token_age()
+        if tok and not force_refresh and age < SF_TOKEN_MAX_AGE_SECONDS:
+            if age >= SF_TOKEN_MAX_AGE_SECONDS - SF_TOKEN_REFRESH_AHEAD_SECONDS and not _org_token_state["refreshing"]:
+                _org_token_state["refreshing"] = True
+                _refresh_org_token_in_background()
+            return tok, inst
+        # Synchronous refresh under the lock so concurrent callers share one grant.
+        tok, inst = _fetch_org_token()
+        _store_org_token(tok, inst)
+        return tok, inst
+
+def _with_org_token_retry(call, instance_url, org_token):
+    """
+    Run call(instance_url, org_token); on a 401 refresh the org token and retry exactly once.
+    If another caller already replaced the token we reuse theirs instead of re-granting.
+    """
+    try:
+        return call(instance_url, org_token)
+    except HTTPError as e:
+        if e.code != 401:
+            raise
+        log("SF 401 - refreshing org token and retrying once")
+        with _org_token_lock:
+            cached = _org_token_state["access_token"]
+        if cached and cached != org_token:
+            new_tok, new_inst = get_org_token()
+        else:
+            invalidate_org_token(org_token)
+            new_tok, new_inst = get_org_token(force_refresh=True)
+        return call(new_inst or instance_url, new_tok)
+
+# ===================== SF REST CLIENT =====================
+
+class SalesforceClient:
+    """
+    Small HTTPS client for the Salesforce REST API.
+
+    Keeps a pool of keep-alive connections per host at module level, so TLS handshakes are
+    paid once per warm container instead of once per call. Responses are negotiated with
+    gzip and decoded transparently. Errors are raised as urllib HTTPError so existing
+    `except HTTPError` handling (e.code / e.read()) keeps working.
+    """
+
+    # Exceptions meaning a pooled keep-alive connection was closed by the server.
+    _STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                     ConnectionResetError, BrokenPipeError)
+    # Safe to re-send after a failure once the request may have reached Salesforce.
+    _IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+    def __init__(self, pool_size=SF_POOL_SIZE_PER_HOST, default_timeout=SF_QUERY_TIMEOUT):
+        self.pool_size = int(pool_size)
+        self.default_timeout = float(default_timeout)
+        self._ssl_context = ssl.create_default_context()
+        self._pools = {}          # host -> [idle HTTPSConnection]
+        self._lock = threading.Lock()
+
+    def _acquire(self, host, timeout, fresh=False):
+        conn = None
+        if not fresh:
+            with self._lock:
+                idle = self._pools.setdefault(host, [])
+                conn = idle.pop() if idle else None
+        if conn is None:
+            return http.client.HTTPSConnection(host, timeout=timeout, context=self._ssl_context), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release(self, host, conn):
+        with self._lock:
+            idle = self._pools.setdefault(host, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Perform one request. Returns (status, headers, body_bytes); raises HTTPError on >= 400."""
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "https":
+            raise ValueError(f"SalesforceClient only supports https URLs: {url}")
+        host = parts.netloc
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        timeout = self.default_timeout if timeout is None else float(timeout)
+
+        hdrs = {"Accept": "application/json", "Accept-Encoding": "gzip"}
+        hdrs.update(headers or {})
+
+        for attempt in (1, 2):
+            conn, reused = self._acquire(host, timeout, fresh=attempt > 1)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=hdrs)
+                sent = True
+                r = conn.getresponse()
+                raw = r.read()
+            except self._STALE_ERRORS:
+                conn.close()
+                # A reused connection may have been idled out by Salesforce; retry once on a new
+                # connection (not another pooled one, which may be just as stale). A write is only
+                # re-sent if it never left this process, so it cannot be applied twice.
+                if reused and attempt == 1 and (method.upper() in self._IDEMPOTENT_METHODS or not sent):
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if r.will_close:
+                conn.close()
+            else:
+                self._release(host, conn)
+
+            if (r.getheader("Content-Encoding") or "").lower() == "gzip" and raw:
+                raw = gzip.decompress(raw)
+            if r.status >= 400:
+                raise HTTPError(url, r.status, r.reason, r.msg, io.BytesIO(raw))
+            return r.status, r.msg, raw
+
+    def request_json(self, method, url, payload=None, body=None, headers=None, timeout=None):
+        hdrs = dict(headers or {})
+        if payload is not None:
+            body = json.dumps(payload).encode("utf-8")
+            hdrs.setdefault("Content-Type", "application/json")
+        _, _, raw = self.request(method, url, body=body, headers=hdrs, timeout=timeout)
+        return json.loads(raw) if raw else None
+
+_sf_client = None
+_sf_client_lock = threading.Lock()
+
+def get_sf_client() -> SalesforceClient:
+    """Lazy-initialize the module-level Salesforce client (reused across warm invocations)."""
+    global _sf_client
+    if _sf_client is None:
+        with _sf_client_lock:
+            if _sf_client is None:
+                _sf_client = SalesforceClient()
+    return _sf_client
 
 # ===================== SF HELPERS =====================
 
-def salesforce_query(instance_url, org_token, soql):
-    url = f"{instance_url}/services/data/v61.0/query?q={urllib.parse.quote(soql)}"
-    req = urllib.request.Request(url, headers={"Authorization": f"Bearer {org_token}"})
+def _sf_url(instance_url, path):
+    return f"{instance_url}/services/data/{SF_API_VERSION}{path}"
+
+def _log_sf_http_error(e):
+    try:
+        error_body = e.read().decode("utf-8")
+        log("SALESFORCE_ERROR:", e.code, error_body)
+    except Exception:
+        log("SALESFORCE_ERROR:", e.code, "(no body)")
+
+def salesforce_query(instance_url, org_token, soql, timeout=SF_QUERY_TIMEOUT):
+    def call(inst, tok):
+        return get_sf_client().request_json(
+            "GET", _sf_url(inst, f"/query?q={urllib.parse.quote(soql)}"),
+            headers={"Authorization": f"Bearer {tok}"}, timeout=timeout,
+        )
     try:
-        with urllib.request.urlopen(req, timeout=20) as r:
-            return json.loads(r.read().decode("utf-8"))
+        return _with_org_token_retry(call, instance_url, org_token)
     except HTTPError as e:
         # NEW: Log Salesforce error response
-        try:
-            error_body = e.read().decode("utf-8")
-            log("SALESFORCE_ERROR:", e.code, error_body)
-        except Exception:
-            log("SALESFORCE_ERROR:", e.code, "(no body)")
+        _log_sf_http_error(e)
         raise
 
-def salesforce_patch(instance_url, org_token, sobject, rec_id, payload):
-    url = f"{instance_url}/services/data/v61.0/sobjects/{sobject}/{rec_id}"
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode("utf-8"),
-        method="PATCH",
-        headers={"Authorization": f"Bearer {org_token}", "Content-Type": "application/json"},
-    )
-    with urllib.request.urlopen(req, timeout=15):
+def salesforce_query_iter(instance_url, org_token, soql, batch_size=None, timeout=SF_QUERY_TIMEOUT):
+    """
+    Yield every record of a SOQL query, following nextRecordsUrl lazily (queryMore).
+    Only one page is held at a time and later pages are never fetched if the caller stops
+    iterating. batch_size is passed as the Sforce-Query-Options hint (Salesforce clamps to 200-2000).
+    """
+    headers = {}
+    if batch_size:
+        headers["Sforce-Query-Options"] = f"batchSize={max(200, min(2000, int(batch_size)))}"
+    path = f"/services/data/{SF_API_VERSION}/query?q={urllib.parse.quote(soql)}"
+    while path:
+        def call(inst, tok, path=path):
+            return get_sf_client().request_json(
+                "GET", f"{inst}{path}",
+                headers=dict(headers, Authorization=f"Bearer {tok}"), timeout=timeout,
+            )
+        try:
+            page = _with_org_token_retry(call, instance_url, org_token)
+        except HTTPError as e:
+            _log_sf_http_error(e)
+            raise
+        for rec in page.get("records", []):
+            yield rec
+        path = None if page.get("done", True) else page.get("nextRecordsUrl")
+
+def salesforce_patch(instance_url, org_token, sobject, rec_id, payload, timeout=SF_WRITE_TIMEOUT):
+    def call(inst, tok):
+        get_sf_client().request_json(
+            "PATCH", _sf_url(inst, f"/sobjects/{sobject}/{rec_id}"), payload=payload,
+            headers={"Authorization": f"Bearer {tok}"}, timeout=timeout,
+        )
         return True
+    return _with_org_token_retry(call, instance_url, org_token)
 
-def salesforce_insert(instance_url, org_token, sobject, payload):
-    url = f"{instance_url}/services/data/v61.0/sobjects/{sobject}"
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode("utf-8"),
-        method="POST",
-        headers={"Authorization": f"Bearer {org_token}", "Content-Type": "application/json"},
-    )
-    with urllib.request.urlopen(req, timeout=15) as r:
-        return json.loads(r.read().decode("utf-8"))["id"]
+def salesforce_insert(instance_url, org_token, sobject, payload, timeout=SF_WRITE_TIMEOUT):
+    def call(inst, tok):
+        return get_sf_client().request_json(
+            "POST", _sf_url(inst, f"/sobjects/{sobject}"), payload=payload,
+            headers={"Authorization": f"Bearer {tok}"}, timeout=timeout,
+        )["id"]
+    return _with_org_token_retry(call, instance_url, org_token)
+
+SF_COLLECTION_MAX_RECORDS = 200  # sObject Collections limit per request
+
+def salesforce_update_collection(instance_url, org_token, sobject, records, all_or_none=False, timeout=SF_WRITE_TIMEOUT):
+    """
+    Update many records with sObject Collections (PATCH /composite/sobjects), 200 per call.
+    `records` are dicts with "Id" plus the fields to set.
+    Returns the per-record results in input order: [{"id", "success", "errors"}, ...].
+    """
+    results = []
+    for i in range(0, len(records), SF_COLLECTION_MAX_RECORDS):
+        chunk = records[i:i + SF_COLLECTION_MAX_RECORDS]
+        payload = {
+            "allOrNone": bool(all_or_none),
+            "records": [
+                dict({k: v for k, v in rec.items() if k != "Id"}, attributes={"type": sobject}, id=rec["Id"])
+                for rec in chunk
+            ],
+        }
+        def call(inst, tok):
+            return get_sf_client().request_json(
+                "PATCH", _sf_url(inst, "/composite/sobjects"), payload=payload,
+                headers={"Authorization": f"Bearer {tok}"}, timeout=timeout,
+            )
+        try:
+            results.extend(_with_org_token_retry(call, instance_url, org_token) or [])
+        except HTTPError as e:
+            _log_sf_http_error(e)
+            raise
+    return results
+
+def salesforce_composite(instance_url, org_token, subrequests, all_or_none=False, timeout=SF_WRITE_TIMEOUT):
+    """
+    Several REST calls in one round trip (POST /composite, up to 25 subrequests).
+    `subrequests`: [{"method", "path" (relative to /services/data/vXX.X), "referenceId", "body"?}].
+    Returns {referenceId: {"status": int, "body": ...}}; raises HTTPError for the first
+    failed subrequest so callers see the same error type as the single-record helpers.
+    """
+    payload = {
+        "allOrNone": bool(all_or_none),
+        "compositeRequest": [
+            dict({"method": r["method"], "url": f"/services/data/{SF_API_VERSION}{r['path']}",
+                  "referenceId": r["referenceId"]}, **({"body": r["body"]} if "body" in r else {}))
+            for r in subrequests
+        ],
+    }
+    def call(inst, tok):
+        return get_sf_client().request_json(
+            "POST", _sf_url(inst, "/composite"), payload=payload,
+            headers={"Authorization": f"Bearer {tok}"}, timeout=timeout,
+        )
+    try:
+        res = _with_org_token_retry(call, instance_url, org_token)
+    except HTTPError as e:
+        _log_sf_http_error(e)
+        raise
+    out = {}
+    for sub in res.get("compositeResponse", []):
+        out[sub["referenceId"]] = {"status": sub.get("httpStatusCode"), "body": sub.get("body")}
+    for ref, sub in out.items():
+        if not (200 <= (sub["status"] or 0) < 300):
+            body = json.dumps(sub["body"]).encode("utf-8")
+            log("SALESFORCE_ERROR:", sub["status"], f"composite[{ref}]", body.decode("utf-8"))
+            raise HTTPError(_sf_url(instance_url, "/composite"), sub["status"] or 500,
+                            f"composite subrequest {ref} failed", None, io.BytesIO(body))
+    return out
+
+# ===================== WRITE-BEHIND (best-effort SF updates) =====================
+#
+# Updates the customer never sees (Last_Viewed__c/Status__c on open, OTP__c audit copies,
+# AI_Helpful__c) are queued instead of PATCHed on the request path. Writes to the same
+# record are coalesced (later fields win) and flushed with sObject Collections; failed
+# records are retried with backoff and dead-lettered after WRITE_BEHIND_MAX_ATTEMPTS.
+#
+#   inprocess  buffer + daemon flusher thread in this container (default; also the local
+#              stand-in for SQS). Lambda freezes the container once the handler returns,
+#              so lambda_handler drains the buffer (bounded by WRITE_BEHIND_FLUSH_TIMEOUT_MS)
+#              before returning; the writes still overlap the rest of the request.
+#   sqs        one message per write to WRITE_BEHIND_QUEUE_URL, drained by
+#              write_behind_sqs_handler; SQS redrive (maxReceiveCount -> DLQ) dead-letters.
+#   off        synchronous PATCH, failures logged (previous behaviour)
+#
+# Security counters (OTP Attempt_Count__c when OTP__c is the OTP state) never go through
+# here; they are written synchronously.
+
+def flush_sf_updates(updates: "OrderedDict") -> dict:
+    """
+    Apply coalesced updates {(sobject, id): fields} with sObject Collections.
+    Returns {(sobject, id): error} for the records that did not save.
+    """
+    failures = {}
+    if not updates:
+        return failures
+    try:
+        org_tok, inst = get_org_token()
+    except Exception as e:
+        return {key: repr(e) for key in updates}
+    by_sobject = OrderedDict()
+    for (sobject, rec_id), fields in updates.items():
+        by_sobject.setdefault(sobject, []).append(dict(fields, Id=rec_id))
+    for sobject, records in by_sobject.items():
+        try:
+            results = salesforce_update_collection(inst, org_tok, sobject, records)
+        except Exception as e:
+            failures.update({(sobject, r["Id"]): repr(e) for r in records})
+            continue
+        for rec, res in zip(records, results):
+            if not (res or {}).get("success"):
+                failures[(sobject, rec["Id"])] = json.dumps((res or {}).get("errors") or "no result")
+    return failures
+
+
+class _InProcessWriteBehind:
+    """Coalescing write buffer with a background flusher thread, retry and dead letters."""
+
+    def __init__(self, delay_ms=WRITE_BEHIND_DELAY_MS, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS, dead_letter_max=100):
+        self.delay = delay_ms / 1000.0
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flush_now = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._pending = OrderedDict()   # (sobject, id) -> {"fields", "attempts", "not_before"}
+        self._thread = None
+        self.dead_letters = []
+        self._dead_letter_max = dead_letter_max
+        self.stats = {"enqueued": 0, "coalesced": 0, "flushed": 0, "retried": 0, "dead_lettered": 0}
+
+    def enqueue(self, sobject: str, rec_id: str, fields: dict):
+        with self._lock:
+            self.stats["enqueued"] += 1
+            entry = self._pending.get((sobject, rec_id))
+            if entry:
+                self.stats["coalesced"] += 1
+                entry["fields"].update(fields)
+            else:
+                self._pending[(sobject, rec_id)] = {"fields": dict(fields), "attempts": 0, "not_before": 0.0}
+            self._idle.clear()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sf-write-behind", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _take_due(self):
+        now = time.time()
+        with self._lock:
+            due = OrderedDict((k, e) for k, e in self._pending.items() if e["not_before"] <= now)
+            for k in due:
+                del self._pending[k]
+            next_at = min((e["not_before"] for e in self._pending.values()), default=None)
+            return due, next_at
+
+    def _settle(self, due, failures):
+        with self._lock:
+            for key, entry in due.items():
+                if key not in failures:
+                    self.stats["flushed"] += 1
+                    continue
+                entry["attempts"] += 1
+                newer = self._pending.get(key)
+                if newer:
+                    # A newer write arrived during the flush: its fields win, the retry count carries over
+                    entry["fields"].update(newer["fields"])
+                if entry["attempts"] >= self.max_attempts:
+                    self.stats["dead_lettered"] += 1
+                    self._pending.pop(key, None)
+                    letter = {"sobject": key[0], "id": key[1], "fields": entry["fields"],
+                              "error": failures[key], "attempts": entry["attempts"]}
+                    self.dead_letters = (self.dead_letters + [letter])[-self._dead_letter_max:]
+                    log("WRITE_BEHIND_DEAD_LETTER", json.dumps(letter))
+                    continue
+                self.stats["retried"] += 1
+                entry["not_before"] = time.time() + min(30.0, 0.5 * (2 ** entry["attempts"]))
+                self._pending[key] = entry
+                log(f"WRITE_BEHIND_RETRY {key[0]} {key[1]} attempt {entry['attempts']}: {failures[key]}")
+            if not self._pending:
+                self._flush_now.clear()
+                self._idle.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._flush_now.wait(self.delay)  # let writes from the same burst coalesce, unless draining
+            while True:
+                due, next_at = self._take_due()
+                if due:
+                    updates = OrderedDict((k, e["fields"]) for k, e in due.items())
+                    self._settle(due, flush_sf_updates(updates))
+                    continue
+                if next_at is None:
+                    break
+                self._wake.wait(max(0.0, next_at - time.time()))
+                self._wake.clear()
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until everything queued so far is written or dead-lettered."""
+        with self._lock:
+            for entry in self._pending.values():
+                entry["not_before"] = 0.0
+            if self._idle.is_set():
+                return True
+            self._flush_now.set()
+        self._wake.set()
+        return self._idle.wait(timeout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, pending=len(self._pending), deadLetters=list(self.dead_letters[-10:]))
+
+
+_write_behind = _InProcessWriteBehind()
+_sqs_client = None
+
+def _get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        _sqs_client = boto3.client("sqs", region_name=AWS_REGION)
+    return _sqs_client
+
+def enqueue_sf_update(sobject: str, rec_id: str, fields: dict):
+    """
+    Queue a best-effort update that the response does not depend on. Never raises.
+    """
+    try:
+        if WRITE_BEHIND_MODE == "off":
+            org_tok, inst = get_org_token()
+            salesforce_patch(inst, org_tok, sobject, rec_id, fields)
+        elif WRITE_BEHIND_MODE == "sqs" and WRITE_BEHIND_QUEUE_URL:
+            try:
+                _get_sqs_client().send_message(
+                    QueueUrl=WRITE_BEHIND_QUEUE_URL,
+                    MessageBody=json.dumps({"sobject": sobject, "id": rec_id, "fields": fields}),
+                )
+            except Exception as e:
+                log(f"WRITE_BEHIND: SQS send failed, buffering in-process: {repr(e)}")
+                _write_behind.enqueue(sobject, rec_id, fields)
+        else:
+            _write_behind.enqueue(sobject, rec_id, fields)
+    except Exception as e:
+        log(f"WRITE_BEHIND: {sobject} {rec_id} update failed: {repr(e)}")
+
+_insert_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sf-insert")
+
+def _insert_and_link(sobject: str, fields: dict, link: dict = None) -> str:
+    """Insert a record and, if asked, write its Id back into a state-store record."""
+    org_tok, inst = get_org_token()
+    rec_id = salesforce_insert(inst, org_tok, sobject, fields)
+    if link:
+        try:
+            get_state_store().update(link["key"], link["ttl"], set_attrs={link["attr"]: rec_id},
+                                     expect=link.get("expect"))
+        except Exception as e:
+            log(f"WRITE_BEHIND: link-back of {sobject} {rec_id} failed: {repr(e)}")
+    return rec_id
+
+def enqueue_sf_insert(sobject: str, fields: dict, link: dict = None):
+    """
+    Create a record off the request path. With `link` = {"key", "attr", "ttl", "expect"?},
+    the new Id is stored on that state-store record once known.
+
+    sqs: queued durably (write_behind_sqs_handler inserts it); returns None.
+    otherwise: started on a worker thread; returns the Future. Lambda freezes the container
+    when the handler returns, so callers that need the row soon (OTP delivery) should
+    .result() it just before responding - the insert still overlaps the rest of the work.
+    """
+    if WRITE_BEHIND_MODE == "sqs" and WRITE_BEHIND_QUEUE_URL:
+        try:
+            _get_sqs_client().send_message(
+                QueueUrl=WRITE_BEHIND_QUEUE_URL,
+                MessageBody=json.dumps({"op": "insert", "sobject": sobject, "fields": fields, "link": link}),
+            )
+            return None
+        except Exception as e:
+            log(f"WRITE_BEHIND: SQS send failed, inserting in-process: {repr(e)}")
+    return _insert_pool.submit(_insert_and_link, sobject, fields, link)
+
+def drain_write_behind():
+    """Finish in-process write-behind before the handler returns and Lambda freezes us."""
+    if not _write_behind.flush(timeout=WRITE_BEHIND_FLUSH_TIMEOUT_MS / 1000.0):
+        log(f"WRITE_BEHIND: drain timed out, {_write_behind.snapshot()['pending']} record(s) still pending")
+
+def write_behind_stats() -> dict:
+    return dict(_write_behind.snapshot(), mode=WRITE_BEHIND_MODE)
+
+# ===================== SHARED TTL STATE STORE =====================
+#
+# Small key -> attributes records with an expiry, shared by every container. Writes are
+# conditional, so concurrent invocations agree on who "won" a transition.
+# DynamoDB in production (item TTL on the `ttl` attribute); MemoryStateStore is the
+# single-process stand-in for local runs and tests.
+
+class DynamoStateStore:
+    def __init__(self, table_name: str = None, key_attr: str = None):
+        self.table_name = table_name or STATE_STORE_TABLE
+        self.key_attr = key_attr or STATE_STORE_KEY
+        self._table = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = boto3.resource('dynamodb', region_name=AWS_REGION).Table(self.table_name)
+        return self._table
+
+    def get(self, key: str):
+        """Attributes of a live (unexpired) record, or None."""
+        item = self.table.get_item(Key={self.key_attr: key}, ConsistentRead=True).get("Item")
+        if not item or int(item.get("ttl") or 0) <= time.time():
+            return None
+        return item
+
+    def update(self, key: str, ttl_seconds: int, set_attrs: dict = None, add_attrs: dict = None,
+               expect: dict = None, expect_below: dict = None, expect_above: dict = None):
+        """
+        Atomically SET `set_attrs`, ADD `add_attrs` (counters; absent counts as 0) and
+        refresh the expiry, provided that:
+          expect        every attribute equals the given value; None means "absent"
+          expect_below  every attribute is < the given value (absent passes)
+          expect_above  every attribute is > the given value
+        An expired record counts as absent. Returns the new attributes, or None if the
+        condition failed (another writer got there first).
+        """
+        now = int(time.time())
+        names, values = {"#ttl": "ttl"}, {":ttl": now + int(ttl_seconds), ":now": now}
+        sets, adds, conds = ["#ttl = :ttl"], [], []
+        for i, (name, value) in enumerate((set_attrs or {}).items()):
+            names[f"#s{i}"], values[f":s{i}"] = name, value
+            sets.append(f"#s{i} = :s{i}")
+        for i, (name, value) in enumerate((add_attrs or {}).items()):
+            names[f"#d{i}"], values[f":d{i}"] = name, value
+            adds.append(f"#d{i} :d{i}")
+        live = "#ttl > :now"
+        for i, (name, value) in enumerate((expect or {}).items()):
+            names[f"#e{i}"] = name
+            if value is None:
+                conds.append(f"(attribute_not_exists(#e{i}) OR #ttl <= :now)")
+            else:
+                values[f":e{i}"] = value
+                conds.append(f"(#e{i} = :e{i} AND {live})")
+        for i, (name, value) in enumerate((expect_below or {}).items()):
+            names[f"#b{i}"], values[f":b{i}"] = name, value
+            conds.append(f"(attribute_not_exists(#b{i}) OR #ttl <= :now OR #b{i} < :b{i})")
+        for i, (name, value) in enumerate((expect_above or {}).items()):
+            names[f"#g{i}"], values[f":g{i}"] = name, value
+            conds.append(f"(#g{i} > :g{i} AND {live})")
+        req = {
+            "Key": {self.key_attr: key},
+            "UpdateExpression": "SET " + ", ".join(sets) + (" ADD " + ", ".join(adds) if adds else ""),
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+            "ReturnValues": "ALL_NEW",
+        }
+        if conds:
+            req["ConditionExpression"] = " AND ".join(conds)
+        else:
+            del values[":now"]
+        try:
+            return self.table.update_item(**req).get("Attributes") or {}
+        except Exception as e:
+            if _is_conditional_check_failure(e):
+                return None
+            raise
+
+    def put_if(self, key: str, attrs: dict, ttl_seconds: int, expect: dict = None) -> bool:
+        """SET `attrs` if `expect` holds (see update). False if another writer got there first."""
+        return self.update(key, ttl_seconds, set_attrs=attrs, expect=expect) is not None
+
+    def delete(self, key: str):
+        self.table.delete_item(Key={self.key_attr: key})
+
+
+class MemoryStateStore:
+    """In-process stand-in with the same semantics as DynamoStateStore."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def _live(self, key):
+        item = self._items.get(key)
+        if item and item["ttl"] <= time.time():
+            del self._items[key]
+            item = None
+        return item
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._live(key)
+            return dict(item) if item else None
+
+    def update(self, key: str, ttl_seconds: int, set_attrs: dict = None, add_attrs: dict = None,
+               expect: dict = None, expect_below: dict = None, expect_above: dict = None):
+        with self._lock:
+            item = self._live(key) or {}
+            for name, value in (expect or {}).items():
+                if item.get(name) != value:
+                    return None
+            for name, value in (expect_below or {}).items():
+                if name in item and not item[name] < value:
+                    return None
+            for name, value in (expect_above or {}).items():
+                if name not in item or not item[name] > value:
+                    return None
+            item = dict(item, **(set_attrs or {}))
+            for name, value in (add_attrs or {}).items():
+                item[name] = item.get(name, 0) + value
+            item["ttl"] = int(time.time()) + int(ttl_seconds)
+            self._items[key] = item
+            return dict(item)
+
+    def put_if(self, key: str, attrs: dict, ttl_seconds: int, expect: dict = None) -> bool:
+        return self.update(key, ttl_seconds, set_attrs=attrs, expect=expect) is not None
+
+    def delete(self, key: str):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+def _is_conditional_check_failure(e) -> bool:
+    code = (getattr(e, "response", None) or {}).get("Error", {}).get("Code")
+    return code == "ConditionalCheckFailedException"
+
+_state_store = None
+
+def get_state_store():
+    global _state_store
+    if _state_store is None:
+        _state_store = MemoryStateStore() if STATE_STORE_BACKEND == "memory" else DynamoStateStore()
+    return _state_store
+
+
+# ===================== VIEW COALESCING (Last_Viewed__c) =====================
+#
+# /doc-url is called again on every reopen/print/download. Last_Viewed__c is written at
+# most once per VIEW_COALESCE_SECONDS per document; the Sent -> Viewed transition is
+# claimed with a conditional write so exactly one request sends it. A document still
+# showing Sent well after a claim (lost write, or re-sent by staff) may be claimed again.
+# If the store is unavailable we fail open and write as before.
+
+_VIEW_STATUS_RECLAIM_SECONDS = 120
+
+def record_document_view(doc_id: str, status: str):
+    """Queue the Last_Viewed__c / Sent->Viewed update for an opened document, if due."""
+    now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    patch = {"Last_Viewed__c": now}
+    is_sent = (status or "").strip().lower() == "sent"
+    if is_sent:
+        patch["Status__c"] = "Viewed"
+    if VIEW_COALESCE_SECONDS <= 0:
+        enqueue_sf_update("Shared_Document__c", doc_id, patch)
+        return
+
+    key = f"view#{doc_id}"
+    window = VIEW_COALESCE_SECONDS
+    # Keep the marker well past the window so the status claim outlives Salesforce read lag
+    marker_ttl = max(window, 86400)
+    try:
+        store = get_state_store()
+        current = store.get(key) or {}
+        epoch = int(time.time())
+        if is_sent:
+            claimed = current.get("viewed_marked")
+            if claimed is None or epoch - int(claimed) > _VIEW_STATUS_RECLAIM_SECONDS:
+                if store.put_if(key, {"viewed_marked": epoch, "viewed_at": epoch}, marker_ttl,
+                                expect={"viewed_marked": claimed}):
+                    enqueue_sf_update("Shared_Document__c", doc_id, patch)
+                    return
+                current = store.get(key) or {}
+        last = int(current.get("viewed_at") or 0)
+        if last and epoch - last < window:
+            return  # written recently (by this or another container)
+        if store.put_if(key, {"viewed_at": epoch}, marker_ttl, expect={"viewed_at": current.get("viewed_at")}):
+            enqueue_sf_update("Shared_Document__c", doc_id, {"Last_Viewed__c": now})
+    except Exception as e:
+        log(f"VIEW_COALESCE: store unavailable, writing through: {repr(e)}")
+        enqueue_sf_update("Shared_Document__c", doc_id, patch)
+
+# ===================== RATE LIMITING =====================
+#
+# Token buckets kept in the shared state store, so the limit holds across containers.
+# Each take() is read -> refill -> conditional write on a version counter, retried on
+# conflict. Token counts are stored in milli-tokens and times in ms (DynamoDB has no
+# floats). If the store is unavailable we fail open: the limiter protects our API
+# allocation, it must not take the portal down with it.
+
+class TokenBucket:
+    def __init__(self, name: str, capacity: int, per_hour: float, store=None):
+        self.name = name
+        self.capacity = int(capacity)
+        self.per_ms = float(per_hour) / 3600000.0
+        self._store = store
+        # Idle buckets are full again after capacity / rate; no need to keep them longer
+        refill_seconds = (self.capacity / (self.per_ms * 1000.0)) if self.per_ms > 0 else 86400
+        self.ttl = int(min(refill_seconds, 86400)) + 60
+
+    @property
+    def store(self):
+        return self._store or get_state_store()
+
+    def take(self, subject: str, cost: int = 1, attempts: int = 4) -> bool:
+        """Spend `cost` tokens for `subject`; False when over the limit."""
+        if self.capacity <= 0:
+            return True
+        key = f"rate#{self.name}#{subject}"
+        full, need = self.capacity * 1000, int(cost) * 1000
+        try:
+            for _ in range(attempts):
+                current = self.store.get(key)
+                now_ms = int(time.time() * 1000)
+                if current:
+                    elapsed = max(0, now_ms - int(current.get("at") or now_ms))
+                    tokens = min(full, int(current.get("tokens") or 0) + int(elapsed * self.per_ms * 1000))
+                else:
+                    tokens = full
+                if tokens < need:
+                    return False
+                if self.store.update(key, self.ttl,
+                                     set_attrs={"tokens": tokens - need, "at": now_ms},
+                                     add_attrs={"ver": 1},
+                                     expect={"ver": current.get("ver") if current else None}) is not None:
+                    return True
+            log(f"RATE_LIMIT: {key} still contended after {attempts} attempts; rejecting")
+            return False
+        except Exception as e:
+            log(f"RATE_LIMIT: store unavailable, allowing: {repr(e)}")
+            return True
+
+_otp_ip_bucket = TokenBucket("otp-ip", OTP_RATE_IP_BURST, OTP_RATE_IP_PER_HOUR)
+_otp_identifier_bucket = TokenBucket("otp-id", OTP_RATE_IDENTIFIER_BURST, OTP_RATE_IDENTIFIER_PER_HOUR)
+
+def _source_ip(event) -> str:
+    return ((event.get("requestContext", {}).get("http", {}) or {}).get("sourceIp") or "").strip()
+
+def allow_otp_request(event, brand: str, identifier_type: str, identifier_value: str) -> bool:
+    """Per source IP and per identifier limits for /identifier/request-otp."""
+    ip = _source_ip(event)
+    if ip and not _otp_ip_bucket.take(ip):
+        log("RATE_LIMITED otp ip", ip)
+        return False
+    if not _otp_identifier_bucket.take(f"{brand}#{identifier_type}#{identifier_value}"):
+        log("RATE_LIMITED otp identifier", identifier_type, identifier_value, brand)
+        return False
+    return True
 
 # ===================== S3 PRESIGN =====================
 _s3 = boto3.client("s3", region_name=AWS_REGION)
@@ -260,21 +1111,16 @@ def s3_presign_get(bucket, key, expires=600):
 
 # ===================== BASIC NORMALIZATION =====================
 
-def normalize_phone_basic(raw: str) -> str:
-    if not raw:
-        return raw
-    s = raw.strip()
-    for ch in (" ", "-", "(", ")"):
-        s = s.replace(ch, "")
-    if s.startswith("00"):
-        s = "+" + s[2:]
-    if s.startswith("+"):
-        return s
-    if s.startswith("45") or s.startswith("46") or s.startswith("353"):
-        return "+" + s
-    return s
+def normalize_phone_basic(raw: str, brand: str = None) -> str:
+    """
+    Canonical E.164 form, the same one the Apex AccountPhoneNormalizer stores on Account
+    (see phone_normalize.py), so phone lookups are a single exact match. `brand` picks the
+    market whose country code applies to local numbers ("12 34 56 78" on the dk portal).
+    """
+    return normalize_phone(raw, market_for_brand(brand))
 
 def phone_variants_for_match(p: str):
+    """Spellings of an E.164 number stored before the backfill (see PHONE_LEGACY_VARIANTS)."""
     vals = set()
     if not p:
         return []
@@ -282,7 +1128,7 @@ def phone_variants_for_match(p: str):
     if p.startswith("+"):
         vals.add(p[1:])           # without +
         vals.add("00" + p[1:])    # 00-country
-    return [v for v in vals if v]
+    return sorted(v for v in vals if v)
 
 # ===================== DATETIME PARSING (ROBUST) =====================
 
@@ -363,17 +1209,23 @@ def _b64u_dec(s: str) -> bytes:
     s += "=" * (-len(s) % 4)
     return base64.urlsafe_b64decode(s.encode("ascii"))
 
-def make_session(identifier_type: str, identifier_value: str, ttl=SESSION_TTL_SECONDS) -> str:
+def make_session(identifier_type: str, identifier_value: str, ttl=SESSION_TTL_SECONDS, **claims) -> str:
+    """
+    Signed session token. Extra claims are embedded as given, e.g.
+      jids=[...]                  journal Ids an identifier session may access
+      role/allowApprove/jid/msid  impersonation sessions (scoped to one journal)
+    """
     if not SESSION_HMAC_SECRET:
         raise RuntimeError("Missing SESSION_HMAC_SECRET")
     now = int(time.time())
-    payload = {
+    payload = dict(claims)
+    payload.update({
         "iat": now,
         "exp": now + int(ttl),
-        "typ": identifier_type,   # "email" | "phone"
+        "typ": identifier_type,   # "email" | "phone" | "impersonation"
         "sub": identifier_value,  # normalized (email lower, phone normalized)
         "nonce": secrets.token_hex(8)
-    }
+    })
     body = _b64u(json.dumps(payload, separators=(",",":")).encode("utf-8"))
     sig  = _b64u(hmac.new(SESSION_HMAC_SECRET.encode("utf-8"), body.encode("ascii"), hashlib.sha256).digest())
     return body + "." + sig
@@ -449,6 +1301,15 @@ def handle_otp_verify(event, event_json):
 
 # ===================== Identifier helpers (find journals) =====================
 
+def _distinct_journal_ids(instance_url, org_token, soql: str):
+    # Plain rows paged with queryMore: an aggregate (GROUP BY) query cannot page, so it
+    # would need a LIMIT that silently truncates identifiers with many journals
+    out = {}
+    for r in salesforce_query_iter(instance_url, org_token, soql, batch_size=SF_QUERY_BATCH_SIZE):
+        jid = r.get("Journal__c")
+        if jid: out.setdefault(jid, None)
+    return list(out)
+
 def _find_journal_ids_by_email(instance_url, org_token, email: str):
     esc = email.replace("'", "\\'")
     soql = (
@@ -457,69 +1318,108 @@ def _find_journal_ids_by_email(instance_url, org_token, email: str):
         "WHERE Journal__r.Account__r.PersonEmail = '" + esc + "' "
         "   OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
         "       AND Journal__r.Account__r.Spouse_Email__pc = '" + esc + "') "
-        "GROUP BY Journal__c "
-        "LIMIT 200"
     )
-    recs = salesforce_query(instance_url, org_token, soql).get("records", [])
-    out = []
-    for r in recs:
-        jid = r.get("Journal__c") or r.get("Expr0") or r.get("expr0")
-        if jid: out.append(jid)
-    return out
+    return _distinct_journal_ids(instance_url, org_token, soql)
 
 def _find_journal_ids_by_phone(instance_url, org_token, phone_norm: str):
-    variants = phone_variants_for_match(phone_norm)
-    if phone_norm not in variants: variants.append(phone_norm)
-    in_clause = ", ".join("'" + v.replace("'", "\\'") + "'" for v in variants)
+    esc = phone_norm.replace("'", "\\'")
+    if PHONE_LEGACY_VARIANTS:
+        in_clause = ", ".join("'" + v.replace("'", "\\'") + "'" for v in phone_variants_for_match(phone_norm))
+        spouse_match = "Journal__r.Account__r.Spouse_Phone__pc IN (" + in_clause + ")"
+    else:
+        spouse_match = "Journal__r.Account__r.Spouse_Phone__pc = '" + esc + "'"
     soql = (
         "SELECT Journal__c "
         "FROM Shared_Document__c "
-        "WHERE Journal__r.Account__r.Phone_Formatted__c = '" + phone_norm.replace("'", "\\'") + "' "
+        "WHERE Journal__r.Account__r.Phone_Formatted__c = '" + esc + "' "
         "   OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-        "       AND Journal__r.Account__r.Spouse_Phone__pc IN (" + (in_clause or "''") + ")) "
-        "GROUP BY Journal__c "
-        "LIMIT 200"
+        "       AND " + spouse_match + ") "
     )
-    recs = salesforce_query(instance_url, org_token, soql).get("records", [])
-    out = []
-    for r in recs:
-        jid = r.get("Journal__c") or r.get("Expr0") or r.get("expr0")
-        if jid: out.append(jid)
-    return out
-
-# ===================== Identifier OTP (new) =====================
-
-def handle_identifier_request_otp(event, data):
-    raw_email = (data.get("email") or "").strip()
-    raw_phone = (data.get("phone") or "").strip()
-    has_email = bool(raw_email)
-    has_phone = bool(raw_phone)
-    if not (has_email ^ has_phone):
-        return resp(event, 400, {"error": "Provide exactly one of: email OR phone"})
-
+    return _distinct_journal_ids(instance_url, org_token, soql)
+
+# ===================== IDENTIFIER -> JOURNAL INDEX =====================
+#
+# The lookups above filter Shared_Document__c through Journal__r.Account__r email/phone
+# fields with an OR on the spouse fields - non-selective, so Salesforce scans as the object
+# grows. Their result is kept in the state store keyed by normalized identifier
+# (ident#email#<lower-cased email> / ident#phone#<E.164 phone>), so the hot path
+# only runs indexed `Journal__c IN (...)` queries. Entries are re-resolved on miss, when
+# older than the caller's max_age, and by identifier_index_refresh_handler for identifiers
+# whose account or documents changed. Callers that grant access bound the age: OTP verify
+# always re-resolves (max_age=0), the list/search endpoints and session re-checks accept
+# SESSION_JOURNAL_REFRESH_SECONDS, so a removed identifier loses access within that window
+# rather than IDENTIFIER_INDEX_TTL_SECONDS.
+
+def _normalize_identifier(typ: str, value: str) -> str:
+    # Phones arrive normalized (portal input, Account fields): keep those as they are,
+    # the Apex rules would drop another trunk 0 from "+450..."
+    if typ == "phone":
+        return canonical_phone((value or "").strip())
+    return (value or "").lower().strip()
+
+def _identifier_index_key(typ: str, value: str) -> str:
+    return f"ident#{typ}#{_normalize_identifier(typ, value)}"
+
+def _find_journal_ids(instance_url, org_token, typ: str, value: str):
+    value = _normalize_identifier(typ, value)
+    if not value:
+        return []
+    if typ == "email":
+        return _find_journal_ids_by_email(instance_url, org_token, value)
+    if typ == "phone":
+        return _find_journal_ids_by_phone(instance_url, org_token, value)
+    return []
+
+def refresh_identifier_index(typ: str, value: str) -> frozenset:
+    """Resolve an identifier's journals from Salesforce and store them in the index."""
+    org_token, instance_url = get_org_token()
+    ids = frozenset(_find_journal_ids(instance_url, org_token, typ, value))
     try:
-        org_token, instance_url = get_org_token()
+        get_state_store().put_if(_identifier_index_key(typ, value),
+                                 {"jids": sorted(ids), "refreshed_at": int(time.time())},
+                                 IDENTIFIER_INDEX_TTL_SECONDS)
+    except Exception as e:
+        log(f"IDENTIFIER_INDEX: store write failed: {repr(e)}")
+    return ids
 
-        # --- 1) existence check (no enumeration in response) ---
-        if has_email:
-            email = raw_email.lower()
-            if "@" not in email or "." not in email.split("@")[-1]:
-                return resp(event, 200, {"ok": True})  # soft success
-            exists = _identifier_exists(instance_url, org_token, email=email)
-        else:
-            phone = normalize_phone_basic(raw_phone)
-            if not any(ch.isdigit() for ch in phone):
-                return resp(event, 200, {"ok": True})
-            exists = _identifier_exists(instance_url, org_token, phone=phone)
+def identifier_journal_ids(typ: str, value: str, max_age: int = None) -> frozenset:
+    """
+    Journal Ids an email/phone may access (primary, or spouse when spouse sharing is
+    enabled), from the index; resolved from Salesforce on a miss or when the entry is older
+    than `max_age` seconds.
+    """
+    try:
+        entry = get_state_store().get(_identifier_index_key(typ, value))
+    except Exception as e:
+        log(f"IDENTIFIER_INDEX: store unavailable, resolving from Salesforce: {repr(e)}")
+        entry = None
+    if entry and (max_age is None or time.time() - int(entry.get("refreshed_at") or 0) < max_age):
+        return frozenset(entry.get("jids") or ())
+    return refresh_identifier_index(typ, value)
+
+def _journal_in_clauses(journal_ids):
+    """`Journal__c IN (...)` conditions, one per SOQL-sized chunk of Ids."""
+    ids = sorted(journal_ids)
+    return [f"Journal__c IN ({soql_in_list(ids[i:i + SF_COLLECTION_MAX_RECORDS])})"
+            for i in range(0, len(ids), SF_COLLECTION_MAX_RECORDS)]
 
-        # --- 2) build OTP__c (ALWAYS CREATE a row, even if no match) ---
-        brand = detect_brand(event)
+# ===================== Identifier OTP (new) =====================
+#
+# Two interchangeable backends behind issue()/verify():
+#   SalesforceOtpBackend  OTP__c is the state (COUNT + insert to issue; query + PATCH to verify)
+#   DynamoOtpBackend      one state-store item per (purpose, brand, identifier type, value):
+#                         ADD counters for resends/attempts, a conditional update for
+#                         verify-once, item TTL for expiry. OTP__c is still created (it drives
+#                         delivery and is the audit trail) but off the critical path, and
+#                         attempt/verification updates to it are write-behind.
+
+class SalesforceOtpBackend:
+    name = "salesforce"
+
+    def issue(self, brand, identifier_type, identifier_value, channel, code):
+        org_token, instance_url = get_org_token()
         now = datetime.datetime.utcnow()
-        expires = (now + datetime.timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%SZ")
-        code = f"{random.randint(0, 999999):06d}"
-        identifier_type  = "Email" if has_email else "Phone"
-        identifier_value = (raw_email.lower() if has_email else normalize_phone_basic(raw_phone))
-        channel = "Email" if has_email else "SMS"
+        expires = (now + datetime.timedelta(seconds=OTP_CODE_TTL_SECONDS)).strftime("%Y-%m-%dT%H:%M:%SZ")
 
         # count prior sends for Resend_Count__c
         try:
@@ -534,68 +1434,15 @@ def handle_identifier_request_otp(event, data):
         except Exception:
             prev_count = 0
 
-        unique_key = f"{OTP_PURPOSE}|{identifier_type}|{identifier_value}|{brand}|{secrets.token_hex(8)}"
-
-        fields = {
-            "Key__c": unique_key,
-            "Brand__c": brand,
-            "Purpose__c": OTP_PURPOSE,
-            "Resource_Type__c": "Shared_Document__c",
-            "Identifier_Type__c": identifier_type,
-            "Identifier_Value__c": identifier_value,
-            "Channel__c": channel,
-
-            "Code__c": code,
-            "Status__c": "Pending",
-            "Sent_At__c": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "Expires_At__c": expires,
-            "Attempt_Count__c": 0,
-            "Resend_Count__c": prev_count,
-        }
-
+        fields = _otp_record_fields(brand, identifier_type, identifier_value, channel, code, now, expires, prev_count)
         try:
             rec_id = salesforce_insert(instance_url, org_token, "OTP__c", fields)
-            log("OTP__c created", rec_id, identifier_type, identifier_value, brand, "exists:", exists)
+            log("OTP__c created", rec_id, identifier_type, identifier_value, brand)
         except Exception as e:
             log("OTP__c create error:", repr(e))
 
-        # Always soft-success (whether match exists or not)
-        return resp(event, 200, {"ok": True})
-
-    except Exception as e:
-        log("identifier_request_otp error:", repr(e))
-        # still soft-success to avoid leaking anything
-        return resp(event, 200, {"ok": True})
-
-def handle_identifier_verify_otp(event, data):
-    raw_email = (data.get("email") or "").strip()
-    raw_phone = (data.get("phone") or "").strip()
-    otp       = (data.get("otp")   or "").strip()
-    if not (otp.isdigit() and len(otp) == 6):
-        return resp(event, 200, {"ok": False})
-
-    has_email = bool(raw_email)
-    has_phone = bool(raw_phone)
-    if not (has_email ^ has_phone):
-        return resp(event, 200, {"ok": False})
-
-    try:
+    def verify(self, brand, identifier_type, identifier_value, otp) -> bool:
         org_token, instance_url = get_org_token()
-        brand = detect_brand(event)
-        if has_email:
-            identifier_type  = "Email"
-            identifier_value = raw_email.lower()
-        else:
-            identifier_type  = "Phone"
-            identifier_value = normalize_phone_basic(raw_phone)
-
-        # DEBUG input snapshot
-        log("VERIFY_DEBUG_IN", {
-            "brand": brand,
-            "type": identifier_type,
-            "value": identifier_value,
-            "otp": otp
-        })
 
         # Most recent pending OTP for this tuple
         soql = (
@@ -611,7 +1458,7 @@ def handle_identifier_verify_otp(event, data):
         )
         recs = salesforce_query(instance_url, org_token, soql).get("records", [])
         if not recs:
-            return resp(event, 200, {"ok": False})
+            return False
 
         row = recs[0]
         # DEBUG record snapshot
@@ -657,83 +1504,286 @@ def handle_identifier_verify_otp(event, data):
                 })
             except Exception:
                 pass
+            return True
 
-            # Issue the same session token your SPA already uses
-            token = make_session("email" if has_email else "phone", identifier_value, ttl=SESSION_TTL_SECONDS)
-            return resp(event, 200, {"ok": True, "session": token})
-
-        # failed attempt → increment attempts (best-effort)
+        # failed attempt → increment attempts; this is the lockout counter, so never write-behind
         try:
-            salesforce_patch(instance_url, org_token, "OTP__c", row["Id"], {
-                "Attempt_Count__c": attempts + 1
-            })
-        except Exception:
-            pass
-        return resp(event, 200, {"ok": False})
-
-    except Exception as e:
-        log("identifier_verify_otp error:", repr(e))
-        return resp(event, 200, {"ok": False})
+            salesforce_patch(instance_url, org_token, "OTP__c", row["Id"], {"Attempt_Count__c": attempts + 1})
+        except Exception as e:
+            log("OTP__c attempt count update failed:", repr(e))
+        return False
 
-# ===================== Client Impersonation Login =====================
 
-def handle_impersonation_login(event, data):
-    """
-    POST /impersonation/login
-    Body: { "token": "64-char-hex-token" }
-    Returns: { "ok": true, "session": "...", "journalId": "...", "journalName": "...", "allowApprove": true }
-    
-    SECURITY: Token can only be used once. After first use, it is immediately invalidated.
-    """
-    token = (data.get("token") or "").strip()
-    if not token:
-        return resp(event, 400, {"error": "Missing token"})
+class DynamoOtpBackend:
+    name = "dynamodb"
 
-    try:
-        org_tok, inst = get_org_token()
-        safe = soql_escape(token)
-        soql = (
-            "SELECT Id, Journal__c, Journal__r.Name, Allow_Approve__c, Expires_At__c, Used_At__c, Is_Revoked__c "
-            f"FROM Client_Impersonation__c WHERE Token__c = '{safe}' LIMIT 1"
-        )
-        recs = salesforce_query(inst, org_tok, soql).get("records", [])
-        if not recs:
-            return resp(event, 200, {"ok": False, "error": "Invalid or expired token"})
+    def __init__(self, store=None):
+        self._store = store
 
-        row = recs[0]
-        
-        # SECURITY: Check if token has been revoked
-        if row.get("Is_Revoked__c"):
-            log("impersonation_login: Token revoked:", row.get("Id"))
-            return resp(event, 200, {"ok": False, "error": "This link has been revoked"})
-        
-        # SECURITY: Check if token has already been used
-        if row.get("Used_At__c"):
-            log("impersonation_login: Token already used:", row.get("Id"))
-            return resp(event, 200, {"ok": False, "error": "This link has already been used"})
-        
-        # Check expiry (reuse robust parser)
-        exp_dt = _parse_sf_datetime(row.get("Expires_At__c") or "")
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        if not (exp_dt and now_utc <= exp_dt):
-            return resp(event, 200, {"ok": False, "error": "Token expired"})
+    @property
+    def store(self):
+        return self._store or get_state_store()
 
-        # Calculate TTL (min of link expiry and normal session TTL)
-        ttl = min(SESSION_TTL_SECONDS, int((exp_dt - now_utc).total_seconds()))
+    @staticmethod
+    def state_key(brand, identifier_type, identifier_value) -> str:
+        return f"otp#{OTP_PURPOSE}#{brand}#{identifier_type}#{identifier_value}"
 
-        # SECURITY: Mark token as used BEFORE creating session
-        # This ensures the token can't be reused even if session creation fails
-        source_ip = (event.get("requestContext", {}).get("http", {}) or {}).get("sourceIp")
-        try:
-            salesforce_patch(inst, org_tok, "Client_Impersonation__c", row["Id"], {
-                "Used_At__c": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "Used_By_IP__c": source_ip or ""
-            })
-        except Exception as e:
-            log("impersonation_login: Failed to mark token as used:", repr(e))
-            return resp(event, 500, {"error": "Failed to validate token"})
+    @staticmethod
+    def code_hash(state_key: str, nonce: str, code: str) -> str:
+        # Codes are not stored in clear; the nonce makes every issued code hash differently
+        secret = (SESSION_HMAC_SECRET or "otp").encode("utf-8")
+        return hmac.new(secret, f"{state_key}|{nonce}|{code}".encode("utf-8"), hashlib.sha256).hexdigest()
 
-        # Create session with impersonation claims (no identifier needed)
+    def issue(self, brand, identifier_type, identifier_value, channel, code):
+        key = self.state_key(brand, identifier_type, identifier_value)
+        now = datetime.datetime.utcnow()
+        expires_at = int(time.time()) + OTP_CODE_TTL_SECONDS
+        nonce = secrets.token_hex(8)
+        # New code replaces any pending one; resend counter is atomic across containers
+        item = self.store.update(key, OTP_STATE_TTL_SECONDS, set_attrs={
+            "status": "Pending",
+            "nonce": nonce,
+            "code_hash": self.code_hash(key, nonce, code),
+            "expires_at": expires_at,
+            "attempts": 0,
+            "sf_id": "",
+        }, add_attrs={"resends": 1})
+        prev_count = int(item.get("resends") or 1) - 1
+
+        expires = datetime.datetime.utcfromtimestamp(expires_at).strftime("%Y-%m-%dT%H:%M:%SZ")
+        fields = _otp_record_fields(brand, identifier_type, identifier_value, channel, code, now, expires, prev_count)
+        # Remember which OTP__c row belongs to this code, unless a newer code replaced it meanwhile
+        link = {"key": key, "attr": "sf_id", "ttl": OTP_STATE_TTL_SECONDS, "expect": {"nonce": nonce}}
+        return enqueue_sf_insert("OTP__c", fields, link=link)
+
+    def verify(self, brand, identifier_type, identifier_value, otp) -> bool:
+        key = self.state_key(brand, identifier_type, identifier_value)
+        state = self.store.get(key)
+        if not state or state.get("status") != "Pending":
+            return False
+        now = int(time.time())
+        expect = {"status": "Pending", "nonce": state.get("nonce"),
+                  "code_hash": self.code_hash(key, state.get("nonce") or "", otp)}
+        # Verify-once: only one request can move Pending -> Verified for this code
+        item = self.store.update(key, OTP_STATE_TTL_SECONDS,
+                                 set_attrs={"status": "Verified", "verified_at": now},
+                                 add_attrs={"attempts": 1},
+                                 expect=expect,
+                                 expect_below={"attempts": OTP_MAX_ATTEMPTS},
+                                 expect_above={"expires_at": now})
+        verified = item is not None
+        if not verified:
+            # Count the failed attempt against this code (no-op once it is no longer pending)
+            item = self.store.update(key, OTP_STATE_TTL_SECONDS, add_attrs={"attempts": 1},
+                                     expect={"status": "Pending", "nonce": state.get("nonce")})
+        item = item or state
+        log("VERIFY_DEBUG_MATCH", {"verified": verified, "attempts": int(item.get("attempts") or 0)})
+
+        sf_id = item.get("sf_id")
+        if sf_id:
+            audit = {"Attempt_Count__c": int(item.get("attempts") or 0)}
+            if verified:
+                audit.update({"Status__c": "Verified",
+                              "Verified_At__c": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")})
+            enqueue_sf_update("OTP__c", sf_id, audit)
+        else:
+            log("OTP audit: OTP__c row not linked yet; skipping audit update")
+        return verified
+
+
+def _otp_record_fields(brand, identifier_type, identifier_value, channel, code, now, expires, prev_count) -> dict:
+    unique_key = f"{OTP_PURPOSE}|{identifier_type}|{identifier_value}|{brand}|{secrets.token_hex(8)}"
+    return {
+        "Key__c": unique_key,
+        "Brand__c": brand,
+        "Purpose__c": OTP_PURPOSE,
+        "Resource_Type__c": "Shared_Document__c",
+        "Identifier_Type__c": identifier_type,
+        "Identifier_Value__c": identifier_value,
+        "Channel__c": channel,
+
+        "Code__c": code,
+        "Status__c": "Pending",
+        "Sent_At__c": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "Expires_At__c": expires,
+        "Attempt_Count__c": 0,
+        "Resend_Count__c": prev_count,
+    }
+
+_otp_backend = None
+
+def get_otp_backend():
+    global _otp_backend
+    if _otp_backend is None:
+        _otp_backend = DynamoOtpBackend() if OTP_BACKEND == "dynamodb" else SalesforceOtpBackend()
+    return _otp_backend
+
+
+def handle_identifier_request_otp(event, data):
+    raw_email = (data.get("email") or "").strip()
+    raw_phone = (data.get("phone") or "").strip()
+    has_email = bool(raw_email)
+    has_phone = bool(raw_phone)
+    if not (has_email ^ has_phone):
+        return resp(event, 400, {"error": "Provide exactly one of: email OR phone"})
+
+    try:
+        brand = detect_brand(event)
+        # --- 1) input sanity (no enumeration in response) ---
+        if has_email:
+            email = raw_email.lower()
+            if "@" not in email or "." not in email.split("@")[-1]:
+                return resp(event, 200, {"ok": True})  # soft success
+        else:
+            phone = normalize_phone_basic(raw_phone, brand)
+            if not any(ch.isdigit() for ch in phone):
+                return resp(event, 200, {"ok": True})
+
+        # --- 2) issue the OTP (ALWAYS, even if no match) ---
+        code = f"{random.randint(0, 999999):06d}"
+        identifier_type  = "Email" if has_email else "Phone"
+        identifier_value = (email if has_email else phone)
+        channel = "Email" if has_email else "SMS"
+
+        # Over the limit: same soft success, but no Salesforce calls at all
+        if not allow_otp_request(event, brand, identifier_type, identifier_value):
+            return resp(event, 200, {"ok": True})
+
+        pending_insert = get_otp_backend().issue(brand, identifier_type, identifier_value, channel, code)
+
+        # --- 3) existence check, logged only; overlaps the OTP__c insert ---
+        try:
+            if has_email:
+                exists = _identifier_exists(email=identifier_value)
+            else:
+                exists = _identifier_exists(phone=identifier_value)
+            log("OTP issued", identifier_type, identifier_value, brand, "exists:", exists)
+        except Exception as e:
+            log("identifier existence check error:", repr(e))
+
+        # OTP__c drives delivery: finish the in-process insert before Lambda freezes us
+        if pending_insert is not None:
+            try:
+                rec_id = pending_insert.result(timeout=SF_WRITE_TIMEOUT)
+                log("OTP__c created", rec_id)
+            except Exception as e:
+                log("OTP__c create error:", repr(e))
+
+        # Always soft-success (whether match exists or not)
+        return resp(event, 200, {"ok": True})
+
+    except Exception as e:
+        log("identifier_request_otp error:", repr(e))
+        # still soft-success to avoid leaking anything
+        return resp(event, 200, {"ok": True})
+
+def handle_identifier_verify_otp(event, data):
+    raw_email = (data.get("email") or "").strip()
+    raw_phone = (data.get("phone") or "").strip()
+    otp       = (data.get("otp")   or "").strip()
+    if not (otp.isdigit() and len(otp) == 6):
+        return resp(event, 200, {"ok": False})
+
+    has_email = bool(raw_email)
+    has_phone = bool(raw_phone)
+    if not (has_email ^ has_phone):
+        return resp(event, 200, {"ok": False})
+
+    try:
+        brand = detect_brand(event)
+        if has_email:
+            identifier_type  = "Email"
+            identifier_value = raw_email.lower()
+        else:
+            identifier_type  = "Phone"
+            identifier_value = normalize_phone_basic(raw_phone, brand)
+
+        # DEBUG input snapshot
+        log("VERIFY_DEBUG_IN", {
+            "brand": brand,
+            "type": identifier_type,
+            "value": identifier_value,
+            "otp": otp
+        })
+
+        if get_otp_backend().verify(brand, identifier_type, identifier_value, otp):
+            # Issue the same session token your SPA already uses, with the journals it may
+            # access resolved once here instead of on every document open/approval
+            typ = "email" if has_email else "phone"
+            claims = {}
+            try:
+                jids = identifier_journal_ids(typ, identifier_value, max_age=0)
+                if len(jids) <= SESSION_MAX_JOURNAL_CLAIMS:
+                    claims["jids"] = sorted(jids)
+            except Exception as e:
+                log("verify_otp: journal resolution failed, session without claim:", repr(e))
+            token = make_session(typ, identifier_value, ttl=SESSION_TTL_SECONDS, **claims)
+            return resp(event, 200, {"ok": True, "session": token})
+        return resp(event, 200, {"ok": False})
+
+    except Exception as e:
+        log("identifier_verify_otp error:", repr(e))
+        return resp(event, 200, {"ok": False})
+
+# ===================== Client Impersonation Login =====================
+
+def handle_impersonation_login(event, data):
+    """
+    POST /impersonation/login
+    Body: { "token": "64-char-hex-token" }
+    Returns: { "ok": true, "session": "...", "journalId": "...", "journalName": "...", "allowApprove": true }
+    
+    SECURITY: Token can only be used once. After first use, it is immediately invalidated.
+    """
+    token = (data.get("token") or "").strip()
+    if not token:
+        return resp(event, 400, {"error": "Missing token"})
+
+    try:
+        org_tok, inst = get_org_token()
+        safe = soql_escape(token)
+        soql = (
+            "SELECT Id, Journal__c, Journal__r.Name, Allow_Approve__c, Expires_At__c, Used_At__c, Is_Revoked__c "
+            f"FROM Client_Impersonation__c WHERE Token__c = '{safe}' LIMIT 1"
+        )
+        recs = salesforce_query(inst, org_tok, soql).get("records", [])
+        if not recs:
+            return resp(event, 200, {"ok": False, "error": "Invalid or expired token"})
+
+        row = recs[0]
+        
+        # SECURITY: Check if token has been revoked
+        if row.get("Is_Revoked__c"):
+            log("impersonation_login: Token revoked:", row.get("Id"))
+            return resp(event, 200, {"ok": False, "error": "This link has been revoked"})
+        
+        # SECURITY: Check if token has already been used
+        if row.get("Used_At__c"):
+            log("impersonation_login: Token already used:", row.get("Id"))
+            return resp(event, 200, {"ok": False, "error": "This link has already been used"})
+        
+        # Check expiry (reuse robust parser)
+        exp_dt = _parse_sf_datetime(row.get("Expires_At__c") or "")
+        now_utc = datetime.datetime.now(datetime.timezone.utc)
+        if not (exp_dt and now_utc <= exp_dt):
+            return resp(event, 200, {"ok": False, "error": "Token expired"})
+
+        # Calculate TTL (min of link expiry and normal session TTL)
+        ttl = min(SESSION_TTL_SECONDS, int((exp_dt - now_utc).total_seconds()))
+
+        # SECURITY: Mark token as used BEFORE creating session
+        # This ensures the token can't be reused even if session creation fails
+        source_ip = _source_ip(event)
+        try:
+            salesforce_patch(inst, org_tok, "Client_Impersonation__c", row["Id"], {
+                "Used_At__c": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "Used_By_IP__c": source_ip or ""
+            })
+        except Exception as e:
+            log("impersonation_login: Failed to mark token as used:", repr(e))
+            return resp(event, 500, {"error": "Failed to validate token"})
+
+        # Create session with impersonation claims (no identifier needed)
         sess = make_session(
             "impersonation", "N/A", ttl=ttl,  # Dummy identifier (unused)
             role="impersonation",
@@ -771,11 +1821,33 @@ def _require_identifier_session(event, provided_email: str, provided_phone: str)
             return (None, resp(event, 403, {"error": "Forbidden"}))
         return ({"typ":"email","sub":email}, None)
     else:
-        phone = normalize_phone_basic(provided_phone)
+        phone = normalize_phone_basic(provided_phone, detect_brand(event))
         if typ != "phone" or sub != phone:
             return (None, resp(event, 403, {"error": "Forbidden"}))
         return ({"typ":"phone","sub":phone}, None)
 
+def session_authorized_journals(sess: dict, journal_ids) -> set:
+    """
+    The subset of `journal_ids` this session may access. Impersonation sessions are scoped
+    to their jid; identifier sessions are checked against their jids claim, and anything
+    outside it (journal added mid-session, or no claim) is looked up in the identifier
+    index, re-resolved from Salesforce at most once per SESSION_JOURNAL_REFRESH_SECONDS.
+    """
+    wanted = {j for j in journal_ids if j}
+    if sess.get("jid"):
+        return {j for j in wanted if j[:15] == sess["jid"][:15]}
+    claimed = {j[:15] for j in sess.get("jids") or ()}
+    allowed = {j for j in wanted if j[:15] in claimed}
+    missing = wanted - allowed
+    if missing and sess.get("typ") in ("email", "phone"):
+        try:
+            current = {j[:15] for j in identifier_journal_ids(sess["typ"], sess.get("sub") or "",
+                                                             max_age=SESSION_JOURNAL_REFRESH_SECONDS)}
+            allowed |= {j for j in missing if j[:15] in current}
+        except Exception as e:
+            log("session journal re-resolution failed:", repr(e))
+    return allowed
+
 def handle_identifier_list(event, event_json):
     data = event_json or {}
     raw_email = (data.get("email") or "").strip()
@@ -811,56 +1883,40 @@ def handle_identifier_list(event, event_json):
         log("identifier_list oauth error:", repr(e))
         return resp(event, 500, {"error": "Salesforce OAuth failed"})
 
-    # Build base SOQL
-    # For impersonation mode with jid claim, we filter only by journal (no email/phone needed)
+    # Build base SOQL: documents of the session's journals, by indexed Journal__c
     if sess and sess.get("jid"):
         # Impersonation mode: filter only by journal ID
-        where_clause = f"WHERE Is_Newest_Version__c = true AND Journal__c = '{soql_escape(journal_id)}'"
-    elif has_email:
-        email = raw_email.lower()
-        esc = email.replace("'", "\\'")
-        where_clause = (
-            "WHERE Is_Newest_Version__c = true AND ("
-            "      Journal__r.Account__r.PersonEmail = '" + esc + "' "
-            "   OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-            "       AND Journal__r.Account__r.Spouse_Email__pc = '" + esc + "')"
-            ")"
-        )
-        # Add journal filter if provided
-        if journal_id:
-            where_clause += f" AND Journal__c = '{soql_escape(journal_id)}'"
+        journal_ids = {journal_id}
     else:
-        phone = normalize_phone_basic(raw_phone)
-        esc_vals = ["'" + v.replace("'", "\\'") + "'" for v in phone_variants_for_match(phone)]
-        in_clause = ", ".join(esc_vals) if esc_vals else "''"
-        where_clause = (
-            "WHERE Is_Newest_Version__c = true AND ("
-            "      Journal__r.Account__r.Phone_Formatted__c = '" + phone.replace("'", "\\'") + "' "
-            "   OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-            "       AND Journal__r.Account__r.Spouse_Phone__pc IN (" + in_clause + "))"
-            ")"
-        )
+        try:
+            journal_ids = set(identifier_journal_ids(sess["typ"], sess["sub"],
+                                                     max_age=SESSION_JOURNAL_REFRESH_SECONDS))
+        except Exception as e:
+            log("identifier_list journal lookup error:", repr(e))
+            return resp(event, 500, {"error": "Salesforce query failed"})
         # Add journal filter if provided
         if journal_id:
-            where_clause += f" AND Journal__c = '{soql_escape(journal_id)}'"
-    
+            journal_ids = {j for j in journal_ids if j[:15] == journal_id[:15]}
+    if not journal_ids:
+        return resp(event, 200, {"ok": True, "items": [], "journals": []})
+
     soql = (
         "SELECT Id, Name, Version__c, Status__c, S3_Key__c, Is_Newest_Version__c, "
         "       Document_Type__c, Market_Unit__c, Sent_Date__c, First_Viewed__c, Last_Viewed__c, "
         "       Journal__c, Journal__r.Name, Journal__r.First_Draft_Sent__c, Sort_Order__c, "
         "       Is_Approval_Blocked__c "
         "FROM Shared_Document__c "
-        + where_clause + " "
-        "ORDER BY Sort_Order__c NULLS LAST, Name "
-        "LIMIT 200"
+        "WHERE Is_Newest_Version__c = true AND {journals} "
+        "ORDER BY Sort_Order__c NULLS LAST, Name"
     )
 
     try:
-        res = salesforce_query(instance_url, org_token, soql)
-        rows = res.get("records", [])
-        
         # Group by journal with document types, first draft sent date, and approval status
         journals_map = {}
+        items = []
+        rows = (r for clause in _journal_in_clauses(journal_ids)
+                for r in salesforce_query_iter(instance_url, org_token, soql.format(journals=clause),
+                                               batch_size=SF_QUERY_BATCH_SIZE))
         for r in rows:
             j_id = r.get("Journal__c")
             j_name = (r.get("Journal__r") or {}).get("Name")
@@ -893,27 +1949,27 @@ def handle_identifier_list(event, event_json):
                 journals_map[j_id]["documentStatuses"][doc_type]["total"] += 1
                 if doc_status == "Approved":
                     journals_map[j_id]["documentStatuses"][doc_type]["approved"] += 1
+
+            items.append({
+                "id":               r.get("Id"),
+                "name":             r.get("Name"),
+                "version":          r.get("Version__c"),
+                "status":           r.get("Status__c"),
+                "s3Key":            r.get("S3_Key__c"),
+                "isNewestVersion":  r.get("Is_Newest_Version__c"),
+                "documentType":     r.get("Document_Type__c"),
+                "marketUnit":       r.get("Market_Unit__c"),
+                "sentDate":         r.get("Sent_Date__c"),
+                "firstViewed":      r.get("First_Viewed__c"),
+                "lastViewed":       r.get("Last_Viewed__c"),
+                "journalId":        r.get("Journal__c"),
+                "journalName":      (r.get("Journal__r") or {}).get("Name"),
+                "sortOrder":        r.get("Sort_Order__c"),
+                "isApprovalBlocked": r.get("Is_Approval_Blocked__c"),
+            })
         
         journals = list(journals_map.values())
         
-        items = [{
-            "id":               r.get("Id"),
-            "name":             r.get("Name"),
-            "version":          r.get("Version__c"),
-            "status":           r.get("Status__c"),
-            "s3Key":            r.get("S3_Key__c"),
-            "isNewestVersion":  r.get("Is_Newest_Version__c"),
-            "documentType":     r.get("Document_Type__c"),
-            "marketUnit":       r.get("Market_Unit__c"),
-            "sentDate":         r.get("Sent_Date__c"),
-            "firstViewed":      r.get("First_Viewed__c"),
-            "lastViewed":       r.get("Last_Viewed__c"),
-            "journalId":        r.get("Journal__c"),
-            "journalName":      (r.get("Journal__r") or {}).get("Name"),
-            "sortOrder":        r.get("Sort_Order__c"),
-            "isApprovalBlocked": r.get("Is_Approval_Blocked__c"),
-        } for r in rows]
-        
         return resp(event, 200, {"ok": True, "items": items, "journals": journals})
     except Exception as e:
         log("identifier_list query error:", repr(e))
@@ -946,78 +2002,27 @@ def handle_identifier_doc_url(event, event_json):
 
     try:
         safe_id = soql_escape(doc_id)
-        if sess and sess.get("typ") == "email":
-            soql = (
-                "SELECT Id, S3_Key__c, Journal__c, Journal__r.Account__r.PersonEmail, Journal__r.Account__r.Spouse_Email__pc, "
-                "       Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc, Status__c "
-                "FROM Shared_Document__c "
-                "WHERE Id = '" + safe_id + "' "
-                "LIMIT 1"
-            )
-        else:
-            soql = (
-                "SELECT Id, S3_Key__c, Journal__c, Journal__r.Account__r.Phone_Formatted__c, Journal__r.Account__r.Spouse_Phone__pc, "
-                "       Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc, Status__c "
-                "FROM Shared_Document__c "
-                "WHERE Id = '" + safe_id + "' "
-                "LIMIT 1"
-            )
+        soql = (
+            "SELECT Id, S3_Key__c, Journal__c, Status__c "
+            "FROM Shared_Document__c "
+            "WHERE Id = '" + safe_id + "' "
+            "LIMIT 1"
+        )
         recs = salesforce_query(instance_url, org_token, soql).get("records", [])
         if not recs:
             return resp(event, 404, {"error": "Not found"})
         doc = recs[0]
 
-        # IMPERSONATION: If session is journal-scoped, enforce it
-        if sess and sess.get("jid"):
-            if doc.get("Journal__c") != sess["jid"]:
-                return resp(event, 403, {"error": "Forbidden"})
-
-        # If we have a session, enforce ownership
-        if sess:
-            account = (doc.get("Journal__r") or {}).get("Account__r", {})
-            is_spouse_recipient = account.get("Is_Spouse_Shared_Document_Recipient__pc", False)
-            
-            if sess.get("typ") == "email":
-                email = (sess.get("sub") or "").lower().strip()
-                primary_email = (account.get("PersonEmail") or "").lower().strip()
-                spouse_email = (account.get("Spouse_Email__pc") or "").lower().strip()
-                
-                # Allow if primary email OR (spouse recipient enabled AND spouse email)
-                if email == primary_email:
-                    pass  # OK
-                elif is_spouse_recipient and email == spouse_email:
-                    pass  # OK
-                else:
-                    return resp(event, 403, {"error": "Forbidden"})
-                    
-            elif sess.get("typ") == "phone":
-                phone = normalize_phone_basic(sess.get("sub") or "")
-                p1 = normalize_phone_basic(account.get("Phone_Formatted__c") or "")
-                p2 = account.get("Spouse_Phone__pc") or ""
-                
-                # Allow if primary phone OR (spouse recipient enabled AND spouse phone)
-                if phone == p1:
-                    ok = True
-                elif is_spouse_recipient and p2:
-                    ok = phone in phone_variants_for_match(normalize_phone_basic(p2))
-                else:
-                    ok = False
-                    
-                if not ok:
-                    return resp(event, 403, {"error": "Forbidden"})
+        # If we have a session, enforce ownership (journal claim; impersonation: its jid)
+        if sess and not session_authorized_journals(sess, [doc.get("Journal__c")]):
+            return resp(event, 403, {"error": "Forbidden"})
 
         s3_key = doc.get("S3_Key__c")
         if not s3_key:
             return resp(event, 400, {"error": "Missing S3 key"})
 
-        # Patch Last_Viewed__c and Sent->Viewed (like journal doc-url)
-        patch = {"Last_Viewed__c": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
-        if (doc.get("Status__c") or "").strip().lower() == "sent":
-            patch["Status__c"] = "Viewed"
-        try:
-            salesforce_patch(instance_url, org_token, "Shared_Document__c", doc_id, patch)
-        except Exception:
-            pass
+        # Patch Last_Viewed__c and Sent->Viewed (like journal doc-url), coalesced and off the request path
+        record_document_view(doc_id, doc.get("Status__c"))
 
         url = s3_presign_get(DOCS_BUCKET, s3_key, expires=SESSION_TTL_SECONDS)
         return resp(event, 200, {"ok": True, "url": url})
@@ -1044,7 +2049,7 @@ def handle_doc_list(event, event_json):
         f"WHERE Journal__c = '{auth['id']}' "
         "ORDER BY Sort_Order__c NULLS LAST, Name"
     )
-    rows = salesforce_query(instance_url, org_token, soql).get("records", [])
+    rows = salesforce_query_iter(instance_url, org_token, soql, batch_size=SF_QUERY_BATCH_SIZE)
     items = [{
         "id":               r.get("Id"),
         "name":             r.get("Name"),
@@ -1091,13 +2096,7 @@ def handle_doc_url(event, event_json):
     if not s3_key:
         return resp(event, 400, {"error": "Missing S3 key"})
 
-    patch = {"Last_Viewed__c": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
-    if (doc.get("Status__c") or "").strip().lower() == "sent":
-        patch["Status__c"] = "Viewed"
-    try:
-        salesforce_patch(instance_url, org_token, "Shared_Document__c", doc_id, patch)
-    except Exception:
-        pass
+    record_document_view(doc_id, doc.get("Status__c"))
     try:
         url = s3_presign_get(DOCS_BUCKET, s3_key, expires=SESSION_TTL_SECONDS)
     except Exception as e:
@@ -1172,6 +2171,47 @@ def handle_upload_start(event, event_json):
 
 # ===================== APPROVE (journal + identifier) =====================
 
+def _fetch_docs_by_id(inst, org_tok, fields: str, doc_ids):
+    """
+    One SOQL per 200 Ids instead of one per document. Returns {Id: row}, keyed by both the
+    18- and 15-char form so callers can look up whatever Id shape the client sent.
+    """
+    ids = [d for d in dict.fromkeys(doc_ids) if is_sf_id(d)]
+    rows = {}
+    for i in range(0, len(ids), SF_COLLECTION_MAX_RECORDS):
+        chunk = ids[i:i + SF_COLLECTION_MAX_RECORDS]
+        soql = (
+            f"SELECT {fields} FROM Shared_Document__c "
+            f"WHERE Id IN ({soql_in_list(chunk)})"
+        )
+        for r in salesforce_query(inst, org_tok, soql).get("records", []):
+            rows[r["Id"]] = r
+            rows[r["Id"][:15]] = r
+    return rows
+
+def _approve_documents(inst, org_tok, doc_ids):
+    """
+    Set Status__c = Approved on all doc_ids with one sObject Collections call.
+    Returns {doc_id: success} for every requested id.
+    """
+    unique = list(dict.fromkeys(doc_ids))
+    if not unique:
+        return {}
+    try:
+        results = salesforce_update_collection(
+            inst, org_tok, "Shared_Document__c",
+            [{"Id": d, "Status__c": "Approved"} for d in unique],
+        )
+    except Exception as e:
+        log("approve collection update error:", repr(e))
+        return {d: False for d in unique}
+    out = {}
+    for doc_id, res in zip(unique, results):
+        out[doc_id] = bool(res.get("success"))
+        if not out[doc_id]:
+            log("approve failed for", doc_id, res.get("errors"))
+    return out
+
 def handle_doc_approve(event, data):
     ext  = (data.get("externalId")  or "").strip()
     tok  = (data.get("accessToken") or "").strip()
@@ -1182,24 +2222,25 @@ def handle_doc_approve(event, data):
     if not auth:
         return resp(event, 401, {"error": "Unauthorized"})
     org_tok, inst = get_org_token()
-    success, skipped = 0, 0
+    try:
+        rows = _fetch_docs_by_id(inst, org_tok, "Id, Journal__c, Is_Approval_Blocked__c", ids)
+    except Exception as e:
+        log("doc_approve query error:", repr(e))
+        rows = {}
+
+    to_approve = {}  # requested id -> canonical Id
     for doc_id in ids:
-        try:
-            q = ("SELECT Id, Journal__c, Is_Approval_Blocked__c FROM Shared_Document__c "
-                 f"WHERE Id = '{soql_escape(doc_id)}' LIMIT 1")
-            row = salesforce_query(inst, org_tok, q)["records"]
-            if not row or row[0].get("Journal__c") != auth["id"]:
-                skipped += 1
-                continue
-            # Check if approval is blocked
-            if row[0].get("Is_Approval_Blocked__c") == True:
-                skipped += 1
-                continue
-            salesforce_patch(inst, org_tok, "Shared_Document__c", doc_id, {"Status__c": "Approved"})
-            success += 1
-        except Exception:
-            skipped += 1
-    return resp(event, 200, {"ok": True, "approved": success, "skipped": skipped})
+        row = rows.get(doc_id)
+        if not row or row.get("Journal__c") != auth["id"]:
+            continue
+        # Check if approval is blocked
+        if row.get("Is_Approval_Blocked__c") == True:
+            continue
+        to_approve[doc_id] = row["Id"]
+
+    results = _approve_documents(inst, org_tok, list(to_approve.values()))
+    success = sum(1 for doc_id in ids if results.get(to_approve.get(doc_id)))
+    return resp(event, 200, {"ok": True, "approved": success, "skipped": len(ids) - success})
 
 def handle_identifier_approve(event, data):
     # Authorization: Bearer <session>
@@ -1223,220 +2264,1275 @@ def handle_identifier_approve(event, data):
 
     try:
         org_tok, inst = get_org_token()
-        approved, skipped = 0, 0
+        try:
+            rows = _fetch_docs_by_id(inst, org_tok, "Id, Journal__c, Is_Approval_Blocked__c", ids)
+        except Exception as e:
+            log("identifier_approve query error:", repr(e))
+            rows = {}
+        allowed = session_authorized_journals(sess, {r.get("Journal__c") for r in rows.values()})
+
+        to_approve = {}  # requested id -> canonical Id
         for doc_id in ids:
-            try:
-                safe_id = soql_escape(doc_id)
-                if sess.get("typ") == "email":
-                    soql = (
-                        "SELECT Id, Journal__c, Journal__r.Account__r.PersonEmail, Journal__r.Account__r.Spouse_Email__pc, "
-                        "       Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc, "
-                        "       Is_Approval_Blocked__c "
-                        "FROM Shared_Document__c "
-                        "WHERE Id = '" + safe_id + "' LIMIT 1"
-                    )
-                    recs = salesforce_query(inst, org_tok, soql).get("records", [])
-                    if not recs: 
-                        skipped += 1; continue
-                    row = recs[0]
-                    
-                    # IMPERSONATION: If session is journal-scoped, enforce it
-                    if sess.get("jid"):
-                        if row.get("Journal__c") != sess["jid"]:
-                            skipped += 1; continue
-                    
-                    # Check if approval is blocked
-                    if row.get("Is_Approval_Blocked__c") == True:
-                        skipped += 1; continue
-                    
-                    acc = (row.get("Journal__r") or {}).get("Account__r", {})
-                    email = (sess.get("sub") or "").lower().strip()
-                    pe = (acc.get("PersonEmail") or "").lower().strip()
-                    se = (acc.get("Spouse_Email__pc") or "").lower().strip()
-                    is_spouse_recipient = acc.get("Is_Spouse_Shared_Document_Recipient__pc", False)
-                    
-                    # Allow if primary email OR (spouse recipient enabled AND spouse email)
-                    if email == pe:
-                        pass  # OK
-                    elif is_spouse_recipient and email == se:
-                        pass  # OK
-                    else:
-                        skipped += 1; continue
-                        
-                else:
-                    soql = (
-                        "SELECT Id, Journal__c, Journal__r.Account__r.Phone_Formatted__c, Journal__r.Account__r.Spouse_Phone__pc, "
-                        "       Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc, "
-                        "       Is_Approval_Blocked__c "
-                        "FROM Shared_Document__c "
-                        "WHERE Id = '" + safe_id + "' LIMIT 1"
-                    )
-                    recs = salesforce_query(inst, org_tok, soql).get("records", [])
-                    if not recs: 
-                        skipped += 1; continue
-                    row = recs[0]
-                    
-                    # IMPERSONATION: If session is journal-scoped, enforce it
-                    if sess.get("jid"):
-                        if row.get("Journal__c") != sess["jid"]:
-                            skipped += 1; continue
-                    
-                    # Check if approval is blocked
-                    if row.get("Is_Approval_Blocked__c") == True:
-                        skipped += 1; continue
-                    
-                    acc = (row.get("Journal__r") or {}).get("Account__r", {})
-                    phone = normalize_phone_basic(sess.get("sub") or "")
-                    p1    = normalize_phone_basic(acc.get("Phone_Formatted__c") or "")
-                    p2raw = acc.get("Spouse_Phone__pc") or ""
-                    is_spouse_recipient = acc.get("Is_Spouse_Shared_Document_Recipient__pc", False)
-                    
-                    # Allow if primary phone OR (spouse recipient enabled AND spouse phone)
-                    if phone == p1:
-                        ok = True
-                    elif is_spouse_recipient and p2raw:
-                        ok = phone in phone_variants_for_match(normalize_phone_basic(p2raw))
-                    else:
-                        ok = False
-                        
-                    if not ok:
-                        skipped += 1; continue
-
-                salesforce_patch(inst, org_tok, "Shared_Document__c", doc_id, {"Status__c": "Approved"})
-                approved += 1
-            except Exception:
-                skipped += 1
-        return resp(event, 200, {"ok": True, "approved": approved, "skipped": skipped})
+            row = rows.get(doc_id)
+            if not row:
+                continue
+            # Ownership (journal claim; impersonation: its jid)
+            if row.get("Journal__c") not in allowed:
+                continue
+            # Check if approval is blocked
+            if row.get("Is_Approval_Blocked__c") == True:
+                continue
+            to_approve[doc_id] = row["Id"]
+
+        results = _approve_documents(inst, org_tok, list(to_approve.values()))
+        approved = sum(1 for doc_id in ids if results.get(to_approve.get(doc_id)))
+        return resp(event, 200, {"ok": True, "approved": approved, "skipped": len(ids) - approved})
     except Exception as e:
         log("identifier_approve error:", repr(e))
         return resp(event, 500, {"error": "Server error"})
 
 # ===================== AI CHATBOT HELPERS =====================
 
-def extract_pdf_text(bucket: str, key: str) -> dict:
+class PdfTooLargeError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def spool_pdf(bucket: str, key: str):
     """
-    Extract text from PDF using PyMuPDF (fitz).
+    Stream a PDF from S3 to a temp file under PDF_SPOOL_DIR, fingerprinting it on the way,
+    and remove the file when the block exits. Peak memory is one chunk, not the document.
+    Raises PdfTooLargeError above PDF_MAX_BYTES.
     
-    Returns:
+    Yields:
         {
-            'text': str,
-            'page_count': int,
-            'file_size': int
+            'path': str,
+            'file_size': int,
+            'etag': str,      # S3 ETag, unquoted
+            'sha256': str     # hex digest of the content
         }
     """
+    obj = _s3.get_object(Bucket=bucket, Key=key)
+    body = obj['Body']
+    declared = int(obj.get('ContentLength') or 0)
+    if declared > PDF_MAX_BYTES:
+        body.close()
+        raise PdfTooLargeError(f"{key} is {declared} bytes (limit {PDF_MAX_BYTES})")
+
+    os.makedirs(PDF_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=PDF_SPOOL_DIR)
     try:
-        import fitz  # PyMuPDF
-        
-        log(f"AI: Extracting text from s3://{bucket}/{key}")
-        
-        # Download PDF from S3
-        obj = _s3.get_object(Bucket=bucket, Key=key)
-        pdf_bytes = obj['Body'].read()
-        file_size = len(pdf_bytes)
-        
-        log(f"AI: Downloaded {file_size} bytes")
-        
-        # Open PDF with PyMuPDF
-        doc = fitz.open(stream=pdf_bytes, filetype='pdf')
-        
-        # Extract text from all pages
-        text_parts = []
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            page_text = page.get_text()
-            if page_text.strip():
-                text_parts.append(f"--- Page {page_num + 1} ---\n{page_text}")
-        
-        full_text = '\n\n'.join(text_parts)
-        page_count = len(doc)
-        doc.close()
-        
-        log(f"AI: Extracted {len(full_text)} characters from {page_count} pages")
-        
-        return {
-            'text': full_text,
-            'page_count': page_count,
-            'file_size': file_size
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = body.read(PDF_SPOOL_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > PDF_MAX_BYTES:
+                        raise PdfTooLargeError(f"{key} exceeds {PDF_MAX_BYTES} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+        finally:
+            body.close()   # also when the size limit or a read error stops the download
+        log(f"AI: Spooled {size} bytes from s3://{bucket}/{key}")
+        yield {
+            'path': path,
+            'file_size': size,
+            'etag': (obj.get('ETag') or '').strip('"'),
+            'sha256': digest.hexdigest(),
         }
-        
-    except ImportError:
-        log("AI ERROR: PyMuPDF (fitz) not available. Check Lambda layer is attached.")
-        raise Exception("PyMuPDF not available")
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _format_pages(page_texts) -> str:
+    # Same layout as always: "--- Page N ---" header per non-empty page, blank line between
+    return '\n\n'.join(
+        f"--- Page {page_num + 1} ---\n{page_text}"
+        for page_num, page_text in enumerate(page_texts)
+        if page_text.strip()
+    )
+
+
+def _extract_page_range_worker(pdf_path, page_numbers, conn):
+    """Worker process: open its own PyMuPDF document and send back [(page_num, text)]."""
+    try:
+        import fitz  # PyMuPDF
+        doc = fitz.open(pdf_path, filetype='pdf')
+        try:
+            out = [(n, doc[n].get_text()) for n in page_numbers]
+        finally:
+            doc.close()
+        conn.send(("ok", out))
     except Exception as e:
-        log(f"AI ERROR: PDF extraction failed: {repr(e)}")
-        raise
+        conn.send(("error", repr(e)))
+    finally:
+        conn.close()
+
+
+_pdf_worker_context = None
+_pdf_worker_context_lock = threading.Lock()
+
+def _get_pdf_worker_context():
+    """
+    forkserver multiprocessing context for the page workers. Forking this process directly is
+    unsafe: by now it runs other threads (write-behind flusher, I/O pools, botocore) whose
+    locks a forked child could inherit mid-acquire and deadlock on. The fork server is
+    started once from a clean single-threaded interpreter with PyMuPDF and this module
+    preloaded, so each worker is still a cheap fork.
+    """
+    global _pdf_worker_context
+    with _pdf_worker_context_lock:
+        if _pdf_worker_context is None:
+            import multiprocessing
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["fitz", _extract_page_range_worker.__module__])
+            _pdf_worker_context = ctx
+        return _pdf_worker_context
+
+
+def _extract_pages_parallel(pdf_path: str, page_numbers, workers: int) -> dict:
+    """
+    Split the pages into contiguous runs across `workers` processes and return {page_num: text}.
+    Uses Process + Pipe rather than ProcessPoolExecutor because Lambda has no /dev/shm,
+    which multiprocessing queues (and therefore pools) require.
+    Raises TimeoutError when the workers take longer than PDF_PARALLEL_TIMEOUT_SECONDS in
+    total; workers still running then are killed.
+    """
+    ctx = _get_pdf_worker_context()
+    deadline = time.time() + PDF_PARALLEL_TIMEOUT_SECONDS
+    page_numbers = list(page_numbers)
+    step = -(-len(page_numbers) // workers)
+    procs = []
+    try:
+        for start in range(0, len(page_numbers), step):
+            reader, writer = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_extract_page_range_worker,
+                            args=(pdf_path, page_numbers[start:start + step], writer), daemon=True)
+            p.start()
+            writer.close()
+            procs.append((p, reader))
+
+        pages = {}
+        for _, reader in procs:
+            # read before join so large results cannot block the pipe
+            if not reader.poll(max(0.0, deadline - time.time())):
+                raise TimeoutError(f"page workers did not finish within {PDF_PARALLEL_TIMEOUT_SECONDS}s")
+            status, payload = reader.recv()
+            if status != "ok":
+                raise RuntimeError(f"page worker failed: {payload}")
+            pages.update(payload)
+        return pages
+    finally:
+        for p, reader in procs:
+            reader.close()
+            p.join(timeout=max(0.0, min(5.0, deadline - time.time())))
+            if p.is_alive():
+                p.kill()
+                p.join(timeout=1)
+
+
+class _MemoryLRU:
+    """Byte-bounded in-process LRU. Lives as long as the warm container."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self.used_bytes = 0
+        self._items = OrderedDict()   # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                return None
+            self._items.move_to_end(key)
+            return hit[0]
+
+    def put(self, key, value, size: int = None):
+        size = int(size if size is not None else sys.getsizeof(value))
+        if size > self.max_bytes:
+            return  # never evict everything for one oversized entry
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+            self._items[key] = (value, size)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes and self._items:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.used_bytes -= evicted
+
+    def pop(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+
+
+class _DiskLRU:
+    """
+    Byte-bounded spill tier under /tmp. Files are named by a hash of the key, recency is the
+    file mtime (touched on read), and the oldest files are evicted once the quota is exceeded.
+    /tmp survives between warm invocations of the same container.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._evict()
+        except OSError as e:
+            log("AI: disk cache write failed:", repr(e))
+
+    def pop(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries, total = [], 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+            if total <= self.max_bytes:
+                break
+
+
+_text_memory_cache = _MemoryLRU(TEXT_CACHE_MEMORY_BYTES)
+_text_disk_cache = _DiskLRU(TEXT_CACHE_DISK_DIR, TEXT_CACHE_DISK_BYTES)
+_text_cache_stats = {tier: {"hits": 0, "misses": 0} for tier in ("memory", "disk", "dynamodb")}
+
+def _count_cache(tier: str, hit: bool):
+    _text_cache_stats[tier]["hits" if hit else "misses"] += 1
+
+def text_cache_stats() -> dict:
+    """Per-tier hit/miss counters for this container plus current tier sizes."""
+    out = {tier: dict(c) for tier, c in _text_cache_stats.items()}
+    out["memory"]["bytes"] = _text_memory_cache.used_bytes
+    return out
+
+# ---------- DynamoDB blob storage (compressed, chunked) ----------
+#
+# Values are stored zlib-compressed as Binary. If the compressed value still exceeds
+# TEXT_CACHE_CHUNK_BYTES it is split into "<key>#chunk#NNNN" items and the "<key>" row
+# becomes a manifest (chunks = N). The table keeps its single `s3_key` hash key, so the
+# composite key is encoded in the key string. Chunks are written before the manifest, so
+# a reader never sees a manifest whose chunks are missing.
+
+_DDB_BATCH_GET_KEYS = 40   # 40 x 350 KB stays under BatchGetItem's 16 MB response cap
+
+def _ddb_ttl(days: int = None) -> int:
+    return int(time.time()) + int(days if days is not None else TEXT_CACHE_TTL_DAYS) * 86400
+
+def _ddb_bytes(value) -> bytes:
+    # boto3 returns Binary wrappers for B attributes
+    return bytes(getattr(value, "value", value))
+
+def _ddb_chunk_key(key: str, i: int) -> str:
+    return f"{key}#chunk#{i:04d}"
+
+def ddb_put_blob(key: str, data: bytes, attrs: dict = None, ttl: int = None):
+    table = _get_text_cache_table()
+    ttl = ttl or _ddb_ttl()
+    comp = zlib.compress(data, 6)
+    item = dict(attrs or {})
+    item.update({"s3_key": key, "enc": "zlib", "raw_size": len(data), "ttl": ttl})
+    if len(comp) <= TEXT_CACHE_CHUNK_BYTES:
+        item.update({"chunks": 0, "body": comp})
+        table.put_item(Item=item)
+        return
+    pieces = [comp[i:i + TEXT_CACHE_CHUNK_BYTES] for i in range(0, len(comp), TEXT_CACHE_CHUNK_BYTES)]
+    with table.batch_writer() as batch:
+        for i, piece in enumerate(pieces):
+            batch.put_item(Item={"s3_key": _ddb_chunk_key(key, i), "body": piece, "ttl": ttl})
+    item.update({"chunks": len(pieces), "comp_size": len(comp)})
+    table.put_item(Item=item)
+
+def ddb_put_blobs(values: dict, ttl: int = None):
+    """Write many small blobs ({key: bytes}) through one batch writer; large ones fall back to ddb_put_blob."""
+    table = _get_text_cache_table()
+    ttl = ttl or _ddb_ttl()
+    with table.batch_writer() as batch:
+        for key, data in values.items():
+            comp = zlib.compress(data, 6)
+            if len(comp) > TEXT_CACHE_CHUNK_BYTES:
+                ddb_put_blob(key, data, ttl=ttl)
+                continue
+            batch.put_item(Item={"s3_key": key, "enc": "zlib", "raw_size": len(data),
+                                 "ttl": ttl, "chunks": 0, "body": comp})
+
+def _ddb_batch_get_items(keys, projection: str = None) -> dict:
+    """BatchGetItem for up to 100 keys, retrying UnprocessedKeys. Returns {key: item}."""
+    out = {}
+    req = {"Keys": [{"s3_key": k} for k in keys]}
+    if projection:
+        req["ProjectionExpression"] = projection
+    request = {DYNAMODB_TEXT_CACHE_TABLE: req}
+    for attempt in range(5):
+        res = _dynamodb.batch_get_item(RequestItems=request)
+        for row in res.get("Responses", {}).get(DYNAMODB_TEXT_CACHE_TABLE, []):
+            out[row["s3_key"]] = row
+        request = res.get("UnprocessedKeys") or {}
+        if not request:
+            break
+        time.sleep(0.05 * (2 ** attempt))
+    return out
+
+def _ddb_batch_get_bodies(keys) -> dict:
+    """Chunk bodies for one group of chunk keys. Returns {key: bytes}."""
+    return {k: _ddb_bytes(row["body"]) for k, row in _ddb_batch_get_items(keys, "s3_key, body").items()}
+
+def _ddb_decode_item(key: str, item: dict):
+    """Turn a stored blob row back into bytes, fetching chunks if it is a manifest. None if incomplete."""
+    n = int(item.get("chunks") or 0)
+    if n == 0:
+        return zlib.decompress(_ddb_bytes(item["body"]))
+    chunk_keys = [_ddb_chunk_key(key, i) for i in range(n)]
+    groups = [chunk_keys[i:i + _DDB_BATCH_GET_KEYS] for i in range(0, n, _DDB_BATCH_GET_KEYS)]
+    bodies = {}
+    with ThreadPoolExecutor(max_workers=min(4, len(groups))) as pool:
+        for part in pool.map(_ddb_batch_get_bodies, groups):
+            bodies.update(part)
+    if len(bodies) != n:
+        log(f"AI: blob {key} is missing {n - len(bodies)} of {n} chunks; treating as cache miss")
+        return None
+    return zlib.decompress(b"".join(bodies[k] for k in chunk_keys))
+
+def ddb_get_blob(key: str):
+    """
+    Read a value written by ddb_put_blob. Returns (data: bytes, item: dict) or (None, None).
+    Chunked values are fetched with parallel BatchGetItem calls and reassembled in order.
+    """
+    table = _get_text_cache_table()
+    item = table.get_item(Key={"s3_key": key}).get("Item")
+    if not item:
+        return (None, None)
+    data = _ddb_decode_item(key, item)
+    return (data, item) if data is not None else (None, None)
+
+def ddb_get_blobs(keys) -> dict:
+    """Read many blobs with BatchGetItem (100 keys per call). Returns {key: bytes} for the keys found."""
+    _get_text_cache_table()
+    keys = list(dict.fromkeys(keys))
+    out = {}
+    for i in range(0, len(keys), 100):
+        for key, item in _ddb_batch_get_items(keys[i:i + 100]).items():
+            data = _ddb_decode_item(key, item)
+            if data is not None:
+                out[key] = data
+    return out
 
+# ---------- Content-addressed, page-granular text cache ----------
+#
+# Extracted text is stored per page under the document's content hash, so identical PDFs
+# under different S3 keys share one extraction and callers can load only the pages they need:
+#   ref#<s3_key>        -> {"etag", "sha256"}      current content behind a key
+#   pages#<sha256>      -> {"page_count", "pages": {"<n>": {"chars", "hash"}}}
+#   page#<sha256>#<n>   -> text of page n (0-based)
+# A head_object per lookup detects re-uploads to the same key (new ETag -> re-fingerprint)
+# without shortening the cache TTL. Pages missing from the manifest are extracted on demand,
+# only for the pages requested.
+
+_doc_ref_cache = _MemoryLRU(1024 * 1024)        # s3_key -> {"etag", "sha256"}
+_page_manifest_cache = _MemoryLRU(4 * 1024 * 1024)  # sha256 -> manifest
+
+def _doc_ref_key(s3_key: str) -> str:
+    return f"ref#{s3_key}"
+
+def _page_manifest_key(sha256: str) -> str:
+    return f"pages#{sha256}"
+
+def _page_key(sha256: str, page_num: int) -> str:
+    return f"page#{sha256}#{page_num:05d}"
+
+def s3_current_etag(s3_key: str) -> str:
+    return (_s3.head_object(Bucket=DOCS_BUCKET, Key=s3_key).get('ETag') or '').strip('"')
+
+def _lookup_content_hash(s3_key: str, etag: str):
+    """sha256 of the content currently behind s3_key, if this ETag has been fingerprinted before."""
+    ref = _doc_ref_cache.get(s3_key)
+    if ref and ref["etag"] == etag:
+        return ref["sha256"]
+    try:
+        data, _ = ddb_get_blob(_doc_ref_key(s3_key))
+    except Exception as e:
+        log(f"AI: ref lookup failed for {s3_key}: {repr(e)}")
+        return None
+    if data is None:
+        return None
+    ref = json.loads(data)
+    if ref.get("etag") != etag:
+        return None
+    _doc_ref_cache.put(s3_key, ref, 256)
+    return ref.get("sha256")
+
+def _store_content_ref(s3_key: str, etag: str, sha256: str):
+    ref = {"etag": etag, "sha256": sha256}
+    _doc_ref_cache.put(s3_key, ref, 256)
+    try:
+        ddb_put_blob(_doc_ref_key(s3_key), json.dumps(ref).encode("utf-8"))
+    except Exception as e:
+        log(f"AI: ref write failed for {s3_key}: {repr(e)}")
+
+def _load_page_manifest(sha256: str):
+    manifest = _page_manifest_cache.get(sha256)
+    if manifest is not None:
+        return manifest
+    try:
+        data, _ = ddb_get_blob(_page_manifest_key(sha256))
+    except Exception as e:
+        log(f"AI: page manifest lookup failed for {sha256[:12]}: {repr(e)}")
+        return None
+    if data is None:
+        return None
+    manifest = json.loads(data)
+    _page_manifest_cache.put(sha256, manifest, len(data))
+    return manifest
+
+def _tiered_get(keys, decode=bytes) -> dict:
+    """
+    Look keys up in the memory, /tmp and DynamoDB tiers (batched). Returns {key: value} for hits.
+    `decode` turns stored bytes into the value kept in memory (bytes by default).
+    """
+    found, pending = {}, []
+    for key in keys:
+        value = _text_memory_cache.get(key)
+        _count_cache("memory", value is not None)
+        if value is not None:
+            found[key] = value
+            continue
+        raw = _text_disk_cache.get(key)
+        _count_cache("disk", raw is not None)
+        if raw is not None:
+            found[key] = decode(raw)
+            _text_memory_cache.put(key, found[key])
+            continue
+        pending.append(key)
+    if pending:
+        try:
+            rows = ddb_get_blobs(pending)
+        except Exception as e:
+            log(f"AI: DynamoDB cache read failed: {repr(e)}")
+            rows = {}
+        for key in pending:
+            data = rows.get(key)
+            _count_cache("dynamodb", data is not None)
+            if data is not None:
+                found[key] = decode(data)
+                _text_disk_cache.put(key, data)
+                _text_memory_cache.put(key, found[key])
+    return found
+
+def _tiered_put(values: dict, encode=bytes):
+    encoded = {key: encode(value) for key, value in values.items()}
+    try:
+        ddb_put_blobs(encoded)
+    except Exception as e:
+        # A failed shared-cache write must not fail the question
+        log(f"AI: DynamoDB cache write failed: {repr(e)}")
+    for key, value in values.items():
+        _text_disk_cache.put(key, encoded[key])
+        _text_memory_cache.put(key, value)
+
+def _tiered_get_texts(keys) -> dict:
+    return _tiered_get(keys, lambda raw: raw.decode("utf-8"))
+
+def _tiered_put_texts(values: dict):
+    _tiered_put(values, lambda text: text.encode("utf-8"))
+
+
+class _LazyPdf:
+    """
+    Spools and opens the PDF behind an S3 key only when a page actually has to be extracted.
+    Use as a context manager; the PyMuPDF document and the spool file are released on exit.
+    """
 
-def get_cached_text(s3_key: str) -> tuple:
+    def __init__(self, s3_key: str):
+        self.s3_key = s3_key
+        self._stack = contextlib.ExitStack()
+        self._spool = None
+        self._doc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._doc is not None:
+            self._doc.close()
+        self._stack.close()
+
+    @property
+    def spool(self) -> dict:
+        if self._spool is None:
+            self._spool = self._stack.enter_context(spool_pdf(DOCS_BUCKET, self.s3_key))
+        return self._spool
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            try:
+                import fitz  # PyMuPDF
+            except ImportError:
+                log("AI ERROR: PyMuPDF (fitz) not available. Check Lambda layer is attached.")
+                raise Exception("PyMuPDF not available")
+            self._doc = fitz.open(self.spool['path'], filetype='pdf')
+        return self._doc
+
+    def page_count(self) -> int:
+        return len(self.doc)
+
+    def page_texts(self, page_numbers) -> dict:
+        """Extract just these pages; large batches go through the parallel workers."""
+        page_numbers = list(page_numbers)
+        workers = min(PDF_PARALLEL_WORKERS, len(page_numbers))
+        if workers > 1 and len(page_numbers) >= PDF_PARALLEL_MIN_PAGES:
+            try:
+                start = time.time()
+                texts = _extract_pages_parallel(self.spool['path'], page_numbers, workers)
+                log(f"AI: Parallel extraction of {len(page_numbers)} pages on {workers} workers in {time.time() - start:.2f}s")
+                return texts
+            except Exception as e:
+                log(f"AI: Parallel extraction failed, falling back to serial: {repr(e)}")
+        return {n: self.doc[n].get_text() for n in page_numbers}
+
+
+def get_document_pages(s3_key: str, pages=None, max_chars: int = None, etag: str = None) -> dict:
+    """
+    Load page texts for the document behind s3_key from the cache, extracting only pages
+    that have never been extracted.
+
+    pages:      iterable of 0-based page numbers to load (default: every page, in order)
+    max_chars:  stop once the loaded pages reach this many characters (prefix loading);
+                page sizes come from the manifest, so later pages are never fetched
+    etag:       known S3 ETag (skips the head_object)
+
+    Returns:
+        {
+            'sha256': str,
+            'etag': str,
+            'page_count': int,
+            'pages': {page_num: text},   # in page order
+            'complete': bool,            # every requested page was loaded
+            'cached': bool               # True unless PyMuPDF had to run
+        }
+    """
+    etag = etag or s3_current_etag(s3_key)
+    sha256 = _lookup_content_hash(s3_key, etag)
+    manifest = _load_page_manifest(sha256) if sha256 else None
+
+    with _LazyPdf(s3_key) as pdf:
+        if manifest is None:
+            if sha256 is None:
+                # Unknown ETag (new upload / re-upload): fingerprint the bytes
+                log(f"AI: Cache MISS for {s3_key} (etag {etag}), fingerprinting...", text_cache_stats())
+                sha256, etag = pdf.spool['sha256'], pdf.spool['etag'] or etag
+                _store_content_ref(s3_key, etag, sha256)
+                # Identical content may already be extracted under another key
+                manifest = _load_page_manifest(sha256)
+            if manifest is None:
+                manifest = {"page_count": pdf.page_count(), "pages": {}}
+        elif manifest.get("page_count") is None:
+            manifest["page_count"] = pdf.page_count()
+
+        page_count = int(manifest["page_count"])
+        known = manifest["pages"]
+        order = [n for n in (range(page_count) if pages is None else pages) if 0 <= n < page_count]
+
+        # Plan the cached reads from the manifest's char counts. A whole-range load reads every
+        # known page; a prefix load stops at the first unknown page, whose size is unknown
+        plan, budget = [], 0
+        for n in order:
+            if max_chars is not None and (budget >= max_chars or str(n) not in known):
+                break
+            if str(n) in known:
+                plan.append(n)
+                budget += int(known[str(n)]["chars"])
+        cached = _tiered_get_texts([_page_key(sha256, n) for n in plan])
+
+        extracted = {}
+        if max_chars is None:
+            # Whole-range load: extract just the pages the cache could not serve, in one pass
+            missing = [n for n in order if _page_key(sha256, n) not in cached]
+            if missing:
+                extracted.update(pdf.page_texts(missing))
+
+        out, total = {}, 0
+        for n in order:
+            if max_chars is not None and total >= max_chars:
+                break
+            text = extracted.get(n, cached.get(_page_key(sha256, n)))
+            if text is None and str(n) in known:
+                text = _tiered_get_texts([_page_key(sha256, n)]).get(_page_key(sha256, n))
+            if text is None:
+                extracted.update(pdf.page_texts([n]))
+                text = extracted[n]
+            out[n] = text
+            total += len(text)
+
+    if extracted:
+        log(f"AI: Extracted {len(extracted)} of {page_count} pages for {sha256[:12]}")
+        _tiered_put_texts({_page_key(sha256, n): t for n, t in extracted.items()})
+        for n, t in extracted.items():
+            known[str(n)] = {"chars": len(t), "hash": hashlib.sha256(t.encode("utf-8")).hexdigest()[:16]}
+        data = json.dumps(manifest, separators=(",", ":")).encode("utf-8")
+        _page_manifest_cache.put(sha256, manifest, len(data))
+        try:
+            ddb_put_blob(_page_manifest_key(sha256), data, attrs={"source_key": s3_key})
+        except Exception as e:
+            log(f"AI: page manifest write failed: {repr(e)}")
+
+    return {
+        'sha256': sha256,
+        'etag': etag,
+        'page_count': page_count,
+        'pages': dict(sorted(out.items())),
+        'complete': len(out) == len(order),
+        'cached': not extracted,
+    }
+
+def get_cached_document(s3_key: str, etag: str = None, max_chars: int = None) -> dict:
+    """
+    Document text (with --- Page N --- markers) for s3_key, assembled from the page cache.
+    Pass `etag` when the caller already knows it (e.g. from an S3 event) to skip the
+    head_object, and `max_chars` to load only the leading pages up to that size.
+    
+    Returns:
+        {
+            'text': str,
+            'sha256': str,
+            'etag': str,
+            'page_count': int,
+            'complete': bool,
+            'cached': bool   # True unless PyMuPDF had to run
+        }
     """
-    Get cached text from DynamoDB or extract if not cached.
+    doc = get_document_pages(s3_key, max_chars=max_chars, etag=etag)
+    page_texts = [doc['pages'].get(n, "") for n in range(doc['page_count'])]
+    return {
+        'text': _format_pages(page_texts),
+        'sha256': doc['sha256'],
+        'etag': doc['etag'],
+        'page_count': doc['page_count'],
+        'complete': doc['complete'],
+        'cached': doc['cached'],
+    }
+
+def get_cached_text(s3_key: str, max_chars: int = None) -> tuple:
+    """
+    Get document text from the cache tiers (memory -> /tmp -> DynamoDB) or extract it.
+    With max_chars, only the leading pages needed to reach that size are loaded.
     
     Returns:
         (text: str, was_cached: bool)
     """
     try:
-        table = _get_text_cache_table()
-        
-        # Check cache first
-        log(f"AI: Checking cache for {s3_key}")
-        response = table.get_item(Key={'s3_key': s3_key})
-        
-        if 'Item' in response:
-            log(f"AI: Cache HIT for {s3_key}")
-            return (response['Item']['text'], True)
-        
-        log(f"AI: Cache MISS for {s3_key}, extracting...")
-        
-        # Extract PDF text
-        result = extract_pdf_text(DOCS_BUCKET, s3_key)
-        
-        # Cache for 30 days
-        from datetime import datetime, timedelta
-        ttl = int((datetime.utcnow() + timedelta(days=30)).timestamp())
-        
-        log(f"AI: Caching text in DynamoDB...")
-        table.put_item(Item={
-            's3_key': s3_key,
-            'text': result['text'],
-            'extracted_at': datetime.utcnow().isoformat(),
-            'page_count': result['page_count'],
-            'file_size': result['file_size'],
-            'ttl': ttl
-        })
-        
-        log(f"AI: Text cached successfully (TTL: 30 days)")
-        
-        return (result['text'], False)
-        
+        doc = get_cached_document(s3_key, max_chars=max_chars)
+        return (doc['text'], doc['cached'])
     except Exception as e:
         log(f"AI ERROR: get_cached_text failed: {repr(e)}")
         raise
 
 
-def ask_ai_about_document(document_text: str, question: str, context: dict = None) -> str:
+# ---------- Retrieval: BM25 over page/paragraph chunks ----------
+#
+# Instead of sending the first N characters, the document is cut into paragraph-sized chunks
+# (never crossing a page) and the chunks that best match the question are sent, in page
+# order, up to the character/token budget. The BM25 index stores chunk offsets and term
+# frequencies only; it is cached next to the page texts under the same content hash.
+
+_BM25_VERSION = 1
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+_bm25_cache = _MemoryLRU(16 * 1024 * 1024)
+
+_BRAND_LANGUAGE = {'dk': 'da', 'se': 'sv', 'ie': 'en'}
+
+_STOPWORDS = {
+    'da': frozenset("""og i jeg det at en den til er som på de med han af for ikke der var mig sig men
+        et har om vi min havde ham hun nu over da fra du ud sin dem os op man hans hvor eller hvad
+        skal selv her alle vil blev kunne ind når være dog noget ville jo deres efter ned skulle
+        denne end dette mit også under have dig anden hende mine alt meget sit sine vor mod disse
+        hvis din nogle hos blive mange ad bliver hendes været thi jer sådan""".split()),
+    'sv': frozenset("""och det att i en jag hon som han på den med var sig för så till är men ett om
+        hade de av icke mig du henne då sin nu har inte hans honom skulle hennes där min man ej vid
+        kunde något från ut när efter upp vi dem vara vad över än dig kan sina här ha mot alla
+        under någon eller allt mycket sedan ju denna själv detta åt utan varit hur ingen mitt ni
+        bli blev oss din dessa några deras blir mina samma vilken er sådan vår blivit dess inom
+        mellan sådant varför varje vilka ditt vem vilket sitta sådana vart dina vars vårt våra
+        ert era vilkas""".split()),
+    'en': frozenset("""a an and are as at be but by for if in into is it no not of on or such that the
+        their then there these they this to was will with what who whom which when where why how
+        do does did we you our your i me my he she him her his its them us has have had""".split()),
+}
+
+# Light suffix stripping in the spirit of the Snowball stemmers: enough to fold
+# "arvingen"/"arvinger"/"arving" or "makarna"/"make" together without a dependency.
+_SUFFIXES = {
+    'da': ("erendes", "erende", "hedens", "ethed", "erede", "heden", "heder", "endes", "ernes",
+           "erens", "erets", "ered", "ende", "erne", "eren", "erer", "heds", "enes", "eres",
+           "eret", "hed", "ene", "ere", "ens", "ers", "ets", "en", "er", "es", "et", "e", "s"),
+    'sv': ("heterna", "hetens", "anden", "heten", "heter", "arnas", "ernas", "ornas", "andes",
+           "arens", "andet", "arna", "erna", "orna", "ande", "arne", "aste", "aren", "ades",
+           "erns", "ade", "are", "ern", "ens", "het", "ast", "ad", "en", "ar", "er", "or", "as",
+           "es", "at", "a", "e", "s"),
+    'en': ("ational", "ations", "ation", "ness", "ment", "ings", "ing", "edly", "ies", "ied",
+           "ed", "es", "ly", "s"),
+}
+_STEM_MIN_LENGTH = 3
+
+def _stem(word: str, lang: str) -> str:
+    for suffix in _SUFFIXES[lang]:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _STEM_MIN_LENGTH:
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text: str, lang: str = 'da') -> list:
+    """Lower-case word tokens with stopwords removed and light stemming applied."""
+    stop = _STOPWORDS[lang]
+    return [_stem(t, lang) for t in _TOKEN_RE.findall(text.lower()) if t not in stop]
+
+def _chunk_page(text: str, target: int) -> list:
     """
-    Send question + document to AWS Bedrock (Claude 3.5 Haiku).
-    
-    Args:
-        document_text: Extracted PDF text
-        question: Customer's question
-        context: Optional metadata (document name, journal name, brand)
-    
+    Split one page into (start, end) spans of roughly `target` chars, preferring to break at
+    blank lines (paragraphs) and otherwise at line ends.
+    """
+    spans, start, end, gap = [], None, None, False
+    for m in re.finditer(r"[^\n]+", text):
+        if not m.group().strip():
+            gap = True
+            continue
+        if end is not None and text.count("\n", end, m.start()) > 1:
+            gap = True
+        if start is not None and (m.end() - start > target or (gap and end - start >= target // 2)):
+            spans.append((start, end))
+            start = None
+        if start is None:
+            start = m.start()
+        end, gap = m.end(), False
+    if start is not None:
+        spans.append((start, end))
+    return spans
+
+def build_bm25_index(page_texts: dict, lang: str, chunk_chars: int = None) -> dict:
+    """
+    Index {page_num: text} as BM25 chunks.
+
     Returns:
-        AI-generated answer
+        {
+            'v': int, 'lang': str,
+            'chunks': [[page_num, start, end], ...],
+            'tf': [{term: count}, ...],     # one per chunk
+            'dl': [int, ...]                # chunk length in terms
+        }
+    """
+    chunk_chars = chunk_chars or AI_RETRIEVAL_CHUNK_CHARS
+    chunks, tfs, lengths = [], [], []
+    for page_num in sorted(page_texts):
+        text = page_texts[page_num]
+        for start, end in _chunk_page(text, chunk_chars):
+            terms = tokenize(text[start:end], lang)
+            if not terms:
+                continue
+            tf = {}
+            for t in terms:
+                tf[t] = tf.get(t, 0) + 1
+            chunks.append([page_num, start, end])
+            tfs.append(tf)
+            lengths.append(len(terms))
+    return {'v': _BM25_VERSION, 'lang': lang, 'chunks': chunks, 'tf': tfs, 'dl': lengths}
+
+def _bm25_prepare(index: dict) -> dict:
+    """Add the derived document-frequency table used for scoring (not persisted)."""
+    df = {}
+    for tf in index['tf']:
+        for t in tf:
+            df[t] = df.get(t, 0) + 1
+    index['df'] = df
+    index['avgdl'] = (sum(index['dl']) / len(index['dl'])) if index['dl'] else 0.0
+    return index
+
+def bm25_scores(index: dict, query: str) -> list:
+    """BM25 score per chunk for the query, in chunk order."""
+    n = len(index['chunks'])
+    terms = set(tokenize(query, index['lang']))
+    idf = {}
+    for t in terms:
+        df = index['df'].get(t, 0)
+        if df:
+            idf[t] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+    scores = [0.0] * n
+    if not idf:
+        return scores
+    avgdl = index['avgdl'] or 1.0
+    for i, tf in enumerate(index['tf']):
+        norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * index['dl'][i] / avgdl)
+        score = 0.0
+        for t, w in idf.items():
+            f = tf.get(t)
+            if f:
+                score += w * f * (_BM25_K1 + 1) / (f + norm)
+        scores[i] = score
+    return scores
+
+def _bm25_key(sha256: str, lang: str) -> str:
+    return f"bm25#v{_BM25_VERSION}#{lang}#{AI_RETRIEVAL_CHUNK_CHARS}#{sha256}"
+
+def get_bm25_index(sha256: str, lang: str, page_texts) -> dict:
+    """
+    BM25 index for this document version, from the cache tiers or built and stored now.
+    `page_texts` is {page_num: text}, or a callable returning it that is only called when
+    the index has to be built.
+    """
+    key = _bm25_key(sha256, lang)
+    index = _bm25_cache.get(key)
+    if index is not None:
+        return index
+    raw = _tiered_get_texts([key]).get(key)
+    if raw is not None:
+        index = json.loads(raw)
+    else:
+        start = time.time()
+        index = build_bm25_index(page_texts() if callable(page_texts) else page_texts, lang)
+        raw = json.dumps(index, separators=(",", ":"), ensure_ascii=False)
+        _tiered_put_texts({key: raw})
+        log(f"AI: Built BM25 index for {sha256[:12]} ({len(index['chunks'])} chunks) in {time.time() - start:.2f}s")
+    index = _bm25_prepare(index)
+    _bm25_cache.put(key, index, len(raw) * 2)
+    return index
+
+def _document_budget_chars() -> int:
+    if AI_MAX_DOCUMENT_TOKENS > 0:
+        return min(AI_MAX_DOCUMENT_CHARS, AI_MAX_DOCUMENT_TOKENS * 4)
+    return AI_MAX_DOCUMENT_CHARS
+
+def select_chunks(index: dict, scores: list, budget: int, top_k: int = None) -> list:
+    """
+    Best-scoring chunk ids that fit the budget (at most top_k), returned in document order.
+    Falls back to the leading chunks when nothing in the question matches.
+    """
+    top_k = top_k or AI_RETRIEVAL_TOP_K
+    chunks = index['chunks']
+    if any(scores):
+        ranked = sorted((i for i in range(len(chunks)) if scores[i] > 0), key=lambda i: -scores[i])
+    else:
+        ranked = list(range(len(chunks)))
+    picked, used = [], 0
+    for i in ranked:
+        size = chunks[i][2] - chunks[i][1]
+        if used + size > budget:
+            continue
+        picked.append(i)
+        used += size
+        if len(picked) >= top_k:
+            break
+    return sorted(picked)
+
+def _format_chunks(index: dict, chunk_ids: list, page_texts: dict) -> str:
+    """Selected chunks under --- Page N --- headers, with [...] marking skipped text."""
+    out, last = [], None
+    for i in chunk_ids:
+        page_num, start, end = index['chunks'][i]
+        if last is None or last[0] != page_num:
+            out.append(f"--- Page {page_num + 1} ---")
+        elif i != last[1] + 1:
+            out.append("[...]")
+        out.append(page_texts[page_num][start:end])
+        last = (page_num, i)
+    return "\n".join(out)
+
+# ---------- Retrieval: chunk embeddings ----------
+#
+# Each BM25 chunk is also embedded once per document version, so paraphrased questions
+# ("who inherits if we both die") still find the clause ("længstlevende ægtefælle").
+# Vectors are stored L2-normalized and quantized (int8 or float16) next to the text cache;
+# cosine similarity is then a single matrix-vector product.
+
+_EMBEDDING_VERSION = 1
+_embedding_cache = _MemoryLRU(32 * 1024 * 1024)
+_embedder = None
+
+
+class HashingEmbedder:
+    """
+    Deterministic local embedder (feature hashing of words and character 4-grams).
+    Needs no network, so it stands in for Bedrock in tests and local runs.
+    """
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+        self.id = f"hashing-{dimensions}"
+
+    def _features(self, text: str):
+        for word in _TOKEN_RE.findall(text.lower()):
+            yield word, 1.0
+            padded = f" {word} "
+            for i in range(len(padded) - 3):
+                yield padded[i:i + 4], 0.5
+
+    def embed(self, texts) -> list:
+        out = []
+        for text in texts:
+            vec = [0.0] * self.dimensions
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                vec[h % self.dimensions] += weight if (h >> 31) & 1 else -weight
+            out.append(_l2_normalize(vec))
+        return out
+
+
+class BedrockEmbedder:
+    """Titan text embeddings through bedrock-runtime (one InvokeModel per text, run concurrently)."""
+
+    def __init__(self, model_id: str = None, dimensions: int = None, max_workers: int = 8):
+        self.model_id = model_id or AI_EMBEDDING_MODEL_ID
+        self.dimensions = dimensions or AI_EMBEDDING_DIMENSIONS
+        self.max_workers = max_workers
+        self.id = f"{self.model_id}-{self.dimensions}"
+
+    def _embed_one(self, text: str) -> list:
+        response = _get_bedrock_client().invoke_model(
+            modelId=self.model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps({"inputText": text, "dimensions": self.dimensions, "normalize": True}),
+        )
+        return json.loads(response['body'].read())['embedding']
+
+    def embed(self, texts) -> list:
+        texts = list(texts)
+        if len(texts) <= 1:
+            return [self._embed_one(t) for t in texts]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(texts))) as pool:
+            return list(pool.map(self._embed_one, texts))
+
+
+def get_embedder():
+    """Embedder selected by AI_EMBEDDER, or None when semantic retrieval is off."""
+    global _embedder
+    if _embedder is None and AI_EMBEDDER != "off":
+        _embedder = HashingEmbedder() if AI_EMBEDDER == "hashing" else BedrockEmbedder()
+    return _embedder
+
+def _l2_normalize(vec: list) -> list:
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+def encode_vectors(vectors: list, dtype: str = None) -> bytes:
+    """
+    Pack normalized vectors as `<json header>\n<row-major data>`.
+    int8 stores round(x * 127); float16 stores IEEE half floats. Cosine needs no scale factor.
+    """
+    dtype = dtype or AI_EMBEDDING_DTYPE
+    dim = len(vectors[0]) if vectors else 0
+    header = json.dumps({"v": _EMBEDDING_VERSION, "dtype": dtype, "n": len(vectors), "dim": dim}).encode("utf-8")
+    if np is not None:
+        arr = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), dim)
+        if dtype == "int8":
+            data = np.clip(np.rint(arr * 127), -127, 127).astype(np.int8).tobytes()
+        else:
+            data = arr.astype("<f2").tobytes()
+    else:
+        import array, struct
+        flat = [x for vec in vectors for x in vec]
+        if dtype == "int8":
+            data = array.array("b", (max(-127, min(127, round(x * 127))) for x in flat)).tobytes()
+        else:
+            data = struct.pack(f"<{len(flat)}e", *flat)
+    return header + b"\n" + data
+
+def decode_vectors(blob: bytes):
+    """Inverse of encode_vectors: an (n, dim) float32 matrix, or a list of rows without NumPy."""
+    header, data = blob.split(b"\n", 1)
+    meta = json.loads(header)
+    n, dim = meta["n"], meta["dim"]
+    if np is not None:
+        arr = np.frombuffer(data, dtype=np.int8 if meta["dtype"] == "int8" else "<f2")
+        return arr.astype(np.float32).reshape(n, dim)
+    import array, struct
+    if meta["dtype"] == "int8":
+        flat = array.array("b", data).tolist()
+    else:
+        flat = list(struct.unpack(f"<{n * dim}e", data))
+    return [flat[i * dim:(i + 1) * dim] for i in range(n)]
+
+def cosine_scores(matrix, query: list) -> list:
+    """Cosine similarity of every row with the query vector."""
+    if np is not None:
+        q = np.asarray(query, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(q) or 1.0)
+        norms[norms == 0] = 1.0
+        return (matrix @ q / norms).tolist()
+    q = _l2_normalize(list(query))
+    out = []
+    for row in matrix:
+        norm = math.sqrt(sum(x * x for x in row)) or 1.0
+        out.append(sum(a * b for a, b in zip(row, q)) / norm)
+    return out
+
+def get_embedding_index(sha256: str, index: dict, page_texts, embedder):
+    """
+    Chunk embedding matrix aligned with the BM25 index chunks, built once per document version.
+    `page_texts` as for get_bm25_index.
     """
+    key = f"emb#v{_EMBEDDING_VERSION}#{embedder.id}#{AI_EMBEDDING_DTYPE}#{_bm25_key(sha256, index['lang'])}"
+    matrix = _embedding_cache.get(key)
+    if matrix is not None:
+        return matrix
+    blob = _tiered_get([key]).get(key)
+    if blob is None:
+        start = time.time()
+        if callable(page_texts):
+            page_texts = page_texts()
+        texts = [page_texts[p][a:b] for p, a, b in index['chunks']]
+        blob = encode_vectors([_l2_normalize(v) for v in embedder.embed(texts)])
+        _tiered_put({key: blob})
+        log(f"AI: Embedded {len(texts)} chunks for {sha256[:12]} with {embedder.id} in {time.time() - start:.2f}s")
+    matrix = decode_vectors(blob)
+    _embedding_cache.put(key, matrix, len(blob) * 4)
+    return matrix
+
+def _fuse_ranks(*score_lists, k: int = 60) -> list:
+    """Reciprocal rank fusion; chunks with a zero score in a list get nothing from it."""
+    fused = [0.0] * len(score_lists[0])
+    for scores in score_lists:
+        ranked = sorted((i for i, v in enumerate(scores) if v > 0), key=lambda i: -scores[i])
+        for rank, i in enumerate(ranked):
+            fused[i] += 1.0 / (k + rank + 1)
+    return fused
+
+
+def warm_retrieval_indexes(sha256: str, page_texts: dict, brand: str = 'dk') -> bool:
+    """
+    Build the BM25 and chunk-embedding indexes get_document_context would otherwise build on
+    the first question (embedding every chunk is one model call per chunk). False when the
+    document fits the budget and is always sent whole.
+    """
+    if sum(len(t) for t in page_texts.values()) <= _document_budget_chars():
+        return False
+    index = get_bm25_index(sha256, _BRAND_LANGUAGE.get(brand, 'da'), page_texts)
+    embedder = get_embedder()
+    if embedder is not None and index['chunks']:
+        get_embedding_index(sha256, index, page_texts, embedder)
+    return True
+
+
+def get_document_context(s3_key: str, question: str, brand: str = 'dk', etag: str = None) -> tuple:
+    """
+    Document text to send with this question: the whole document when it fits the budget,
+    otherwise the top-k chunks that fit, ranked by BM25 fused with embedding similarity
+    (BM25 alone when no embedder is configured or it fails).
+
+    Once a document is fully extracted, the page manifest tells its size without loading
+    any page, and only the pages behind the selected chunks are read; all pages are loaded
+    only the first time (to extract them and build the indexes).
+
+    Returns:
+        (text: str, was_cached: bool, whole_document: bool)
+    """
+    budget = _document_budget_chars()
+    etag = etag or s3_current_etag(s3_key)
+    sha256 = _lookup_content_hash(s3_key, etag)
+    manifest = _load_page_manifest(sha256) if sha256 else None
+    page_count = manifest and manifest.get("page_count")
+    if page_count is None or len(manifest["pages"]) < int(page_count) or \
+            sum(int(p["chars"]) for p in manifest["pages"].values()) <= budget:
+        doc = get_document_pages(s3_key, etag=etag)
+        if sum(len(t) for t in doc['pages'].values()) <= budget:
+            return (_format_pages([doc['pages'].get(n, "") for n in range(doc['page_count'])]), doc['cached'], True)
+        sha256, page_count = doc['sha256'], doc['page_count']
+    else:
+        doc = None
+
+    def all_pages():
+        nonlocal doc
+        if doc is None:
+            doc = get_document_pages(s3_key, etag=etag)
+        return doc['pages']
+
+    lang = _BRAND_LANGUAGE.get(brand, 'da')
+    embedder = get_embedder()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # The question embedding is a model round trip; overlap it with the index loads
+        question_vec = pool.submit(embedder.embed, [question]) if embedder is not None else None
+        index = get_bm25_index(sha256, lang, all_pages)
+        scores = bm25_scores(index, question)
+        if question_vec is not None and index['chunks']:
+            try:
+                matrix = get_embedding_index(sha256, index, all_pages, embedder)
+                similarity = cosine_scores(matrix, question_vec.result()[0])
+                scores = _fuse_ranks(scores, similarity)
+            except Exception as e:
+                log(f"AI: Embedding retrieval failed, using BM25 only: {repr(e)}")
+    picked = select_chunks(index, scores, budget)
+    if doc is None:
+        doc = get_document_pages(s3_key, pages=sorted({index['chunks'][i][0] for i in picked}), etag=etag)
+    text = _format_chunks(index, picked, doc['pages'])
+    log(f"AI: Retrieval picked {len(picked)}/{len(index['chunks'])} chunks ({len(text)} chars) "
+        f"from {len(doc['pages'])}/{page_count} loaded pages")
+    return (text, doc['cached'], False)
+
+
+# ---------- Answer cache ----------
+#
+# Identical questions about identical content get the stored answer instead of a model call.
+# The key covers everything that shapes the answer: document content hash, normalized
+# question, brand (answer language), the document and case names the prompt carries (so an
+# answer is never served under another customer's journal), model and AI_PROMPT_VERSION.
+# A re-uploaded document has a new content hash, so its old answers are never served and
+# expire via the TTL.
+
+AI_PROMPT_VERSION = "4"   # bump whenever build_ai_request / the system prompt / retrieval changes
+_answer_cache = _MemoryLRU(4 * 1024 * 1024)
+
+def normalize_question(question: str) -> str:
+    """Case-, width- and whitespace-insensitive form of a question; trailing ?!. ignored."""
+    q = unicodedata.normalize("NFKC", question).lower()
+    return " ".join(q.split()).strip(" ?!.")
+
+def answer_cache_key(sha256: str, question: str, context: dict) -> str:
+    digest = hashlib.sha256(json.dumps(
+        [AI_PROMPT_VERSION, BEDROCK_MODEL_ID, context.get('brand'), _document_budget_chars(),
+         context.get('name'), context.get('journal_name'), normalize_question(question)],
+        ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"answer#{sha256}#{digest[:32]}"
+
+def get_cached_answer(key: str):
+    entry = _answer_cache.get(key)
+    if entry is None:
+        try:
+            data, item = ddb_get_blob(key)
+        except Exception as e:
+            log(f"AI: answer cache read failed: {repr(e)}")
+            return None
+        if data is None:
+            return None
+        # DynamoDB deletes expired items lazily; honour the TTL ourselves
+        entry = {"answer": data.decode("utf-8"), "expires": int(item.get("ttl") or 0)}
+        _answer_cache.put(key, entry, len(data) + 128)
+    if entry["expires"] <= time.time():
+        _answer_cache.pop(key)
+        return None
+    return entry["answer"]
+
+def put_cached_answer(key: str, answer: str):
+    expires = int(time.time()) + AI_ANSWER_CACHE_TTL_HOURS * 3600
+    _answer_cache.put(key, {"answer": answer, "expires": expires}, len(answer) + 128)
     try:
-        bedrock = _get_bedrock_client()
-        
-        log(f"AI: Asking AI (question length: {len(question)} chars)")
-        
-        # Detect language from brand or question
-        brand = (context or {}).get('brand', 'dk').lower()
-        lang_map = {'dk': 'Danish', 'se': 'Swedish', 'ie': 'English'}
-        default_lang = lang_map.get(brand, 'Danish')
-        
-        # Build context-aware prompt
-        system_prompt = f"""You are a helpful legal document assistant for Din Familiejurist (family law firm).
+        ddb_put_blob(key, answer.encode("utf-8"), ttl=expires)
+    except Exception as e:
+        log(f"AI: answer cache write failed: {repr(e)}")
+
+def load_question_context(s3_key: str, question: str, context: dict) -> dict:
+    """
+    Answer-cache lookup, falling back to loading the document context for the model.
+    `context` is the prompt context ({'name', 'journal_name', 'brand'}) the answer is for.
+
+    Returns:
+        {
+            'cached_answer': str | None,   # set on an answer-cache hit (document not loaded)
+            'document_text': str | None,
+            'whole_document': bool,        # document_text is the whole document, not retrieved chunks
+            'was_cached': bool,
+            'answer_key': str | None       # where to store a fresh answer
+        }
+    """
+    etag = s3_current_etag(s3_key)
+    sha256 = _lookup_content_hash(s3_key, etag)
+    enabled = AI_ANSWER_CACHE_TTL_HOURS > 0
+    key = answer_cache_key(sha256, question, context) if (enabled and sha256) else None
+    cached_answer = get_cached_answer(key) if key else None
+    if cached_answer is not None:
+        log(f"AI: Answer cache HIT for {s3_key}")
+        return {'cached_answer': cached_answer, 'document_text': None, 'whole_document': False,
+                'was_cached': True, 'answer_key': key}
+
+    document_text, was_cached, whole_document = get_document_context(s3_key, question, context['brand'], etag=etag)
+    if enabled and key is None:
+        # First question on new content: the hash is known now
+        sha256 = _lookup_content_hash(s3_key, etag)
+        key = answer_cache_key(sha256, question, context) if sha256 else None
+    return {'cached_answer': None, 'document_text': document_text, 'whole_document': whole_document,
+            'was_cached': was_cached, 'answer_key': key}
+
+def answer_question(qctx: dict, question: str, context: dict) -> tuple:
+    """
+    The cached answer, or a fresh one from the model (stored unless it is the error reply).
+
+    Returns:
+        (answer: str, from_cache: bool)
+    """
+    if qctx['cached_answer'] is not None:
+        return (qctx['cached_answer'], True)
+    answer = ask_ai_about_document(qctx['document_text'], question, context,
+                                   cache_document=qctx['whole_document'])
+    if qctx['answer_key'] and answer != _ai_error_message(context):
+        put_cached_answer(qctx['answer_key'], answer)
+    return (answer, False)
+
+def _ai_answer_fields(journal_id: str, answer: str, elapsed_ms: int, from_cache: bool) -> dict:
+    """Outbound ChatMessage__c fields for an AI answer."""
+    fields = {
+        "Parent_Record__c": journal_id,
+        "Body__c": answer,
+        "Is_Inbound__c": False,
+        "Message_Type__c": "AI",
+        "AI_Model__c": BEDROCK_MODEL_ID,
+        "AI_Response_Time__c": elapsed_ms
+    }
+    if AI_CACHE_HIT_FIELD:
+        fields[AI_CACHE_HIT_FIELD] = from_cache
+    return fields
+
+
+def _ai_system_prompt(brand: str) -> str:
+    lang_map = {'dk': 'Danish', 'se': 'Swedish', 'ie': 'English'}
+    default_lang = lang_map.get(brand, 'Danish')
+    return f"""You are a helpful legal document assistant for Din Familiejurist (family law firm).
 Your role is to answer customer questions about their legal documents clearly and accurately.
 
 Guidelines:
@@ -1449,44 +3545,100 @@ Guidelines:
 - Respond in the same language as the question (Danish, Swedish, or English)
 - Default language: {default_lang}
 """
+
+def build_ai_request(document_text: str, question: str, context: dict = None,
+                     cache_document: bool = False) -> dict:
+    """
+    Anthropic Messages body for a document question.
+
+    The prompt is ordered so that everything except the question is a stable prefix:
+    system prompt (per brand) -> document block -> question. With AI_PROMPT_CACHING on and
+    `cache_document` set (the whole document is sent), the document block carries a
+    cache_control breakpoint, so follow-up questions on the same document read the prefix
+    from Bedrock's prompt cache instead of re-processing it. Retrieved chunks differ per
+    question, so marking them would pay the cache-write premium on every call; the system
+    prompt alone is below the minimum cacheable length.
+    """
+    brand = (context or {}).get('brand', 'dk').lower()
+    system_prompt = _ai_system_prompt(brand)
+
+    # Add document context if provided
+    context_text = ""
+    if context:
+        doc_name = context.get('name', 'Unknown')
+        journal_name = context.get('journal_name', '')
+        context_text = f"\nDocument: {doc_name}\n"
+        if journal_name:
+            context_text += f"Case: {journal_name}\n"
+
+    # Safety net: retrieval already keeps the text within budget
+    max_text_length = _document_budget_chars()
+    truncated_text = document_text[:max_text_length]
+    if len(document_text) > max_text_length:
+        truncated_text += f"\n\n[Document truncated - showing first {max_text_length} characters]"
+
+    document_block = {"type": "text", "text": f"""{context_text}
+Document content:
+{truncated_text}
+"""}
+    question_block = {"type": "text", "text": f"""
+Customer question: {question}
+
+Please answer the question based on the document content above."""}
+    system = [{"type": "text", "text": system_prompt}]
+    if AI_PROMPT_CACHING and cache_document:
+        document_block["cache_control"] = {"type": "ephemeral"}
+
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 1000,
+        "temperature": 0.3,  # Lower = more focused/consistent
+        "system": system,
+        "messages": [
+            {
+                "role": "user",
+                "content": [document_block, question_block]
+            }
+        ]
+    }
+
+def _log_ai_usage(usage: dict, elapsed: float, answer_chars: int):
+    usage = usage or {}
+    log(f"AI: Response generated in {elapsed:.2f}s ({answer_chars} chars); tokens "
+        f"in={usage.get('input_tokens', 0)} out={usage.get('output_tokens', 0)} "
+        f"cache_read={usage.get('cache_read_input_tokens', 0)} "
+        f"cache_write={usage.get('cache_creation_input_tokens', 0)}")
+
+def _ai_error_message(context: dict = None) -> str:
+    """Friendly error message in the customer's language."""
+    brand = (context or {}).get('brand', 'dk').lower()
+    if brand == 'se':
+        return "Jag beklagar, jag kunde inte behandla din fråga. Försök igen eller kontakta supporten."
+    elif brand == 'ie':
+        return "I apologize, I couldn't process your question. Please try again or contact support."
+    else:
+        return "Jeg beklager, jeg kunne ikke behandle dit spørgsmål. Prøv venligst igen eller kontakt support."
+
+def ask_ai_about_document(document_text: str, question: str, context: dict = None,
+                          cache_document: bool = False) -> str:
+    """
+    Send question + document to AWS Bedrock (Claude 3.5 Haiku).
+    
+    Args:
+        document_text: Extracted PDF text
+        question: Customer's question
+        context: Optional metadata (document name, journal name, brand)
+        cache_document: document_text is the whole document (prompt-cache breakpoint)
+    
+    Returns:
+        AI-generated answer
+    """
+    try:
+        bedrock = _get_bedrock_client()
         
-        # Add document context if provided
-        context_text = ""
-        if context:
-            doc_name = context.get('name', 'Unknown')
-            journal_name = context.get('journal_name', '')
-            context_text = f"\nDocument: {doc_name}\n"
-            if journal_name:
-                context_text += f"Case: {journal_name}\n"
-        
-        # Limit document text to ~15K chars (to stay within token limits)
-        max_text_length = 15000
-        truncated_text = document_text[:max_text_length]
-        if len(document_text) > max_text_length:
-            truncated_text += f"\n\n[Document truncated - showing first {max_text_length} characters]"
-        
-        # Build user prompt
-        user_prompt = f"""{context_text}
-Document content:
-{truncated_text}
-
-Customer question: {question}
-
-Please answer the question based on the document content above."""
+        log(f"AI: Asking AI (question length: {len(question)} chars)")
         
-        # Call Bedrock (Claude 3.5 Haiku)
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 1000,
-            "temperature": 0.3,  # Lower = more focused/consistent
-            "system": system_prompt,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": user_prompt
-                }
-            ]
-        })
+        body = json.dumps(build_ai_request(document_text, question, context, cache_document))
         
         start_time = time.time()
         
@@ -1500,20 +3652,69 @@ Please answer the question based on the document content above."""
         result = json.loads(response['body'].read())
         answer = result['content'][0]['text']
         
-        log(f"AI: Response generated in {elapsed_time:.2f}s ({len(answer)} chars)")
+        _log_ai_usage(result.get('usage'), elapsed_time, len(answer))
         
         return answer
         
     except Exception as e:
         log(f"AI ERROR: ask_ai_about_document failed: {repr(e)}")
-        # Return friendly error message in appropriate language
-        brand = (context or {}).get('brand', 'dk').lower()
-        if brand == 'se':
-            return "Jag beklagar, jag kunde inte behandla din fråga. Försök igen eller kontakta supporten."
-        elif brand == 'ie':
-            return "I apologize, I couldn't process your question. Please try again or contact support."
-        else:
-            return "Jeg beklager, jeg kunne ikke behandle dit spørgsmål. Prøv venligst igen eller kontakt support."
+        return _ai_error_message(context)
+
+
+class AIStreamInterrupted(Exception):
+    """The model stream failed after part of the answer was already yielded."""
+    pass
+
+
+def stream_ai_answer(document_text: str, question: str, context: dict = None, outcome: dict = None,
+                     cache_document: bool = False):
+    """
+    Same request as ask_ai_about_document, via invoke_model_with_response_stream.
+    Yields answer text fragments as the model produces them. On failure before any text,
+    yields the friendly error message instead; after partial output, raises
+    AIStreamInterrupted (the answer so far is truncated and must not be used).
+    outcome['stop_reason'] is set once the model reports how the answer ended
+    (message_delta stop_reason or message_stop); without it the stream was cut short.
+    """
+    outcome = {} if outcome is None else outcome
+    sent = False
+    try:
+        bedrock = _get_bedrock_client()
+        log(f"AI: Streaming AI answer (question length: {len(question)} chars)")
+        start_time = time.time()
+        response = bedrock.invoke_model_with_response_stream(
+            modelId=BEDROCK_MODEL_ID,
+            body=json.dumps(build_ai_request(document_text, question, context, cache_document))
+        )
+        usage, chars, first_token = {}, 0, None
+        for event in response['body']:
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            msg = json.loads(chunk['bytes'])
+            kind = msg.get('type')
+            if kind == 'message_start':
+                usage.update(msg.get('message', {}).get('usage') or {})
+            elif kind == 'content_block_delta' and msg.get('delta', {}).get('type') == 'text_delta':
+                text = msg['delta']['text']
+                if first_token is None:
+                    first_token = time.time() - start_time
+                chars += len(text)
+                sent = True
+                yield text
+            elif kind == 'message_delta':
+                usage.update(msg.get('usage') or {})
+                if msg.get('delta', {}).get('stop_reason'):
+                    outcome['stop_reason'] = msg['delta']['stop_reason']
+            elif kind == 'message_stop':
+                outcome.setdefault('stop_reason', 'message_stop')
+        log(f"AI: First token after {(first_token or 0):.2f}s")
+        _log_ai_usage(usage, time.time() - start_time, chars)
+    except Exception as e:
+        log(f"AI ERROR: stream_ai_answer failed: {repr(e)}")
+        if sent:
+            raise AIStreamInterrupted(repr(e)) from e
+        yield _ai_error_message(context)
 
 
 # ---------- CHAT (document-scoped) ----------
@@ -1607,10 +3808,10 @@ def handle_chat_list(event):
             "FROM ChatMessage__c "
             f"WHERE Parent_Record__c = '{soql_escape(parent_record_id)}' " +
             (f"AND CreatedDate > {since} " if since else "") +
-            "ORDER BY CreatedDate ASC LIMIT 500"
+            "ORDER BY CreatedDate ASC"
         )
-        rows = salesforce_query(inst, org_tok, soql).get("records", [])
-        msgs = [{"id": r["Id"], "body": r.get("Body__c"), "inbound": r.get("Is_Inbound__c", False), "at": r["CreatedDate"]} for r in rows]
+        msgs = [{"id": r["Id"], "body": r.get("Body__c"), "inbound": r.get("Is_Inbound__c", False), "at": r["CreatedDate"]}
+                for r in salesforce_query_iter(inst, org_tok, soql, batch_size=SF_QUERY_BATCH_SIZE)]
         return resp(event, 200, {"ok": True, "messages": msgs})
     except Exception as e:
         log("chat_list error:", repr(e))
@@ -1642,6 +3843,8 @@ def handle_identifier_chat_list(event, data):
     if not journal_id:
         log("CHAT_LIST_ERROR: Missing journalId in data. Full data:", data)
         return resp(event, 400, {"error": "Missing journalId"})
+    if not session_authorized_journals(sess, [journal_id]):
+        return resp(event, 403, {"error": "Forbidden"})
     
     since = (data.get("since") or "").strip()
     
@@ -1658,13 +3861,10 @@ def handle_identifier_chat_list(event, data):
             "FROM ChatMessage__c "
             f"WHERE Parent_Record__c = '{soql_escape(journal_id)}' " +
             (f"AND CreatedDate > {since} " if since else "") +
-            "ORDER BY CreatedDate ASC LIMIT 500"
+            "ORDER BY CreatedDate ASC, Id ASC"
         )
         log("CHAT_LIST_SOQL:", soql)
         
-        rows = salesforce_query(inst, org_tok, soql).get("records", [])
-        log("CHAT_LIST_RESULTS:", len(rows), "messages")
-        
         msgs = [{
             "id": r["Id"],
             "body": r.get("Body__c"),
@@ -1679,7 +3879,8 @@ def handle_identifier_chat_list(event, data):
             "originalTarget": r.get("Original_Target__c"),
             "finalTarget": r.get("Final_Target__c"),
             "targetChanged": r.get("Target_Changed__c", False)
-        } for r in rows]
+        } for r in salesforce_query_iter(inst, org_tok, soql, batch_size=SF_QUERY_BATCH_SIZE)]
+        log("CHAT_LIST_RESULTS:", len(msgs), "messages")
         return resp(event, 200, {"ok": True, "messages": msgs})
     except Exception as e:
         log("identifier_chat_list error:", repr(e))
@@ -1721,6 +3922,8 @@ def handle_identifier_chat_send(event, data):
     if not body:
         log("CHAT_SEND_ERROR: Missing body in data. Full data:", data)
         return resp(event, 400, {"error": "Missing body"})
+    if not session_authorized_journals(sess, [journal_id]):
+        return resp(event, 403, {"error": "Forbidden"})
     
     # Insert message directly to journal
     try:
@@ -1745,31 +3948,46 @@ def handle_identifier_chat_send(event, data):
         return resp(event, 500, {"error": "Salesforce insert failed"})
 
 
-def handle_identifier_chat_ask(event, data):
+class _StageTimer:
+    """Wall-clock milliseconds per named pipeline stage, reported back as `timings`."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + int((time.time() - t0) * 1000)
+
+    def elapsed_ms(self) -> int:
+        return int((time.time() - self.start) * 1000)
+
+
+def _prepare_chat_ask(event, data, prep: dict):
     """
-    AI-powered document Q&A endpoint.
-    
-    POST /identifier/chat/ask
-    Headers: Authorization: Bearer <session-token>
-    Body: {
-        "journalId": "a015g00000...",
-        "documentId": "a0M5g00000...",
-        "question": "What is this document about?",
-        "brand": "dk"  // optional, defaults to detected brand
-    }
-    
-    Returns: {
-        "answer": "Based on your document...",
-        "documentName": "Testament.pdf",
-        "isAI": true,
-        "cached": true,
-        "timestamp": "2025-10-26T..."
-    }
+    Shared front half of /identifier/chat/ask and /identifier/chat/ask-stream: authorize,
+    load the document and the document context (or a cached answer), filling `prep`.
+    The customer's question is inserted as soon as the caller is authorized, on the
+    write-behind pool so it overlaps the document lookup and the context load; callers
+    take its Id with _inbound_message_id, and any failure path waits for it through
+    _record_question, so the question is in Salesforce before the model is even asked.
+
+    Returns:
+        error_response, or None with prep = {
+            'inst', 'org_tok', 'journal_id', 'document_id', 'question', 'context',
+            'qctx', 'was_cached', 'inbound_fields', 'inbound_future', 'timer'
+        }
     """
     # Check if AI is enabled
     if not AI_ENABLED:
         return resp(event, 503, {"error": "AI chatbot is currently disabled"})
     
+    timer = _StageTimer()
+    
     # Authorization: Bearer <session>
     token = get_bearer(event)
     if not token:
@@ -1792,101 +4010,275 @@ def handle_identifier_chat_ask(event, data):
             "required": ["journalId", "documentId", "question"]
         })
     
-    try:
+    with timer.stage("auth"):
+        if not session_authorized_journals(sess, [journal_id]):
+            return resp(event, 403, {"error": "Forbidden"})
         org_tok, inst = get_org_token()
-        
-        # Get document details from Salesforce
-        soql = f"""
-            SELECT Id, Name, S3_Key__c, Journal__r.Name
-            FROM Shared_Document__c
-            WHERE Id = '{soql_escape(document_id)}'
-              AND Journal__c = '{soql_escape(journal_id)}'
-            LIMIT 1
-        """
-        
-        result = salesforce_query(inst, org_tok, soql)
-        if not result.get('records'):
-            log(f"AI ERROR: Document not found - docId={document_id}, journalId={journal_id}")
-            return resp(event, 404, {"error": "Document not found or access denied"})
-        
-        doc = result['records'][0]
-        s3_key = doc.get('S3_Key__c')
-        
-        if not s3_key:
-            log(f"AI ERROR: Document has no S3 key - docId={document_id}")
-            return resp(event, 400, {"error": "Document has no S3 key"})
-        
-        log(f"AI: Processing question for document: {s3_key}")
-        
-        # 1. CREATE customer's question (inbound ChatMessage) with routing metadata
-        #    Original_Target__c = AI (since they asked AI)
-        #    Final_Target__c and Target_Changed__c will be set later if user changes routing
-        inbound_fields = {
+    
+    # Customer's question (inbound ChatMessage) with routing metadata
+    #    Original_Target__c = AI (since they asked AI)
+    #    Final_Target__c and Target_Changed__c will be set later if user changes routing
+    # Note: Message_Type__c is only for OUTBOUND messages
+    prep.update({
+        'inst': inst,
+        'org_tok': org_tok,
+        'journal_id': journal_id,
+        'document_id': document_id,
+        'question': question,
+        'timer': timer,
+        'inbound_fields': {
             "Parent_Record__c": journal_id,
             "Body__c": question,
             "Is_Inbound__c": True,
             "Original_Target__c": "AI"  # They asked the AI
-        }
-        
-        # Note: Message_Type__c is only for OUTBOUND messages
-        # Final_Target__c and Target_Changed__c are initially null/false
-        
-        inbound_id = salesforce_insert(inst, org_tok, "ChatMessage__c", inbound_fields)
-        log(f"AI: Created inbound ChatMessage: {inbound_id} (Original_Target=AI)")
-        
-        # Get or extract document text
-        start_time = time.time()
-        document_text, was_cached = get_cached_text(s3_key)
-        
-        if not document_text:
-            log(f"AI ERROR: Could not extract text from {s3_key}")
-            return resp(event, 500, {"error": "Could not extract document text"})
-        
-        # Prepare context for AI
-        context = {
-            'name': doc.get('Name', 'Unknown'),
-            'journal_name': doc.get('Journal__r', {}).get('Name', ''),
-            'brand': brand
-        }
+        },
+    })
+    prep['inbound_future'] = _insert_pool.submit(salesforce_insert, inst, org_tok,
+                                                 "ChatMessage__c", prep['inbound_fields'])
+    
+    # Get document details from Salesforce
+    soql = f"""
+        SELECT Id, Name, S3_Key__c, Journal__r.Name
+        FROM Shared_Document__c
+        WHERE Id = '{soql_escape(document_id)}'
+          AND Journal__c = '{soql_escape(journal_id)}'
+        LIMIT 1
+    """
+    
+    with timer.stage("document"):
+        result = salesforce_query(inst, org_tok, soql)
+    if not result.get('records'):
+        log(f"AI ERROR: Document not found - docId={document_id}, journalId={journal_id}")
+        _record_question(prep)
+        return resp(event, 404, {"error": "Document not found or access denied"})
+    
+    doc = result['records'][0]
+    s3_key = doc.get('S3_Key__c')
+    
+    if not s3_key:
+        log(f"AI ERROR: Document has no S3 key - docId={document_id}")
+        _record_question(prep)
+        return resp(event, 400, {"error": "Document has no S3 key"})
+    
+    log(f"AI: Processing question for document: {s3_key}")
+    
+    # Prepare context for AI
+    context = {
+        'name': doc.get('Name', 'Unknown'),
+        'journal_name': doc.get('Journal__r', {}).get('Name', ''),
+        'brand': brand
+    }
+    
+    # Answer cache, else get or extract document text
+    with timer.stage("context"):
+        qctx = load_question_context(s3_key, question, context)
+    
+    if qctx['cached_answer'] is None and not qctx['document_text']:
+        log(f"AI ERROR: Could not extract text from {s3_key}")
+        _record_question(prep)
+        return resp(event, 500, {"error": "Could not extract document text"})
+    
+    prep.update({
+        'context': context,
+        'qctx': qctx,
+        'was_cached': qctx['was_cached'],
+    })
+    return None
+
+
+def _inbound_message_id(prep: dict) -> str:
+    """Id of the customer's question, waiting for the insert _prepare_chat_ask started."""
+    prep['written'] = True
+    return prep['inbound_future'].result()
+
+
+def _write_chat_exchange(prep: dict, answer: str, from_cache: bool = False) -> tuple:
+    """
+    CREATE the AI's response once the customer's question is in (so the question keeps
+    the lower Id when both share a CreatedDate).
+
+    Returns:
+        (inbound_id, outbound_id)
+    """
+    timer = prep['timer']
+    elapsed_ms = timer.elapsed_ms()
+    with timer.stage("write"):
+        inbound_id = _inbound_message_id(prep)
+        outbound_id = salesforce_insert(prep['inst'], prep['org_tok'], "ChatMessage__c",
+                                        _ai_answer_fields(prep['journal_id'], answer, elapsed_ms, from_cache))
+    return (inbound_id, outbound_id)
+
+
+def _record_question(prep: dict):
+    """
+    Make sure the question insert started by _prepare_chat_ask has finished before the
+    request returns (the Lambda may be frozen right after). Best effort: a failed insert
+    is logged, not re-sent - the Salesforce client already retries writes that never left.
+    A no-op before authorization (nothing to record) or once the Id was taken.
+    """
+    if not prep.get('inbound_future') or prep.get('written'):
+        return
+    prep['written'] = True
+    try:
+        prep['inbound_future'].result()
+    except Exception as e:
+        log(f"AI ERROR: could not record inbound ChatMessage: {repr(e)}")
+
+
+def handle_identifier_chat_ask(event, data):
+    """
+    AI-powered document Q&A endpoint.
+    
+    POST /identifier/chat/ask
+    Headers: Authorization: Bearer <session-token>
+    Body: {
+        "journalId": "a015g00000...",
+        "documentId": "a0M5g00000...",
+        "question": "What is this document about?",
+        "brand": "dk"  // optional, defaults to detected brand
+    }
+    
+    Returns: {
+        "answer": "Based on your document...",
+        "documentName": "Testament.pdf",
+        "isAI": true,
+        "cached": true,
+        "timestamp": "2025-10-26T...",
+        "timings": {"auth": 0, "document": 85, "context": 40, "model": 2100, "write": 160}
+    }
+    """
+    prep = {}
+    try:
+        error = _prepare_chat_ask(event, data, prep)
+        if error:
+            return error
+        context = prep['context']
+        timer = prep['timer']
         
-        # Ask AI
-        answer = ask_ai_about_document(document_text, question, context)
-        elapsed_ms = int((time.time() - start_time) * 1000)
+        # Ask AI (or serve the cached answer)
+        with timer.stage("model"):
+            answer, from_cache = answer_question(prep['qctx'], prep['question'], context)
         
-        # 2. CREATE AI's response (outbound ChatMessage)
-        outbound_id = salesforce_insert(inst, org_tok, "ChatMessage__c", {
-            "Parent_Record__c": journal_id,
-            "Body__c": answer,
-            "Is_Inbound__c": False,
-            "Message_Type__c": "AI",
-            "AI_Model__c": BEDROCK_MODEL_ID,
-            "AI_Response_Time__c": elapsed_ms
-        })
-        log(f"AI: Created outbound ChatMessage: {outbound_id} (response time: {elapsed_ms}ms)")
+        # Answer (the question was inserted while the document loaded)
+        inbound_id, outbound_id = _write_chat_exchange(prep, answer, from_cache)
+        elapsed_ms = timer.elapsed_ms()
+        log(f"AI: Created ChatMessages {inbound_id} -> {outbound_id} (response time: {elapsed_ms}ms, stages: {timer.timings})")
         
         # Log interaction (for monitoring and quality improvement)
-        log(f"AI: Answered question - docId={document_id}, questionLen={len(question)}, answerLen={len(answer)}, cached={was_cached}")
+        log(f"AI: Answered question - docId={prep['document_id']}, questionLen={len(prep['question'])}, answerLen={len(answer)}, cached={prep['was_cached']}, answerCached={from_cache}")
         
         return resp(event, 200, {
             "answer": answer,
             "documentName": context['name'],
             "isAI": True,
-            "cached": was_cached,
+            "cached": prep['was_cached'],
+            "answerCached": from_cache,
             "timestamp": datetime.datetime.utcnow().isoformat(),
             "inboundMessageId": inbound_id,
             "outboundMessageId": outbound_id,
-            "responseTimeMs": elapsed_ms
+            "responseTimeMs": elapsed_ms,
+            "timings": timer.timings
         })
         
     except Exception as e:
         log(f"AI ERROR: chat/ask failed: {repr(e)}")
         log("Full traceback:", traceback.format_exc())
+        _record_question(prep)
         return resp(event, 500, {
             "error": "AI query failed",
             "details": str(e) if os.environ.get("DEBUG") else "Internal server error"
         })
 
 
+def handle_identifier_chat_ask_stream(event, data, write):
+    """
+    Streaming variant of /identifier/chat/ask.
+    
+    POST /identifier/chat/ask-stream   (same headers and body as /identifier/chat/ask)
+    
+    Writes newline-delimited JSON events through `write(bytes)` as they happen:
+        {"type": "start", "documentName": "...", "cached": true, "inboundMessageId": "..."}
+        {"type": "delta", "text": "..."}            // repeated, in order
+        {"type": "done", "inboundMessageId": "...", "outboundMessageId": "...",
+         "responseTimeMs": 1234, "firstTokenMs": 380, "answerCached": false, "timings": {...}}
+    or an {"type": "error", "status": 4xx/5xx, "error": "..."} event, which can also
+    follow some deltas when the model stream breaks off (discard the partial answer).
+    The question is inserted while the document loads; the answer is inserted after the
+    last token, so the customer sees it at time-to-first-token instead of
+    after generation + the Salesforce write.
+    """
+    def emit(obj):
+        write((json.dumps(obj) + "\n").encode("utf-8"))
+
+    prep = {}
+    try:
+        error = _prepare_chat_ask(event, data, prep)
+        if error:
+            emit({"type": "error", "status": error["statusCode"], **json.loads(error["body"])})
+            return
+        timer = prep['timer']
+        qctx = prep['qctx']
+        from_cache = qctx['cached_answer'] is not None
+        outcome = {}
+        if from_cache:
+            fragments = iter([qctx['cached_answer']])
+        else:
+            fragments = stream_ai_answer(qctx['document_text'], prep['question'], prep['context'], outcome,
+                                         cache_document=qctx['whole_document'])
+        
+        # The question insert has had the document load and the first token to finish,
+        # so "start" carries its Id without delaying the answer
+        parts = []
+        with timer.stage("model"):
+            first = next(fragments, None)
+            first_token_ms = timer.elapsed_ms()
+            inbound_id = _inbound_message_id(prep)
+            emit({
+                "type": "start",
+                "documentName": prep['context']['name'],
+                "isAI": True,
+                "cached": prep['was_cached'],
+                "inboundMessageId": inbound_id,
+            })
+            while first is not None:
+                parts.append(first)
+                emit({"type": "delta", "text": first})
+                first = next(fragments, None)
+        answer = "".join(parts)
+        # Only a stream the model finished cleanly is a whole answer worth caching and writing
+        finished = from_cache or 'stop_reason' in outcome
+        if not finished and answer != _ai_error_message(prep['context']):
+            raise AIStreamInterrupted("model stream ended without a stop reason")
+        if finished and not from_cache and qctx['answer_key']:
+            put_cached_answer(qctx['answer_key'], answer)
+        
+        with timer.stage("write"):
+            outbound_id = salesforce_insert(prep['inst'], prep['org_tok'], "ChatMessage__c",
+                                            _ai_answer_fields(prep['journal_id'], answer, timer.elapsed_ms(), from_cache))
+        elapsed_ms = timer.elapsed_ms()
+        log(f"AI: Created ChatMessages {inbound_id} -> {outbound_id} (stream: first token {first_token_ms}ms, total {elapsed_ms}ms, stages: {timer.timings})")
+        emit({
+            "type": "done",
+            "inboundMessageId": inbound_id,
+            "outboundMessageId": outbound_id,
+            "responseTimeMs": elapsed_ms,
+            "firstTokenMs": first_token_ms,
+            "answerCached": from_cache,
+            "timings": timer.timings,
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+        })
+        
+    except AIStreamInterrupted as e:
+        log(f"AI ERROR: chat/ask-stream interrupted after partial answer: {repr(e)}")
+        _record_question(prep)
+        emit({"type": "error", "status": 502, "error": "AI answer interrupted"})
+    except Exception as e:
+        log(f"AI ERROR: chat/ask-stream failed: {repr(e)}")
+        log("Full traceback:", traceback.format_exc())
+        _record_question(prep)
+        emit({"type": "error", "status": 500, "error": "AI query failed"})
+
+
 def handle_identifier_chat_feedback(event, data):
     """
     Handle AI message feedback (helpful or escalate to human).
@@ -1926,10 +4318,8 @@ def handle_identifier_chat_feedback(event, data):
         org_tok, inst = get_org_token()
         
         if action == "helpful":
-            # Mark the AI OUTBOUND message as helpful
-            salesforce_patch(inst, org_tok, "ChatMessage__c", message_id, {
-                "AI_Helpful__c": True
-            })
+            # Mark the AI OUTBOUND message as helpful (write-behind)
+            enqueue_sf_update("ChatMessage__c", message_id, {"AI_Helpful__c": True})
             log(f"AI Feedback: Outbound message {message_id} marked as helpful")
             return resp(event, 200, {"ok": True})
         
@@ -1951,15 +4341,18 @@ def handle_identifier_chat_feedback(event, data):
             journal_id = ai_msg.get('Parent_Record__c')
             ai_created = ai_msg.get('CreatedDate')
             
-            # 2. Find the original customer question (most recent INBOUND message before this AI outbound message)
+            # 2. Find the original customer question (most recent INBOUND message up to this AI outbound message)
             #    This is the message we need to UPDATE (not create a new one)
+            #    The question is usually created in the same second as the answer, so the
+            #    bound is inclusive and Id breaks the tie (the question is inserted first)
             original_soql = f"""
                 SELECT Id, Body__c, Original_Target__c
                 FROM ChatMessage__c
                 WHERE Parent_Record__c = '{soql_escape(journal_id)}'
                   AND Is_Inbound__c = true
-                  AND CreatedDate < {ai_created}
-                ORDER BY CreatedDate DESC
+                  AND Id != '{soql_escape(ai_msg['Id'])}'
+                  AND CreatedDate <= {ai_created}
+                ORDER BY CreatedDate DESC, Id DESC
                 LIMIT 1
             """
             original_result = salesforce_query(inst, org_tok, original_soql)
@@ -2037,9 +4430,13 @@ def handle_identifier_chat_switch_to_ai(event, data):
         })
     
     try:
-        org_tok, inst = get_org_token()
+        timer = _StageTimer()
+        with timer.stage("auth"):
+            if not session_authorized_journals(sess, [journal_id]):
+                return resp(event, 403, {"error": "Forbidden"})
+            org_tok, inst = get_org_token()
         
-        # 1. Get the original INBOUND message
+        # 1. Get the original INBOUND message and 2. the document, concurrently
         msg_soql = f"""
             SELECT Id, Body__c, Original_Target__c, Final_Target__c, Target_Changed__c
             FROM ChatMessage__c
@@ -2048,22 +4445,6 @@ def handle_identifier_chat_switch_to_ai(event, data):
               AND Parent_Record__c = '{soql_escape(journal_id)}'
             LIMIT 1
         """
-        msg_result = salesforce_query(inst, org_tok, msg_soql)
-        if not msg_result.get('records'):
-            return resp(event, 404, {"error": "Message not found"})
-        
-        msg = msg_result['records'][0]
-        question = msg.get('Body__c', '')
-        original_target = msg.get('Original_Target__c', 'Human')
-        
-        # 2. UPDATE the message to show it was switched to AI
-        salesforce_patch(inst, org_tok, "ChatMessage__c", message_id, {
-            "Final_Target__c": "AI",
-            "Target_Changed__c": True
-        })
-        log(f"Switch to AI: Updated message {message_id} (Original: {original_target} -> Final: AI)")
-        
-        # 3. Get document for AI processing
         doc_soql = f"""
             SELECT Id, Name, S3_Key__c, Journal__r.Name
             FROM Shared_Document__c
@@ -2071,7 +4452,17 @@ def handle_identifier_chat_switch_to_ai(event, data):
               AND Journal__c = '{soql_escape(journal_id)}'
             LIMIT 1
         """
-        doc_result = salesforce_query(inst, org_tok, doc_soql)
+        with timer.stage("lookup"), ThreadPoolExecutor(max_workers=2) as pool:
+            msg_future = pool.submit(salesforce_query, inst, org_tok, msg_soql)
+            doc_future = pool.submit(salesforce_query, inst, org_tok, doc_soql)
+            msg_result, doc_result = msg_future.result(), doc_future.result()
+        if not msg_result.get('records'):
+            return resp(event, 404, {"error": "Message not found"})
+        
+        msg = msg_result['records'][0]
+        question = msg.get('Body__c', '')
+        original_target = msg.get('Original_Target__c', 'Human')
+        
         if not doc_result.get('records'):
             return resp(event, 404, {"error": "Document not found"})
         
@@ -2083,39 +4474,46 @@ def handle_identifier_chat_switch_to_ai(event, data):
         
         log(f"Switch to AI: Processing question for document: {s3_key}")
         
-        # 4. Get document text and ask AI
-        start_time = time.time()
-        document_text, was_cached = get_cached_text(s3_key)
-        
-        if not document_text:
-            log(f"Switch to AI ERROR: Could not extract text from {s3_key}")
-            return resp(event, 500, {"error": "Could not extract document text"})
-        
         context = {
             'name': doc.get('Name', 'Unknown'),
             'journal_name': doc.get('Journal__r', {}).get('Name', ''),
             'brand': brand
         }
         
-        answer = ask_ai_about_document(document_text, question, context)
-        elapsed_ms = int((time.time() - start_time) * 1000)
+        # 3. Get document text and ask AI (or serve the cached answer)
+        with timer.stage("context"):
+            qctx = load_question_context(s3_key, question, context)
         
-        # 5. CREATE AI's response (outbound ChatMessage)
-        outbound_id = salesforce_insert(inst, org_tok, "ChatMessage__c", {
-            "Parent_Record__c": journal_id,
-            "Body__c": answer,
-            "Is_Inbound__c": False,
-            "Message_Type__c": "AI",
-            "AI_Model__c": BEDROCK_MODEL_ID,
-            "AI_Response_Time__c": elapsed_ms
-        })
-        log(f"Switch to AI: Created outbound AI message {outbound_id}")
+        if qctx['cached_answer'] is None and not qctx['document_text']:
+            log(f"Switch to AI ERROR: Could not extract text from {s3_key}")
+            return resp(event, 500, {"error": "Could not extract document text"})
+        
+        with timer.stage("model"):
+            answer, from_cache = answer_question(qctx, question, context)
+        elapsed_ms = timer.elapsed_ms()
+        
+        # 4. UPDATE the message to show it was switched to AI and
+        # 5. CREATE AI's response (outbound ChatMessage), in one all-or-none composite request.
+        # The switch is only recorded together with the answer: if anything before this
+        # fails, the message stays targeted at a human, and a retry never duplicates the answer.
+        with timer.stage("write"):
+            results = salesforce_composite(inst, org_tok, [
+                {"method": "PATCH", "path": f"/sobjects/ChatMessage__c/{message_id}", "referenceId": "switch",
+                 "body": {"Final_Target__c": "AI", "Target_Changed__c": True}},
+                {"method": "POST", "path": "/sobjects/ChatMessage__c", "referenceId": "outbound",
+                 "body": _ai_answer_fields(journal_id, answer, elapsed_ms, from_cache)},
+            ], all_or_none=True)
+        outbound_id = results["outbound"]["body"]["id"]
+        log(f"Switch to AI: Updated message {message_id} (Original: {original_target} -> Final: AI)")
+        log(f"Switch to AI: Created outbound AI message {outbound_id} (answerCached={from_cache}, stages: {timer.timings})")
         
         return resp(event, 200, {
             "ok": True,
             "answer": answer,
+            "answerCached": from_cache,
             "outboundMessageId": outbound_id,
-            "responseTimeMs": elapsed_ms
+            "responseTimeMs": elapsed_ms,
+            "timings": timer.timings
         })
         
     except Exception as e:
@@ -2133,7 +4531,9 @@ def handle_ping(event):
 def handle_sf_oauth_check(event):
     try:
         tok, inst = get_org_token()
-        return resp(event, 200, {"ok": True, "instanceUrl": inst})
+        age = org_token_age()   # inf if another request invalidated the token meanwhile
+        return resp(event, 200, {"ok": True, "instanceUrl": inst,
+                                 "tokenAgeSeconds": int(age) if math.isfinite(age) else None})
     except HTTPError as e:
         try:
             body = e.read().decode("utf-8", "ignore")
@@ -2167,6 +4567,12 @@ def _parse_body(event):
             return {}
 
 def lambda_handler(event, context):
+    try:
+        return _handle_http(event, context)
+    finally:
+        drain_write_behind()
+
+def _handle_http(event, context):
     try:
         method = (event.get("requestContext", {}).get("http", {}).get("method") or "").upper()
         path   = (event.get("rawPath") or "").lower()
@@ -2182,6 +4588,7 @@ def lambda_handler(event, context):
         # Health / diagnostics
         if path.endswith("/ping")                       and method == "GET":  return handle_ping(event)
         if path.endswith("/diag/net")                   and method == "GET":  return handle_diag_net(event)
+        if path.endswith("/diag/cache")                 and method == "GET":  return handle_diag_cache(event)
         if path.endswith("/sf-oauth-check")             and method == "GET":  return handle_sf_oauth_check(event)
 
         # Client Impersonation (NEW)
@@ -2206,6 +4613,7 @@ def lambda_handler(event, context):
 
         # Chat (identifier-specific routes MUST come before journal routes to avoid path collision!)
         if path.endswith("/identifier/chat/ask")        and method == "POST": return handle_identifier_chat_ask(event, data)
+        if path.endswith("/identifier/chat/ask-stream") and method == "POST": return _buffered_stream_response(event, handle_identifier_chat_ask_stream, data)
         if path.endswith("/identifier/chat/feedback")   and method == "POST": return handle_identifier_chat_feedback(event, data)
         if path.endswith("/identifier/chat/switch-to-ai") and method == "POST": return handle_identifier_chat_switch_to_ai(event, data)
         if path.endswith("/identifier/chat/send")       and method == "POST": return handle_identifier_chat_send(event, data)
@@ -2229,6 +4637,220 @@ def lambda_handler(event, context):
         log(traceback.format_exc())
         return resp(event, 500, {"error": "Server error"})
 
+# ===================== RESPONSE STREAMING =====================
+
+STREAMING_ROUTES = {
+    "/identifier/chat/ask-stream": handle_identifier_chat_ask_stream,
+}
+
+def _stream_headers(event):
+    return {
+        "Content-Type": "application/x-ndjson",
+        "Cache-Control": "no-cache",
+        "Access-Control-Allow-Origin": _cors_origin(event),
+        "Access-Control-Allow-Headers": "Content-Type,Authorization",
+        "Access-Control-Allow-Methods": "POST,GET,OPTIONS",
+        "Vary": "Origin",
+    }
+
+def _buffered_stream_response(event, handler, data):
+    """Run a streaming handler behind a buffering integration: same NDJSON, delivered at once."""
+    buf = io.BytesIO()
+    handler(event, data, buf.write)
+    out = resp(event, 200, buf.getvalue().decode("utf-8"), content_type="application/x-ndjson")
+    out["headers"]["Cache-Control"] = "no-cache"
+    return out
+
+def stream_handler(event, response_stream, context=None):
+    """
+    Entry point for deployments with Lambda response streaming (function URL in
+    RESPONSE_STREAM mode via a streaming-capable runtime/adapter). `response_stream`
+    needs write(bytes), plus optional set_headers(dict) and close().
+    Routes in STREAMING_ROUTES write tokens as they arrive. Every other route goes through
+    lambda_handler and is written out whole.
+    """
+    method = (event.get("requestContext", {}).get("http", {}).get("method") or "").upper()
+    path   = (event.get("rawPath") or "").lower()
+    handler = next((h for suffix, h in STREAMING_ROUTES.items() if path.endswith(suffix)), None)
+    try:
+        if handler is None or method != "POST":
+            result = lambda_handler(event, context)
+            if hasattr(response_stream, "set_headers"):
+                response_stream.set_headers({"statusCode": result["statusCode"], "headers": result["headers"]})
+            response_stream.write(result["body"].encode("utf-8"))
+            return
+        if hasattr(response_stream, "set_headers"):
+            response_stream.set_headers({"statusCode": 200, "headers": _stream_headers(event)})
+        handler(event, _parse_body(event), response_stream.write)
+    finally:
+        if hasattr(response_stream, "close"):
+            response_stream.close()
+        drain_write_behind()
+
+# ===================== WRITE-BEHIND DRAIN (SQS entry point) =====================
+
+def write_behind_sqs_handler(event, context):
+    """
+    Lambda entry point for the WRITE_BEHIND_QUEUE_URL event source mapping
+    (ReportBatchItemFailures enabled). Update messages in the batch are coalesced per record
+    in arrival order and flushed with sObject Collections; insert messages are created one
+    by one. Messages whose record failed are
+    reported back so SQS redelivers them, and the queue's redrive policy moves them to the
+    DLQ after maxReceiveCount.
+    """
+    updates, message_ids, failed_inserts = OrderedDict(), {}, []
+    for record in event.get("Records", []):
+        try:
+            msg = json.loads(record["body"])
+            if msg.get("op") == "insert":
+                # Inserts (enqueue_sf_insert) are not coalesced
+                try:
+                    _insert_and_link(msg["sobject"], msg["fields"], msg.get("link"))
+                except Exception as e:
+                    log(f"WRITE_BEHIND_RETRY insert {msg['sobject']}: {repr(e)}")
+                    failed_inserts.append(record["messageId"])
+                continue
+            key = (msg["sobject"], msg["id"])
+        except Exception as e:
+            log(f"WRITE_BEHIND: dropping malformed message {record.get('messageId')}: {repr(e)}")
+            continue
+        updates.setdefault(key, {}).update(msg.get("fields") or {})
+        message_ids.setdefault(key, []).append(record["messageId"])
+
+    failures = flush_sf_updates(updates)
+    for key, error in failures.items():
+        log(f"WRITE_BEHIND_RETRY {key[0]} {key[1]}: {error}")
+    log(f"WRITE_BEHIND: flushed {len(updates) - len(failures)}/{len(updates)} records from {len(event.get('Records', []))} messages")
+    failed = [mid for key in failures for mid in message_ids[key]] + failed_inserts
+    return {"batchItemFailures": [{"itemIdentifier": mid} for mid in failed]}
+
+# ===================== IDENTIFIER INDEX REFRESH (scheduled entry point) =====================
+
+_IDENTIFIER_INDEX_CURSOR_KEY = "ident#cursor"
+
+def _identifiers_of(account: dict):
+    """(typ, value) pairs an Account row grants access to, spouse fields included."""
+    account = account or {}
+    for typ, field in (("email", "PersonEmail"), ("email", "Spouse_Email__pc"),
+                       ("phone", "Phone_Formatted__c"), ("phone", "Spouse_Phone__pc")):
+        value = _normalize_identifier(typ, account.get(field) or "")
+        if value:
+            yield typ, value
+
+def identifier_index_refresh_handler(event, context):
+    """
+    Lambda entry point for an EventBridge schedule (e.g. every 5 minutes). Finds identifiers
+    whose account or shared documents changed since the last run (LastModifiedDate is
+    indexed) and re-resolves the ones that have an index entry; the rest are resolved on
+    their next miss. An identifier that was removed from an account is not seen here; readers
+    that grant access re-resolve entries older than SESSION_JOURNAL_REFRESH_SECONDS.
+    """
+    store = get_state_store()
+    started = datetime.datetime.utcnow()
+    cursor = store.get(_IDENTIFIER_INDEX_CURSOR_KEY) or {}
+    since = cursor.get("since") or (
+        started - datetime.timedelta(minutes=IDENTIFIER_INDEX_LOOKBACK_MINUTES)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    org_token, instance_url = get_org_token()
+    touched = set()
+    doc_soql = (
+        "SELECT Journal__r.Account__r.PersonEmail, Journal__r.Account__r.Spouse_Email__pc, "
+        "       Journal__r.Account__r.Phone_Formatted__c, Journal__r.Account__r.Spouse_Phone__pc "
+        f"FROM Shared_Document__c WHERE LastModifiedDate >= {since}"
+    )
+    for r in salesforce_query_iter(instance_url, org_token, doc_soql, batch_size=SF_QUERY_BATCH_SIZE):
+        touched.update(_identifiers_of(((r.get("Journal__r") or {}).get("Account__r"))))
+    acct_soql = (
+        "SELECT PersonEmail, Spouse_Email__pc, Phone_Formatted__c, Spouse_Phone__pc "
+        f"FROM Account WHERE LastModifiedDate >= {since}"
+    )
+    for r in salesforce_query_iter(instance_url, org_token, acct_soql, batch_size=SF_QUERY_BATCH_SIZE):
+        touched.update(_identifiers_of(r))
+
+    refreshed = dropped = 0
+    for typ, value in sorted(touched):
+        key = _identifier_index_key(typ, value)
+        if store.get(key) is None:
+            continue
+        if refreshed < IDENTIFIER_INDEX_REFRESH_MAX:
+            refresh_identifier_index(typ, value)
+            refreshed += 1
+        else:
+            store.delete(key)  # over budget: resolve on next miss instead
+            dropped += 1
+
+    # Overlap runs slightly so records committed while we queried are not missed
+    next_since = (started - datetime.timedelta(seconds=60)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    store.put_if(_IDENTIFIER_INDEX_CURSOR_KEY, {"since": next_since}, 7 * 86400)
+    log(f"IDENTIFIER_INDEX: since {since}: {len(touched)} identifiers changed, {refreshed} refreshed, {dropped} dropped")
+    return {"since": since, "changed": len(touched), "refreshed": refreshed, "dropped": dropped}
+
+# ===================== S3 PRE-EXTRACTION (second entry point) =====================
+
+def _customer_document_prefixes():
+    # Every prefix handle_upload_start can write to (see s3_base_prefix_for_market)
+    prefixes = set(_DEFAULT_PREFIX_MAP.values()) | set(_S3_PREFIX_MAP.values()) | {_FALLBACK_PREFIX}
+    return tuple(p.rstrip("/") + "/" for p in prefixes if p)
+
+def _brand_for_key(s3_key: str) -> str:
+    """Portal brand whose market prefix s3_key lives under (dk when no market prefix matches)."""
+    brands = {market: brand for brand, market in BRAND_MARKETS.items()}
+    for market, prefix in dict(_DEFAULT_PREFIX_MAP, **_S3_PREFIX_MAP).items():
+        if prefix and market in brands and s3_key.startswith(prefix.rstrip("/") + "/"):
+            return brands[market]
+    return "dk"
+
+def s3_event_handler(event, context):
+    """
+    Lambda entry point for S3 ObjectCreated notifications on DOCS_BUCKET.
+
+    Warms the text cache for uploaded customer documents so the first /identifier/chat/ask
+    does not pay for download + PyMuPDF, and builds the retrieval indexes (BM25 and chunk
+    embeddings, in the language of the document's market) for documents too large to send
+    whole. Safe to replay: every step is a no-op for content that is already cached.
+    """
+    if not AI_ENABLED:
+        return {"processed": 0, "skipped": len((event or {}).get("Records") or []), "failed": 0}
+
+    prefixes = _customer_document_prefixes()
+    processed, skipped, failed = 0, 0, []
+    seen = set()
+
+    for rec in (event or {}).get("Records") or []:
+        if rec.get("eventSource") != "aws:s3" or not (rec.get("eventName") or "").startswith("ObjectCreated"):
+            skipped += 1
+            continue
+        s3info = rec.get("s3") or {}
+        bucket = (s3info.get("bucket") or {}).get("name")
+        obj    = s3info.get("object") or {}
+        key    = urllib.parse.unquote_plus(obj.get("key") or "")
+        etag   = (obj.get("eTag") or "").strip('"') or None
+
+        if bucket != DOCS_BUCKET or not key.lower().endswith(".pdf") or not key.startswith(prefixes):
+            skipped += 1
+            continue
+        if (key, etag) in seen:
+            skipped += 1
+            continue
+        seen.add((key, etag))
+
+        try:
+            doc = get_document_pages(key, etag=etag)
+            indexed = warm_retrieval_indexes(doc['sha256'], doc['pages'], _brand_for_key(key))
+            log(f"PREEXTRACT: {key} -> {doc['sha256'][:12]} ({'already cached' if doc['cached'] else 'extracted'}"
+                f"{', retrieval indexes ready' if indexed else ''})")
+            processed += 1
+        except Exception as e:
+            log(f"PREEXTRACT ERROR: {key}: {repr(e)}")
+            failed.append(key)
+
+    summary = {"processed": processed, "skipped": skipped, "failed": len(failed)}
+    log("PREEXTRACT_SUMMARY:", summary)
+    if failed:
+        # Let Lambda's async retry redeliver the event; already-warmed keys are no-ops on replay
+        raise RuntimeError(f"Pre-extraction failed for {len(failed)} object(s): {failed[:5]}")
+    return summary
+
 # ===================== COMPAT HELPERS (unchanged) =====================
 
 def handle_otp_init(event, _):   # kept for compatibility
@@ -2245,32 +4867,18 @@ def handle_identifier_search(event, event_json):
     try:
         org_token, instance_url = get_org_token()
         if has_email:
-            email = raw_email.lower()
-            if "@" not in email or "." not in email.split("@")[-1]:
+            typ, value = "email", raw_email.lower()
+            if "@" not in value or "." not in value.split("@")[-1]:
                 return resp(event, 400, {"error": "Invalid email format"})
-            esc = email.replace("'", "\\'")
-            soql = (
-                "SELECT COUNT() FROM Shared_Document__c WHERE "
-                "(Journal__r.Account__r.PersonEmail = '" + esc + "' "
-                "OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-                "AND Journal__r.Account__r.Spouse_Email__pc = '" + esc + "'))"
-            )
-            count = salesforce_query(instance_url, org_token, soql).get("totalSize", 0)
-            return resp(event, 200, {"ok": True, "identifierType": "email", "identifier": email, "matchCount": count})
         else:
-            phone = normalize_phone_basic(raw_phone)
-            if not any(ch.isdigit() for ch in phone):
+            typ, value = "phone", normalize_phone_basic(raw_phone, detect_brand(event))
+            if not any(ch.isdigit() for ch in value):
                 return resp(event, 400, {"error": "Invalid phone format"})
-            esc_vals = ["'" + v.replace("'", "\\'") + "'" for v in phone_variants_for_match(phone)]
-            in_clause = ", ".join(esc_vals) if esc_vals else "''"
-            soql = (
-                "SELECT COUNT() FROM Shared_Document__c WHERE "
-                "(Journal__r.Account__r.Phone_Formatted__c = '" + phone.replace("'", "\\'") + "' "
-                "OR (Journal__r.Account__r.Is_Spouse_Shared_Document_Recipient__pc = true "
-                "AND Journal__r.Account__r.Spouse_Phone__pc IN (" + in_clause + ")))"
-            )
-            count = salesforce_query(instance_url, org_token, soql).get("totalSize", 0)
-            return resp(event, 200, {"ok": True, "identifierType": "phone", "identifier": phone, "matchCount": count})
+        count = 0
+        for clause in _journal_in_clauses(identifier_journal_ids(typ, value, max_age=SESSION_JOURNAL_REFRESH_SECONDS)):
+            soql = "SELECT COUNT() FROM Shared_Document__c WHERE " + clause
+            count += int(salesforce_query(instance_url, org_token, soql).get("totalSize", 0))
+        return resp(event, 200, {"ok": True, "identifierType": typ, "identifier": value, "matchCount": count})
     except Exception as e:
         log("identifier_search error:", repr(e))
         return resp(event, 500, {"error": "Salesforce query failed"})
@@ -0,0 +1,146 @@
+"""
+Phone normalization to E.164 (+<country code><number>), shared by the Lambda and the
+backfill script.
+
+The rules mirror the Apex AccountPhoneNormalizer that rewrites Account.Phone and
+Spouse_Phone__pc in Salesforce, so a number typed into the portal and the number stored on
+the Account end up as the same string and can be matched exactly. The golden corpus in
+salesforce/main/default/staticresources/PhoneNormalizationGolden.json pins that agreement
+(the Apex side can read it as a static resource):
+
+    python phone_normalize.py --check
+"""
+import json, os, re, sys
+
+# Market unit -> (country code, accepted local number lengths once the trunk 0 is dropped)
+MARKETS = {
+    "DFJ_DK":        ("45",  (8, 8)),
+    "Testamente_DK": ("45",  (8, 8)),
+    "FA_SE":         ("46",  (7, 10)),
+    "Ireland":       ("353", (9, 10)),
+}
+
+BRAND_MARKETS = {"dk": "DFJ_DK", "se": "FA_SE", "ie": "Ireland"}
+
+# Numbers written with the country code but without + / 00: code -> total digit counts
+_BARE_INTERNATIONAL = (
+    ("45",  (10,)),      # 45 + 8
+    ("46",  (11,)),      # 46 + 9
+    ("353", (12, 13)),   # 353 + 9-10
+)
+
+_NON_DIGITS = re.compile(r"[^0-9]")
+# The shape of every normalize_phone result (+ and digits only)
+_NORMALIZED = re.compile(r"^\+[0-9]+$")
+# One trunk 0 after a known country code: +45 0XX -> +45 XX (353 only with digits after it)
+_TRUNK_AFTER_CODE = re.compile(r"^(?:(45|46)0|(353)0(?=.))")
+# Leading zeros of a local number, keeping at least one digit
+_LEADING_ZEROS = re.compile(r"^0+(?=.)")
+
+DEFAULT_GOLDEN_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "salesforce", "main", "default", "staticresources", "PhoneNormalizationGolden.json",
+)
+
+
+def market_for_brand(brand: str):
+    """Market unit whose local-number rules apply to a portal brand ("dk" | "se" | "ie")."""
+    return BRAND_MARKETS.get((brand or "").strip().lower())
+
+
+def normalize_phone(raw: str, market_unit: str = None) -> str:
+    """
+    E.164 form of `raw`. An explicit country code (+ or 00) is kept; a bare number that
+    already carries a known country code is recognised by its length; anything else is a
+    local number and gets the market unit's country code when its length fits. Blank or
+    digit-less input is returned unchanged.
+
+    These are the Apex rules as they are, which are not idempotent: "+450..." loses
+    another 0 on a second pass. Values that already went through them (Account fields,
+    the index) are kept with canonical_phone instead of being normalized again.
+    """
+    if raw is None or not raw.strip():
+        return raw
+    s = raw.strip()
+    has_plus = s.startswith("+")
+    digits = _NON_DIGITS.sub("", s)
+
+    if not has_plus and digits.startswith("00"):
+        digits, has_plus = digits[2:], True
+
+    if has_plus and len(digits) > 3:
+        return "+" + _TRUNK_AFTER_CODE.sub(r"\1\2", digits, count=1)
+
+    for code, lengths in _BARE_INTERNATIONAL:
+        if digits.startswith(code) and len(digits) in lengths:
+            return "+" + digits
+
+    digits = _LEADING_ZEROS.sub("", digits)
+    market = MARKETS.get(market_unit or "")
+    if market:
+        code, (lo, hi) = market
+        if lo <= len(digits) <= hi:
+            return "+" + code + digits
+
+    if digits:
+        return "+" + digits
+    return raw
+
+
+def is_normalized(value: str) -> bool:
+    """True for values in the form normalize_phone produces (+ and digits only)."""
+    return bool(value) and _NORMALIZED.match(value) is not None
+
+
+def canonical_phone(value: str, market_unit: str = None) -> str:
+    """
+    `value` if it is already normalized, else normalize_phone(value, market_unit). For
+    values that come out of normalize_phone or the Apex normalizer, so running them
+    through again is a no-op.
+    """
+    s = (value or "").strip()
+    return s if is_normalized(s) else normalize_phone(value, market_unit)
+
+
+def normalize_phones(values, market_units=None) -> list:
+    """
+    Batch form of normalize_phone. `market_units` is one market unit for every value, or a
+    sequence parallel to `values`. Repeated (value, market) pairs - common in exports, where
+    spouses and family members share numbers - are normalized once.
+    """
+    if market_units is None or isinstance(market_units, str):
+        market_units = [market_units] * len(values)
+    memo, out = {}, []
+    for raw, market_unit in zip(values, market_units):
+        key = (raw, market_unit)
+        if key not in memo:
+            memo[key] = normalize_phone(raw, market_unit)
+        out.append(memo[key])
+    return out
+
+
+def check_golden(path: str = DEFAULT_GOLDEN_PATH) -> list:
+    """
+    Corpus cases whose result differs from `expected`, or whose `expected` is not kept as
+    is by canonical_phone, as (case, actual) pairs.
+    """
+    with open(path, encoding="utf-8") as f:
+        cases = json.load(f)["cases"]
+    markets = [c.get("market") for c in cases]
+    actual = normalize_phones([c["raw"] for c in cases], markets)
+    again = [canonical_phone(c["expected"], m) for c, m in zip(cases, markets)]
+    return [(c, got if got != c["expected"] else twice) for c, got, twice in zip(cases, actual, again)
+            if got != c["expected"] or twice != c["expected"]]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--check":
+        path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_GOLDEN_PATH
+        failures = check_golden(path)
+        for case, got in failures:
+            print(f"FAIL {case['raw']!r} [{case.get('market')}]: expected {case['expected']!r}, got {got!r}")
+        print(f"{len(failures)} failure(s)")
+        sys.exit(1 if failures else 0)
+    for line in sys.stdin:
+        raw, _, market_unit = line.rstrip("\n").partition("\t")
+        print(normalize_phone(raw, market_unit or None))